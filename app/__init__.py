@@ -48,7 +48,7 @@ from .models.layout import Layout
 from .models.permission import Permissions
 from .models.state_history import StateHistory
 from .models.task import Task
-from .models.log import Log
+from .models.log import Log, create_log_indexes
 
 
 # Try to connect to the database. If it cannot succeed after a
@@ -60,6 +60,7 @@ while not connected_to_db:
         if settings.drop_database_on_startup:
             db.drop_all()
         db.create_all()
+        create_log_indexes()
         connected_to_db = True
     except (pymysql.err.OperationalError, pymysql.err.InternalError,
             sqlalchemy.exc.InternalError, sqlalchemy.exc.OperationalError,
@@ -96,7 +97,7 @@ app.register_blueprint(chat_blueprint)
 
 login_manager.init_app(app)
 login_manager.login_view = 'login.index'
-socketio.init_app(app)
+socketio.init_app(app, message_queue=settings.socketio_message_queue)
 
 
 @event.listens_for(Engine, "connect")
@@ -165,4 +166,7 @@ sys.stdout.flush()
 from .crwiz import init_crwiz, logger_crwiz, stop_bots
 init_crwiz()
 
+from .crwiz.analysis_queue import analysis_queue
+analysis_queue.resume()
+
 logger_crwiz.info("Ready")
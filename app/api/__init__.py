@@ -1,12 +1,14 @@
-from flask import g, make_response, jsonify, Blueprint, request
+from flask import g, make_response, jsonify, Blueprint, request, json, Response, stream_with_context
 from flask_httpauth import HTTPTokenAuth
 
-from sqlalchemy.exc import StatementError, IntegrityError
+from sqlalchemy import text
+from sqlalchemy.exc import StatementError, IntegrityError, SQLAlchemyError
 
 from ..models.token import Token
 from ..models.layout import Layout
 from ..models.task import Task
 from ..models.permission import Permissions
+from ..models.log import Log, log_buffer, iter_logs, get_room_logs_for_event
 
 
 from .log import log_event
@@ -16,6 +18,7 @@ from ..crwiz import game_token, fake_actions
 from ..crwiz.utils import constants
 from ..crwiz.socket_connection import *
 from ..crwiz.task_manager import task_manager, emit_dialogue_choices
+from ..crwiz.analysis_queue import analysis_queue, JOB_DONE
 
 
 auth = HTTPTokenAuth(scheme='Token')
@@ -40,6 +43,16 @@ def verify_token(token):
     return False
 
 
+@api.route('/health', methods=['GET'])
+def get_health():
+    # only touches the database, so it can be used as a keepalive
+    try:
+        db.session.execute(text("SELECT 1"))
+    except SQLAlchemyError as e:
+        return make_response(jsonify({'status': 'error', 'error': str(e)}), 503)
+    return make_response(jsonify({'status': 'ok'}))
+
+
 @api.route('/layouts', methods=['GET'])
 @auth.login_required
 def get_layouts():
@@ -475,6 +488,7 @@ def get_room_logs(name):
     if not g.current_permissions.room_log_query:
         return make_response(jsonify({'error': 'insufficient rights'}), 403)
 
+    log_buffer.flush()
     room = Room.query.get(name)
     if room:
         return make_response(jsonify([log.as_dict() for log in room.logs]))
@@ -482,20 +496,54 @@ def get_room_logs(name):
         return make_response(jsonify({'error': 'room not found'}), 404)
 
 
+def filter_private_messages(logs, id):
+    for log in logs:
+        if log['event'] == "text_message" or log['event'] == "image_message":
+            # Filter only messages
+            if log['data']['receiver']:
+                # Private message
+                if int(log['data']['receiver']) != id and log['user']['id'] != id:
+                    # User not affected, continue the loop
+                    continue
+        yield log
+
+
+def stream_logs(logs):
+    """
+    Streams logs as JSON Lines (one JSON object per line).
+
+    :param logs: iterable with logs as LogView
+    :return: streamed Response
+    """
+    def generate():
+        for log in logs:
+            yield json.dumps(log.as_dict()) + "\n"
+
+    return Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+
+
+def get_log_stream_criteria():
+    """
+    Gets the criteria to filter a log stream from the request arguments:
+    `since_id` to only get logs after that id and any number of `event`.
+
+    :return: tuple with the since_id and the list of criteria
+    :raises ValueError: if since_id is not a number
+    """
+    since_id = request.args.get('since_id')
+    if since_id is not None:
+        since_id = int(since_id)
+    criteria = []
+    events = request.args.getlist('event')
+    if events:
+        criteria.append(Log.event.in_(events))
+    return since_id, criteria
+
+
 @api.route('/user/<int:id>/logs', methods=['GET'])
 @auth.login_required
 def get_user_logs(id):
-    def filter_private_messages(logs, id):
-        for log in logs:
-            if log['event'] == "text_message" or log['event'] == "image_message":
-                # Filter only messages
-                if log['data']['receiver']:
-                    # Private message
-                    if int(log['data']['receiver']) != id and log['user']['id'] != id:
-                        # User not affected, continue the loop
-                        continue
-            yield log
-
+    log_buffer.flush()
     user = User.query.get(id)
     if user:
         return make_response(jsonify({room.name: list(filter_private_messages([log.as_dict() for log in room.logs], user.id)) for room in user.rooms}))
@@ -503,6 +551,59 @@ def get_user_logs(id):
         return make_response(jsonify({'error': 'user not found'}), 404)
 
 
+@api.route('/room/<string:name>/logs/stream', methods=['GET'])
+@auth.login_required
+def stream_room_logs(name):
+    if not g.current_permissions.room_log_query:
+        return make_response(jsonify({'error': 'insufficient rights'}), 403)
+
+    try:
+        since_id, criteria = get_log_stream_criteria()
+    except ValueError:
+        return make_response(jsonify({'error': 'invalid number: `since_id`'}), 400)
+
+    room = Room.query.get(name)
+    if room:
+        return stream_logs(iter_logs(Log.room_id == room.name, *criteria, since_id=since_id))
+    else:
+        return make_response(jsonify({'error': 'room not found'}), 404)
+
+
+@api.route('/room/<string:name>/analysis', methods=['GET'])
+@auth.login_required
+def get_room_analysis(name):
+    if not g.current_permissions.room_log_query:
+        return make_response(jsonify({'error': 'insufficient rights'}), 403)
+
+    job = analysis_queue.get_job(name)
+    analysis = get_room_logs_for_event(name, constants.EVENT_POST_TASK_ANALYSIS, limit=1)
+    if not job:
+        if not analysis:
+            return make_response(jsonify({'error': 'analysis not found'}), 404)
+        # the finished jobs are not kept, see AnalysisQueue
+        job = {'room_name': name, 'status': JOB_DONE}
+
+    job['analysis'] = analysis[0]['data'] if analysis else None
+    return make_response(jsonify(job))
+
+
+@api.route('/user/<int:id>/logs/stream', methods=['GET'])
+@auth.login_required
+def stream_user_logs(id):
+    try:
+        since_id, criteria = get_log_stream_criteria()
+    except ValueError:
+        return make_response(jsonify({'error': 'invalid number: `since_id`'}), 400)
+
+    user = User.query.get(id)
+    if user:
+        room_names = [room.name for room in user.rooms]
+        logs = iter_logs(Log.room_id.in_(room_names), *criteria, since_id=since_id)
+        return stream_logs(filter_private_messages(logs, user.id))
+    else:
+        return make_response(jsonify({'error': 'user not found'}), 404)
+
+
 @api.route('/user/<int:id>/task', methods=['GET'])
 @auth.login_required
 def get_user_task(id):
@@ -540,8 +641,8 @@ def post_user_logs(user_id):
         this_room = None
 
     try:
-        return make_response(jsonify(
-            log_event(event, this_user, this_room, data.get('data')).as_dict()))
+        return make_response(jsonify(log_event(
+            event, this_user, this_room, data.get('data'), buffered=False).as_dict()))
     except (IntegrityError, StatementError) as e:
         return make_response(jsonify({'error': str(e)}), 400)
 
@@ -622,4 +723,6 @@ def request_task_hint(user_id):
 
 def close_rooms():
     task_manager.__del__()
+    log_buffer.flush()
+    analysis_queue.shutdown()
     getLogger("crwiz").debug("Task manager and task rooms closed")
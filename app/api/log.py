@@ -1,5 +1,6 @@
 
 import bson
+import datetime
 from logging import getLogger
 
 from ..crwiz.utils import constants
@@ -7,9 +8,31 @@ from ..crwiz.utils import constants
 
 EVENTS_TO_IGNORE = [constants.EVENT_STATUS_UPDATE]
 
+# frequent events that are written in batches (see LogBuffer)
+BUFFERED_EVENTS = [
+    constants.EVENT_FSM_GET_TRANSITIONS,
+    constants.EVENT_STATUS_UPDATE,
+    "join",
+    "leave",
+    "connect",
+    "disconnect",
+]
 
-def log_event(event, user, room=None, data=None):
+
+def log_event(event, user, room=None, data=None, buffered: bool = None):
+    """
+    Logs an event in the database.
+
+    :param event: name of the event
+    :param user: User responsible for the event
+    :param room: Room where the event happened, if any
+    :param data: dict with additional data
+    :param buffered: whether to buffer the log and write it later in a batch,
+        defaults to True for the events in BUFFERED_EVENTS
+    :return: the new Log, or None if it was buffered
+    """
     from .. import db, Log
+    from ..models.log import event_cache, log_buffer
 
     if not data:
         data = {}
@@ -43,7 +66,45 @@ def log_event(event, user, room=None, data=None):
     if event not in EVENTS_TO_IGNORE:
         getLogger("slurk").info(message)
 
-    log = Log(event=event, user=user, room=room, data=bson.dumps(data))
-    db.session.add(log)
-    db.session.commit()
+    if buffered is None:
+        buffered = event in BUFFERED_EVENTS
+
+    # the buffered logs are written later, so all the logs are stamped here with
+    # the clock of the app instead of the database default (now(6))
+    date_created = datetime.datetime.now()
+    if buffered:
+        log = None
+        log_buffer.add({
+            'event': event,
+            'user_id': user.id,
+            'room_id': room.name if room else None,
+            'data': bson.dumps(data),
+            'date_created': date_created,
+            'date_modified': date_created
+        })
+    else:
+        # write the buffered logs first, so the ids keep the order of the events
+        log_buffer.flush()
+        log = Log(
+            event=event, user=user, room=room, data=bson.dumps(data),
+            date_created=date_created, date_modified=date_created)
+        db.session.add(log)
+        # flush to get the id of the log, so it can be cached without reloading it
+        db.session.flush()
+
+    event_cache.add({
+        'event': event,
+        'user': {
+            'id': user.id,
+            'name': user.name,
+        },
+        'room': room.name if room else None,
+        'data': data,
+        'id': log.id if log else None,
+        'date_created': date_created.timestamp(),
+        'date_modified': date_created.timestamp()
+    })
+
+    if log:
+        db.session.commit()
     return log
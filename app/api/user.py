@@ -12,6 +12,7 @@ from ..models.user import User, UserRole
 from ..api.log import log_event
 
 from ..socket_logic import user_logic
+from ..crwiz.task_manager import task_manager
 
 
 @socketio.on('join_room')
@@ -37,6 +38,9 @@ def _join_room(data):
 
     if room not in user.rooms:
         user.rooms.append(room)
+        if room.name.startswith("wizard_task"):
+            # the user may have asked for its task room before getting one
+            task_manager.forget_unknown_user(user.id)
     if room not in user.current_rooms:
         user.current_rooms.append(room)
         socketio.emit('joined_room', {
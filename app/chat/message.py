@@ -1,3 +1,4 @@
+import contextlib
 from calendar import timegm
 from datetime import datetime
 
@@ -79,14 +80,18 @@ def message_text(payload):
         'timestamp': timegm(datetime.now().utctimetuple()),
         'private': private,
     }, room=receiver, broadcast=broadcast)
-    log_event("text_message", current_user, room, data={
-        'receiver': payload['receiver_id'] if private else None,
-        'message': payload['msg'],
-        'seconds_since_start':
-            task_manager.active_rooms[room.name].elapsed_seconds
-            if room.name != 'waiting_room' and current_user_id > 2 \
-               and room.name in task_manager.active_rooms else -1
-    })
+    # other workers could change the active room meanwhile, it is saved at the end
+    with task_manager.edit_room(room.name) if room.name != 'waiting_room' \
+            else contextlib.nullcontext() as active_room:
+        log_event("text_message", current_user, room, data={
+            'receiver': payload['receiver_id'] if private else None,
+            'message': payload['msg'],
+            'seconds_since_start':
+                active_room.elapsed_seconds
+                if active_room is not None and current_user_id > 2 else -1
+        })
+        if active_room is not None:
+            active_room.add_user_message(current_user_id)
     for room in current_user.rooms:
         emit('stop_typing', {'user': user}, room=room.name)
     return True
@@ -9,20 +9,23 @@ Author: Javier Chiyah, Heriot-Watt University, 2019
 """
 
 import enum
-import threading
-from typing import List, Tuple, Callable
+import collections
+from typing import List, Tuple, Callable, Set, Deque, Optional
 
 from .. import socketio
 
 from ..api import log
 
-from ..models.user import User, get_user_messages
-from ..models.room import Room
+from ..models.user import User
+from ..models.room import Room, count_room_user_messages
+from ..models.state_history import get_user_states
 
 from ..socket_logic import user_logic
 
 from . import logger_crwiz
 from .utils import helper, constants
+from .utils.scheduler import scheduler
+from .utils.room_timers import RoomTimers
 
 
 class Subtask(enum.Enum):
@@ -44,13 +47,19 @@ SUBTASK_END = Subtask.finish
 # when this time has passed closing the chat room
 TASK_TIME = 6 * 60   # 6 minutes
 
-# Min number of turns until users can finish the game (if Subtask.assess_damage)
+# Min number of turns until users can finish the game (if in SUBTASK_END)
 # 14 is the minimum amount of turns to reach that point, so 15 means that they
 # sent at least 1 additional message
 MINIMUM_USER_TURNS = 15
 
 SUBTASK_THRESHOLD = 0.5  # means each subtask accounts for 50% of progress
 
+# time until the tokens of the participants are invalidated after the task
+TOKEN_TIME = 5 * 60   # 5 minutes
+
+# how many of the latest dialogue states are kept in memory for each room
+STATE_HISTORY_LENGTH = 100
+
 
 class ActiveRoom:
 	"""
@@ -59,14 +68,16 @@ class ActiveRoom:
 	"""
 
 	def __init__(
-		self, room_name: str, wizard_id, timeout_callback: Callable):
+		self, room_name: str, wizard_id, timeout_callback: Callable,
+		worker_id: str = None):
 		self.name: str = room_name
 		self.wizard_id = wizard_id
-		self.room_timer_callback = timeout_callback
+		# the timers are only scheduled in one worker, see RoomTimers
+		self.timers = RoomTimers(
+			room_name, worker_id, scheduler, timeout_callback, helper.is_worker_stopped)
 
 		self.task_finished = False
 		self.start_time = None
-		self.end_time = None
 		self.set_end_time(TASK_TIME, start_timer=False)
 
 		self.subtask_stack: List[Tuple[Subtask, float]] = []
@@ -74,19 +85,36 @@ class ActiveRoom:
 		self._current_state: str = ""
 		self.previous_state_stack: List[str] = []
 		self.current_state_hint = None
+		# state that the last free text of the wizard most likely belongs to,
+		# with its score (see StateClassifier), until the current state changes
+		self.predicted_state: Optional[Tuple[str, float]] = None
 		self.progress = 0
-		self._room_timer = None
-		self._token_timer = None
 		self._operator_id = None
 
+		# dialogue history of the wizard, loaded once from the StateHistory
+		# and then kept up to date with add_state_history()
+		self.used_states: Set[str] = set()
+		self.recent_states: Deque[str] = collections.deque(
+			maxlen=STATE_HISTORY_LENGTH)
+		for state in reversed(get_user_states(wizard_id)):
+			self.used_states.add(state.current_state)
+			self.recent_states.append(state.current_state)
+
+		# messages sent in the room, kept up to date with add_user_message()
 		room = Room.query.get(room_name)
+		message_counts = count_room_user_messages(room_name)
 		self._users = {}
 		for user in list(room.users):
 			self._users[user.id] = {
-				'utterances': 0,
+				'utterances': message_counts.get(user.id, 0),
 				'name': user.name
 			}
 
+		# what the last status_update depended on, see emit_status_update()
+		self._status_signature = None
+		# last dialogue choices computed and the key they were computed for
+		self._dialogue_choices: Optional[Tuple[tuple, dict]] = None
+
 	@property
 	def operator_id(self) -> int:
 		if self._operator_id is not None:
@@ -119,6 +147,7 @@ class ActiveRoom:
 		if self.previous_state != self.current_state:
 			self.check_current_state_for_milestones()
 			self.current_state_hint = None
+			self.predicted_state = None
 
 	@property
 	def previous_state(self) -> str:
@@ -146,6 +175,59 @@ class ActiveRoom:
 		"""
 		return len(self.previous_state_stack) + 1
 
+	def add_state_history(self, state_name: str):
+		"""
+		Adds a dialogue state to the in-memory history of the room.
+		It should be called every time a StateHistory is added for the wizard.
+
+		:param state_name: name of the new state
+		:return: None
+		"""
+		self.used_states.add(state_name)
+		self.recent_states.append(state_name)
+
+	@property
+	def dialogue_choices_key(self) -> tuple:
+		"""
+		Returns what the dialogue choices depend on. It changes every time
+		the dialogue state changes, even if it goes back to the same state.
+
+		:return: tuple with the current state, state count and subtask
+		"""
+		return self.current_state, self.state_count, self.current_subtask.name
+
+	def get_dialogue_choices(self, version: int = 0) -> Optional[dict]:
+		"""
+		Gets the dialogue choices computed for the current dialogue state.
+
+		:param version: version of the dialogue states they were computed with
+		:return: dict with the dialogue choices or None if they were not computed
+		"""
+		if self._dialogue_choices is not None \
+				and self._dialogue_choices[0] == self.dialogue_choices_key + (version,):
+			return self._dialogue_choices[1]
+		return None
+
+	def set_dialogue_choices(self, dialogue_choices: dict, version: int = 0):
+		"""
+		Keeps the dialogue choices computed for the current dialogue state,
+		so they are not computed (and logged) again until the state changes.
+
+		:param dialogue_choices: dict with the dialogue choices
+		:param version: version of the dialogue states they were computed with
+		:return: None
+		"""
+		self._dialogue_choices = (self.dialogue_choices_key + (version,), dialogue_choices)
+
+	def check_used_state(self, state_name: str) -> bool:
+		"""
+		Checks whether a dialogue state has been used before in this room.
+
+		:param state_name: name of the state
+		:return: bool, True if state has been used
+		"""
+		return state_name in self.used_states
+
 	@property
 	def remaining_seconds(self) -> int:
 		if self.room_timer:
@@ -181,14 +263,29 @@ class ActiveRoom:
 
 	@property
 	def room_timer(self):
-		return self._room_timer
+		"""
+		Key of the room timeout in the scheduler, None if it was not set.
+		"""
+		return self.timers.room_timer
 
 	@room_timer.setter
-	def room_timer(self, new_thread):
-		if self._room_timer is not None:
-			self._room_timer.cancel()
-			logger_crwiz.debug(f"Timeout for room '{self.name}' cancelled")
-		self._room_timer = new_thread
+	def room_timer(self, key):
+		self.timers.room_timer = key
+
+	@property
+	def end_time(self):
+		return self.timers.end_time
+
+	@property
+	def token_end_time(self):
+		return self.timers.token_end_time
+
+	@property
+	def timer_worker(self):
+		"""
+		Worker that runs the timers of the room.
+		"""
+		return self.timers.timer_worker
 
 	@property
 	def users(self):
@@ -221,14 +318,19 @@ class ActiveRoom:
 
 	@property
 	def can_finish_task(self):
-		self._update_user_utterances()
-		return sum([user['utterances'] for user in self._users.values()]) >= \
-			MINIMUM_USER_TURNS and self.current_subtask == Subtask.assess_damage
+		return sum([
+			self._users[user_id]['utterances'] for user_id in self.participants]) \
+			>= MINIMUM_USER_TURNS and self.current_subtask == SUBTASK_END
 
-	def _update_user_utterances(self):
-		for user_id in self._users.keys():
-			self._users[user_id]['utterances'] = max(
-				self._users[user_id]['utterances'], len(get_user_messages(user_id)))
+	def add_user_message(self, user_id):
+		"""
+		Counts a message sent by a user in this room.
+
+		:param user_id: id of the user that sent the message
+		:return: None
+		"""
+		if user_id in self._users:
+			self._users[user_id]['utterances'] += 1
 
 	def check_state_for_milestones(self, state_name):
 		"""
@@ -266,14 +368,10 @@ class ActiveRoom:
 		self.check_state_for_milestones(self.current_state)
 
 	def set_end_time(self, seconds, start_timer=True):
-		if seconds > 0:
-			self.end_time = helper.get_unix_timestamp() + seconds
-			if start_timer:
-				self.room_timer = threading.Timer(
-					seconds+1, self.room_timer_callback, [self.name])
-				self.room_timer.start()
-				logger_crwiz.debug(
-					f"New timeout set for room '{self.name}' in {seconds} seconds")
+		self.timers.set_end_time(seconds, start_timer)
+		if seconds > 0 and start_timer:
+			logger_crwiz.debug(
+				f"New timeout set for room '{self.name}' in {seconds} seconds")
 
 	def start_task(self):
 		self.start_time = helper.get_unix_timestamp()
@@ -284,10 +382,8 @@ class ActiveRoom:
 		self.advance_subtask(SUBTASK_START)
 		self.set_end_time(TASK_TIME)
 
-	def start_token_timer(self, timeout_callback: Callable):
-		# timeout in 5 minutes
-		self._token_timer = threading.Timer(5 * 60, timeout_callback, [self.name])
-		self._token_timer.start()
+	def start_token_timer(self, timeout_callback: Callable, seconds=TOKEN_TIME):
+		self.timers.start_token_timer(timeout_callback, seconds)
 
 	def invalidate_user_tokens(self):
 		"""
@@ -305,18 +401,100 @@ class ActiveRoom:
 
 		:return: None
 		"""
-		if self.room_timer is not None:
-			self.room_timer = None
-		if self._token_timer is not None:
-			self._token_timer.cancel()
-			self._token_timer = None
+		self.timers.cancel()
+
+	def to_dict(self) -> dict:
+		"""
+		Returns the state of the room as a dict that can be serialised to JSON,
+		so it can be kept in a RoomStateBackend and restored with restore().
+
+		:return: dict
+		"""
+		return {
+			'name': self.name,
+			'wizard_id': self.wizard_id,
+			'task_finished': self.task_finished,
+			'start_time': self.start_time,
+			**self.timers.to_dict(),
+			'subtask_stack': [
+				[subtask.name, timestamp] for subtask, timestamp in self.subtask_stack],
+			'last_analysed_msg': self.last_analysed_msg,
+			'current_state': self._current_state,
+			'previous_state_stack': self.previous_state_stack,
+			'current_state_hint': self.current_state_hint,
+			'predicted_state': list(self.predicted_state)
+			if self.predicted_state is not None else None,
+			'progress': self.progress,
+			'operator_id': self._operator_id,
+			'used_states': list(self.used_states),
+			'recent_states': list(self.recent_states),
+			'users': self._users,
+			'dialogue_choices': list(self._dialogue_choices)
+			if self._dialogue_choices is not None else None,
+		}
+
+	def restore(self, state: dict, token_timeout_callback: Callable = None):
+		"""
+		Restores the state of the room from to_dict(), e.g. after another
+		worker changed it. The timers are scheduled again if they changed,
+		but only if this worker runs them (see timer_worker).
+
+		:param state: dict from to_dict()
+		:param token_timeout_callback: callback for the token timer,
+			if it has to be started in this worker
+		:return: None
+		"""
+		self.task_finished = state['task_finished']
+		self.start_time = state['start_time']
+		self.subtask_stack = [
+			(Subtask[subtask], timestamp) for subtask, timestamp in state['subtask_stack']]
+		self.last_analysed_msg = state['last_analysed_msg']
+		self._current_state = state['current_state']
+		self.previous_state_stack = list(state['previous_state_stack'])
+		self.current_state_hint = state['current_state_hint']
+		self.predicted_state = tuple(state['predicted_state']) \
+			if state.get('predicted_state') is not None else None
+		self.progress = state['progress']
+		self._operator_id = state['operator_id']
+		self.used_states = set(state['used_states'])
+		self.recent_states = collections.deque(
+			state['recent_states'], maxlen=STATE_HISTORY_LENGTH)
+		# JSON keys are always strings
+		self._users = {int(user_id): user for user_id, user in state['users'].items()}
+		# JSON turns the key into a list
+		self._dialogue_choices = (
+			tuple(state['dialogue_choices'][0]), state['dialogue_choices'][1]) \
+			if state.get('dialogue_choices') is not None else None
+
+		self.timers.restore(state, self.task_finished, token_timeout_callback)
+
+	def mark_status_dirty(self):
+		"""
+		Makes the next emit_status_update() send the status even if it did not
+		change (e.g. when a user reconnects and has not received it).
+
+		:return: None
+		"""
+		self._status_signature = None
 
 	def emit_status_update(self, source: str = None, *args, **kwargs):
 		"""
 		Sends a status_update message to the users in this active room.
+		It is skipped if nothing in the status changed since the last one,
+		unless there is a source to log.
 
 		:return: None
 		"""
+		# the remaining seconds only change with the end time,
+		# the front-end counts down from them
+		signature = (
+			self.start_time, self.end_time if self.room_timer else None,
+			self.can_finish_task, self.progress, self.task_finished,
+			tuple(self._users.keys()))
+		if source is None and signature == self._status_signature:
+			return
+		self._status_signature = signature
+
 		emit_data = {
 			'start_time': self.start_time,
 			'remaining_seconds': self.remaining_seconds,
@@ -0,0 +1,257 @@
+"""
+analysis_queue
+--------------
+
+Runs the post-task analysis of the rooms in the background, so closing a room
+does not wait for it. Jobs are saved on disk (one JSON file per room), so the
+unfinished ones are resumed after a restart, and they are retried if they fail.
+
+Only the unfinished jobs are kept in memory. Once a room is analysed, the
+analysis is in its logs (see GET /room/<name>/analysis), and the jobs that
+failed for the last time are read from their file.
+
+The file of a job is named after the worker that claimed it (room.json.worker),
+so the workers sharing the folder never run the same job. Unclaimed jobs
+(room.json) and those of workers of this machine that are not running anymore
+are claimed by renaming their file, which only one worker can do. The file
+is deleted once the job is done, failed jobs are kept as room.json.failed.
+"""
+
+import os
+import json
+import time
+import threading
+from typing import Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+
+from .. import app, db
+
+from ..models.log import get_room_logs_for_event
+
+from . import logger_crwiz
+from .utils import constants, helper, post_task_analysis
+from .utils.scheduler import scheduler
+
+
+ANALYSIS_QUEUE_DIR = os.path.join(
+	os.path.split(os.path.abspath(__file__))[0], "..", "..", "logs", "analysis")
+ANALYSIS_WORKERS = 2
+# number of times an analysis is attempted before giving up
+ANALYSIS_MAX_ATTEMPTS = 3
+ANALYSIS_RETRY_SECONDS = 30
+
+JOB_PENDING = "pending"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+JOB_EXTENSION = ".json"
+
+
+class AnalysisQueue:
+	"""
+	Queue of post-task analysis jobs, one per room. Adding a room that already
+	has an unfinished job does nothing, and the rooms already analysed are
+	skipped when their job runs, so a room is only analysed once.
+	"""
+
+	def __init__(self, queue_dir: str = ANALYSIS_QUEUE_DIR, workers: int = ANALYSIS_WORKERS):
+		self._queue_dir = queue_dir
+		self._workers = workers
+		self._executor: Optional[ThreadPoolExecutor] = None
+		# unfinished jobs by room name
+		self._jobs: Dict[str, dict] = {}
+		self._lock = threading.Lock()
+		self._worker_id = helper.get_worker_id()
+
+	def resume(self):
+		"""
+		Claims the jobs left on disk that did not finish and runs them again.
+
+		:return: None
+		"""
+		os.makedirs(self._queue_dir, exist_ok=True)
+		for filename in sorted(os.listdir(self._queue_dir)):
+			room_name, worker_id = _split_job_filename(filename)
+			if room_name is None or worker_id == JOB_FAILED \
+					or worker_id == self._worker_id or not _is_orphan(worker_id):
+				continue
+
+			try:
+				# only one worker can rename the file, the others skip it
+				os.replace(
+					os.path.join(self._queue_dir, filename), self._get_job_path(room_name))
+				with open(self._get_job_path(room_name)) as json_file:
+					job = json.load(json_file)
+			except FileNotFoundError:
+				continue
+			except (OSError, json.decoder.JSONDecodeError):
+				logger_crwiz.warning(f"Could not load analysis job '{filename}'")
+				continue
+
+			# jobs saved before the files were deleted when done
+			if job['status'] == JOB_DONE:
+				self._delete_job(job)
+			elif job['status'] == JOB_FAILED:
+				self._save_failed_job(job)
+			else:
+				self._jobs[job['room_name']] = job
+				self._update_job(job, status=JOB_PENDING)
+				self._submit(job['room_name'])
+
+	def add(self, room_name: str) -> dict:
+		"""
+		Adds the analysis of a room to the queue, unless it is already there.
+
+		:param room_name: name of the room
+		:return: dict with the job
+		"""
+		with self._lock:
+			job = self._jobs.get(room_name)
+			is_new = job is None
+			if is_new:
+				job = {
+					'room_name': room_name,
+					'status': JOB_PENDING,
+					'attempts': 0,
+					'error': None,
+					'date_created': time.time(),
+					'date_modified': time.time()
+				}
+				self._jobs[room_name] = job
+				self._save_job(job)
+				self._delete_job(job, JOB_FAILED)
+
+		if is_new:
+			self._submit(room_name)
+		return dict(job)
+
+	def get_job(self, room_name: str) -> Optional[dict]:
+		"""
+		Gets the unfinished or failed job of a room.
+
+		:param room_name: name of the room
+		:return: dict with the job or None if it is not queued (e.g. done)
+		"""
+		job = self._jobs.get(room_name)
+		if job is not None:
+			return dict(job)
+		try:
+			with open(self._get_job_path(room_name, JOB_FAILED)) as json_file:
+				return json.load(json_file)
+		except (OSError, json.decoder.JSONDecodeError):
+			return None
+
+	def shutdown(self):
+		"""
+		Waits for the running jobs. The pending ones stay on disk.
+
+		:return: None
+		"""
+		if self._executor is not None:
+			self._executor.shutdown(wait=True)
+			self._executor = None
+
+	def _submit(self, room_name: str):
+		if self._executor is None:
+			self._executor = ThreadPoolExecutor(
+				max_workers=self._workers, thread_name_prefix="analysis")
+		self._executor.submit(self._run, room_name)
+
+	def _run(self, room_name: str):
+		job = self._jobs[room_name]
+		self._update_job(job, status=JOB_RUNNING, attempts=job['attempts'] + 1)
+
+		with app.app_context():
+			try:
+				# a previous attempt may have finished before the job was updated
+				if not get_room_logs_for_event(
+						room_name, constants.EVENT_POST_TASK_ANALYSIS, limit=1):
+					post_task_analysis.perform_post_task_analysis(room_name)
+			except Exception as ex:
+				db.session.rollback()
+				self._retry(job, ex)
+			else:
+				with self._lock:
+					job.update(status=JOB_DONE, error=None, date_modified=time.time())
+					self._delete_job(job)
+					del self._jobs[room_name]
+				logger_crwiz.debug(f"Post-task analysis of room '{room_name}' done")
+			finally:
+				db.session.remove()
+
+	def _retry(self, job: dict, ex: Exception):
+		if job['attempts'] < ANALYSIS_MAX_ATTEMPTS:
+			logger_crwiz.warning(
+				f"Post-task analysis of room '{job['room_name']}' failed "
+				f"({job['attempts']}/{ANALYSIS_MAX_ATTEMPTS}), retrying in "
+				f"{ANALYSIS_RETRY_SECONDS} seconds: {ex}")
+			self._update_job(job, status=JOB_PENDING, error=str(ex))
+			scheduler.schedule(
+				('analysis_retry', job['room_name']), ANALYSIS_RETRY_SECONDS,
+				self._submit, [job['room_name']])
+		else:
+			logger_crwiz.error(
+				f"Post-task analysis of room '{job['room_name']}' failed: {ex}",
+				exc_info=ex)
+			with self._lock:
+				job.update(status=JOB_FAILED, error=str(ex), date_modified=time.time())
+				self._save_failed_job(job)
+				del self._jobs[job['room_name']]
+
+	def _update_job(self, job: dict, **changes):
+		with self._lock:
+			job.update(changes, date_modified=time.time())
+			self._save_job(job)
+
+	def _get_job_path(self, room_name: str, worker_id: str = None) -> str:
+		return os.path.join(
+			self._queue_dir, f"{room_name}{JOB_EXTENSION}.{worker_id or self._worker_id}")
+
+	def _save_job(self, job: dict, path: str = None):
+		# write to a temporary file first so a job is never half written
+		os.makedirs(self._queue_dir, exist_ok=True)
+		path = path or self._get_job_path(job['room_name'])
+		with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+			json.dump(job, f)
+		os.replace(f"{path}.tmp", path)
+
+	def _save_failed_job(self, job: dict):
+		self._save_job(job, self._get_job_path(job['room_name'], JOB_FAILED))
+		self._delete_job(job)
+
+	def _delete_job(self, job: dict, worker_id: str = None):
+		try:
+			os.remove(self._get_job_path(job['room_name'], worker_id))
+		except FileNotFoundError:
+			pass
+
+
+def _split_job_filename(filename: str):
+	"""
+	Splits the name of a job file into the room name and the worker that
+	claimed it (None if unclaimed).
+
+	:param filename: name of the file
+	:return: tuple with the room name (None if it is not a job) and the worker
+	"""
+	if filename.endswith(JOB_EXTENSION):
+		return filename[:-len(JOB_EXTENSION)], None
+	room_name, separator, worker_id = filename.rpartition(JOB_EXTENSION + ".")
+	if not separator or not room_name or worker_id.endswith(".tmp"):
+		return None, None
+	return room_name, worker_id
+
+
+def _is_orphan(worker_id: Optional[str]) -> bool:
+	"""
+	Checks whether the jobs claimed by a worker can be claimed by another one,
+	because they are unclaimed or the worker was in this machine and has stopped.
+
+	:param worker_id: id of the worker (hostname-pid), None if unclaimed
+	:return: bool
+	"""
+	return worker_id is None or helper.is_worker_stopped(worker_id)
+
+
+analysis_queue = AnalysisQueue()
@@ -1,10 +1,12 @@
 
 import os
+import time
 import yaml
-import shutil
-from typing import List, Dict
+import hashlib
+from typing import List, Dict, Optional, Tuple
 
 from . import logger_crwiz
+from .utils import helper, knowledge_base_snapshot
 
 
 STATES_TO_IGNORE = []
@@ -38,6 +40,10 @@ class DialogueState:
 		if not self.formulations:
 			logger_crwiz.warning(f'No formulations found in state \'{self.name}\'')
 
+		# compiled with the state, so utterances can be matched to the formulations quickly
+		self._formulation_matcher = helper.FormulationMatcher(
+			(self.name, formulation) for formulation in self.formulations)
+
 	@property
 	def name(self) -> str:
 		return self._name
@@ -68,6 +74,32 @@ class DialogueState:
 	def is_fixed(self) -> bool:
 		return False
 
+	def match_formulation(self, utterance: str) -> Optional[str]:
+		"""
+		Gets the formulation of this state that an utterance was made from.
+
+		:param utterance: text of the utterance
+		:return: str with the formulation or None if none matches
+		"""
+		match = self._formulation_matcher.match(utterance)
+		return match[1] if match is not None else None
+
+	@classmethod
+	def from_dict(cls, state_properties: dict):
+		"""
+		Creates a new DialogueState from a dict with state properties.
+
+		:param state_properties: dict loaded from a YAML file
+		:return: DialogueState
+		"""
+		return cls(
+			state_properties['name'], state_properties.get('formulations') or [],
+			state_properties.get('transition_states') or [],
+			dict(state_properties.get('transition_probabilities') or {}),
+			state_properties.get('subtask'),
+			state_properties.get('slots') or []
+		)
+
 	@classmethod
 	def from_yaml_file(cls, yaml_file: str):
 		"""
@@ -76,18 +108,8 @@ class DialogueState:
 		:param yaml_file: file path to open
 		:return: DialogueState
 		"""
-		state_properties = yaml.safe_load(open(yaml_file).read())
-
-		return cls(
-			state_properties['name'], state_properties['formulations']
-			if 'formulations' in state_properties else [],
-			state_properties['transition_states']
-			if 'transition_states' in state_properties else [],
-			state_properties['transition_probabilities']
-			if 'transition_probabilities' in state_properties else [],
-			state_properties['subtask'] if 'subtask' in state_properties else None,
-			state_properties['slots'] if 'slots' in state_properties else []
-		)
+		with open(yaml_file) as f:
+			return cls.from_dict(yaml.safe_load(f))
 
 	def get_transition_probability(self, state_name: str) -> float:
 		"""
@@ -113,84 +135,254 @@ class FixedDialogueState(DialogueState):
 		return True
 
 	@classmethod
-	def from_yaml_file(cls, yaml_file: str):
+	def from_dict(cls, file_properties: dict):
 		"""
-		Creates a list of FixedDialogueStates from a file.
+		Creates a dict of FixedDialogueStates from a dict with {name: formulation}.
 
-		:param yaml_file: file path to open
+		:param file_properties: dict loaded from a YAML file
 		:return: Dict[str, FixedDialogueState]
 		"""
-		file_properties = yaml.safe_load(open(yaml_file).read())
 		states = {}
 		for name, formulation in file_properties.items():
 			states[name] = cls(name, formulation)
 
 		return states
 
+	@classmethod
+	def from_yaml_file(cls, yaml_file: str):
+		"""
+		Creates a list of FixedDialogueStates from a file.
 
-def load_dialogue_states(folder_path: str) -> Dict[str, DialogueState]:
+		:param yaml_file: file path to open
+		:return: Dict[str, FixedDialogueState]
+		"""
+		with open(yaml_file) as f:
+			return cls.from_dict(yaml.safe_load(f))
+
+
+def load_dialogue_state_file(file_path: str) -> Dict[str, DialogueState]:
 	"""
-	Loads the YAML files in the folder to a dict of DialogueStates.
+	Parses a YAML file into the DialogueStates that it defines.
 
-	:param folder_path: folder with YAML files
+	:param file_path: full path to file
 	:return: dict of DialogueStates
 	"""
-	# copy files in the folder to a secure location
-	load_path = os.getcwd() + os.sep + 'loaded_states'
-	_prepare_load_folder(load_path, folder_path)
+	with open(file_path, 'rb') as f:
+		return parse_dialogue_state_file(os.path.basename(file_path), f.read())
 
-	# load states
-	loaded_states = {}
-	for file in os.listdir(load_path):
-		if file.endswith('.yaml'):
-			file_path = load_path + os.sep + file
-			if file.startswith('fixed_states'):
-				loaded_states = {
-					**loaded_states,
-					**FixedDialogueState.from_yaml_file(file_path)}
-			else:
-				# transform file if needed
-				_preprocess_yaml_file(file_path)
-
-				tmp_state = DialogueState.from_yaml_file(file_path)
-				if tmp_state.name in loaded_states:
-					logger_crwiz.warning(f'Overwriting state \'{tmp_state.name}\'')
-				loaded_states[tmp_state.name] = tmp_state
 
-	return loaded_states
+def create_dialogue_state(properties: dict) -> DialogueState:
+	"""
+	Creates a DialogueState (or FixedDialogueState) from its properties.
+
+	:param properties: dict from knowledge_base_snapshot.parse_state_file()
+	:return: DialogueState
+	"""
+	if properties.get('is_fixed'):
+		return FixedDialogueState(properties['name'], properties['formulations'][0])
+	return DialogueState.from_dict(properties)
 
 
-def _prepare_load_folder(load_path: str, folder_path: str):
+def parse_dialogue_state_file(file_name: str, content: bytes) -> Dict[str, DialogueState]:
 	"""
-	Prepares the load folder with a copy of the YAML files to load the states.
+	Parses the content of a YAML file into the DialogueStates that it defines.
+	Files named fixed_states* have several FixedDialogueStates,
+	the rest have a single DialogueState.
 
-	:param load_path: folder path to copy dialogue files to.
-		WARNING: all its contents will be deleted on load
-	:param folder_path: folder with the original dialogue state files
-	:return: None
+	:param file_name: name of the file
+	:param content: content of the file
+	:return: dict of DialogueStates
 	"""
-	try:
-		# remove folder
-		shutil.rmtree(load_path)
-	except FileNotFoundError:
-		pass
-	os.makedirs(load_path, exist_ok=True)
+	states = [
+		create_dialogue_state(properties) for properties in
+		knowledge_base_snapshot.parse_state_file(file_name, content)]
+	return {state.name: state for state in states}
 
-	for file in os.listdir(folder_path):
-		if file.endswith('.yaml'):
-			shutil.copy(f'{folder_path}{os.sep}{file}', f'{load_path}{os.sep}{file}')
 
+def merge_dialogue_states(
+	file_states: Dict[str, Dict[str, DialogueState]]) -> Dict[str, DialogueState]:
+	"""
+	Merges the states of several files into one dict, in the order of the
+	file names, so the result does not depend on the order they were loaded in.
 
-def _preprocess_yaml_file(file_path: str):
+	:param file_states: dict with {file_name: states of the file}
+	:return: dict of DialogueStates
 	"""
-	Preprocess a file and changes it so it can be loaded as a dialogue state.
+	loaded_states = {}
+	for file_name in sorted(file_states.keys()):
+		for state in file_states[file_name].values():
+			if state.name in loaded_states and not state.is_fixed:
+				logger_crwiz.warning(f'Overwriting state \'{state.name}\'')
+			loaded_states[state.name] = state
 
-	:param file_path: full path to file
-	:return: None
+	return loaded_states
+
+
+def load_dialogue_states(folder_path: str) -> Dict[str, DialogueState]:
 	"""
-	properties = yaml.safe_load(open(file_path).read())
+	Loads the YAML files in the folder to a dict of DialogueStates.
+	Each file is parsed once, straight from the folder.
+
+	:param folder_path: folder with YAML files
+	:return: dict of DialogueStates
+	"""
+	return DialogueStateLoader(folder_path).load()
 
-	if 'transition_probabilities' not in properties:
-		properties['transition_probabilities'] = {}
 
-	yaml.dump(properties, open(file_path, mode='w'), sort_keys=False)
+class DialogueStateLoader:
+	"""
+	Loads the dialogue states of a folder and keeps track of its files, so
+	only the files that changed (by modification time and content hash)
+	are parsed again when reloading.
+	"""
+
+	def __init__(self, folder_path: str):
+		"""
+		:param folder_path: folder with the dialogue state files
+		"""
+		self._folder_path = folder_path
+		# file name -> (mtime_ns, size, sha1, states of the file)
+		self._files: Dict[str, Tuple[int, int, str, Dict[str, DialogueState]]] = {}
+		# file name -> (mtime_ns, size) of the files that could not be parsed
+		self._invalid_files: Dict[str, Tuple[int, int]] = {}
+
+	@property
+	def folder_path(self) -> str:
+		return self._folder_path
+
+	def load(self) -> Dict[str, DialogueState]:
+		"""
+		Loads all the dialogue states of the folder. Unlike reload(), it
+		raises if a file cannot be read or parsed.
+
+		:return: dict of DialogueStates
+		"""
+		self._files = {}
+		self._invalid_files = {}
+
+		snapshot_path = knowledge_base_snapshot.get_snapshot_path(self._folder_path)
+		if os.path.exists(snapshot_path):
+			try:
+				if self._load_snapshot(snapshot_path):
+					return merge_dialogue_states(
+						{file_name: entry[3] for file_name, entry in self._files.items()})
+				logger_crwiz.info(
+					f'Snapshot \'{snapshot_path}\' is out of date, loading the YAML files')
+			except (OSError, knowledge_base_snapshot.SnapshotError) as ex:
+				logger_crwiz.warning(f'Cannot load snapshot \'{snapshot_path}\': {ex}')
+			self._files = {}
+
+		return self.reload(strict=True) or {}
+
+	def _load_snapshot(self, snapshot_path: str) -> bool:
+		"""
+		Loads the states from a snapshot, if the files did not change since it was built.
+
+		:param snapshot_path: path of the snapshot
+		:return: True if the states were loaded
+		"""
+		snapshot = knowledge_base_snapshot.read_snapshot(snapshot_path)
+		try:
+			if not snapshot.is_fresh(self._folder_path):
+				return False
+
+			file_states: Dict[str, Dict[str, DialogueState]] = {}
+			for file_name, properties in snapshot.get_states():
+				state = create_dialogue_state(properties)
+				file_states.setdefault(file_name, {})[state.name] = state
+
+			for file_name, mtime_ns, size, content_hash in snapshot.get_files():
+				self._files[file_name] = (
+					mtime_ns, size, content_hash, file_states.get(file_name, {}))
+		finally:
+			snapshot.close()
+
+		logger_crwiz.debug(f'Dialogue states loaded from snapshot \'{snapshot_path}\'')
+		return True
+
+	def reload(self, strict: bool = False) -> Optional[Dict[str, DialogueState]]:
+		"""
+		Parses again the files that were added or changed since the last load.
+		If a file cannot be parsed, its previous states are kept.
+
+		:param strict: raise if a file cannot be read or parsed instead
+		:return: dict of DialogueStates or None if no file changed
+		"""
+		changed = False
+		file_names = knowledge_base_snapshot.list_state_files(self._folder_path)
+
+		for file_name in set(self._files.keys()).difference(file_names):
+			logger_crwiz.info(f'Dialogue state file \'{file_name}\' removed')
+			del self._files[file_name]
+			changed = True
+
+		# read the files that changed, then parse them all at once
+		changed_files = []
+		for file_name in file_names:
+			file_path = os.path.join(self._folder_path, file_name)
+			try:
+				stat = os.stat(file_path)
+			except OSError:
+				# removed while listing, it is handled in the next reload
+				continue
+
+			file_version = (stat.st_mtime_ns, stat.st_size)
+			entry = self._files.get(file_name)
+			if entry is not None and entry[:2] == file_version \
+					or self._invalid_files.get(file_name) == file_version:
+				continue
+
+			try:
+				with open(file_path, 'rb') as f:
+					content = f.read()
+			except OSError as ex:
+				logger_crwiz.error(f'Cannot load dialogue state file \'{file_name}\': {ex}')
+				if strict:
+					raise
+				continue
+
+			content_hash = hashlib.sha1(content).hexdigest()
+			if entry is not None and entry[2] == content_hash:
+				# touched but not changed
+				self._files[file_name] = (*file_version, content_hash, entry[3])
+				continue
+
+			changed_files.append((file_name, file_version, content_hash, content))
+
+		start_time = time.perf_counter()
+		# parsed in this process, the app cannot spawn the processes of the
+		# offline tools (they would import it), the snapshot is faster anyway
+		file_properties = knowledge_base_snapshot.parse_state_files(
+			[(file_name, content) for file_name, _, _, content in changed_files])
+		if len(changed_files) > 1:
+			logger_crwiz.debug(
+				f'Parsed {len(changed_files)} dialogue state files '
+				f'in {time.perf_counter() - start_time:.3f}s')
+
+		for (file_name, file_version, content_hash, _), properties in \
+				zip(changed_files, file_properties):
+			try:
+				if isinstance(properties, knowledge_base_snapshot.StateFileError):
+					raise properties
+				states = {}
+				for state in map(create_dialogue_state, properties):
+					states[state.name] = state
+			except (knowledge_base_snapshot.StateFileError, KeyError, IndexError, TypeError) as ex:
+				logger_crwiz.error(f'Cannot load dialogue state file \'{file_name}\': {ex}')
+				if strict:
+					raise
+				# not loaded again until it changes
+				self._invalid_files[file_name] = file_version
+				continue
+
+			self._invalid_files.pop(file_name, None)
+			if file_name in self._files:
+				logger_crwiz.info(f'Dialogue state file \'{file_name}\' changed')
+			self._files[file_name] = (*file_version, content_hash, states)
+			changed = True
+
+		if not changed:
+			return None
+
+		return merge_dialogue_states(
+			{file_name: entry[3] for file_name, entry in self._files.items()})
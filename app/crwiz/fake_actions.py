@@ -5,7 +5,7 @@ import collections
 from .. import socketio
 
 from ..api import log
-from ..models.log import get_user_logs_for_event
+from ..models.log import get_last_user_log_for_event
 from ..models.user import User
 from ..models.room import get_room_user_messages
 
@@ -95,19 +95,14 @@ def _check_action_trigger(
 		return True
 	elif trigger == ActionTrigger.on_operator_message:
 		# first check if it has already triggered
-		action_logs = get_user_logs_for_event(
+		action_log = get_last_user_log_for_event(
 			active_room.wizard_id, _EVENT_ACTION_TRIGGERED)
 
-		# avoid showing pa announcement twice - hack to fix this bug
-		for action_log in action_logs:
-			if action_log['data']['action_name'] == 'pa_announcement':
-				return False
-
-		if len(action_logs) > 0 \
-			and action_logs[0]['data']['action_name'] == action_name \
-			and (action_logs[0]['data']['state_count'] == active_room.state_count
+		if action_log is not None \
+			and action_log['data']['action_name'] == action_name \
+			and (action_log['data']['state_count'] == active_room.state_count
 					or active_room.current_state == active_room.previous_state) \
-			and action_logs[0]['data']['state_name'] == active_room.current_state:
+			and action_log['data']['state_name'] == active_room.current_state:
 			# action already triggered
 			return False
 
@@ -10,35 +10,79 @@ Author: Javier Chiyah, Heriot-Watt University, 2019
 """
 
 import os
+import time
 import random
-from typing import Dict, Tuple
+from typing import Callable, Dict, List, Optional, Set, Tuple
 
 import numpy.random
 
 from .. import db
 
-from ..models.log import get_user_logs_for_event
-from ..models.state_history import StateHistory, get_user_states, \
-	check_used_state
+from ..models.log import get_last_user_log_for_event
+from ..models.state_history import StateHistory
 
 from . import logger_crwiz, dialogue_state, fake_actions
-from .utils import helper, constants, dialogue_utils
-from .active_room import ActiveRoom, Subtask
+from .utils import helper, constants, dialogue_utils, transition_graph
+from .utils.state_classifier import StateClassifier, DEFAULT_TOP_K
+from .utils.scheduler import scheduler
+from .active_room import ActiveRoom
 
 
 MIN_TRANSITION_UTTERANCES = 1
 INITIAL_STATE = 'start'
 
 
+class KnowledgeBase:
+	"""
+	Dialogue states and everything compiled from them. It is replaced as
+	a whole when the states are reloaded, so they are always consistent.
+	"""
+
+	def __init__(self, states: Dict[str, dialogue_state.DialogueState], version: int = 1):
+		self.version = version
+		self.states = states
+
+		self.fixed_states = [
+			state.name for state in self.states.values() if state.is_fixed]
+
+		# compile the transitions once, so each request is just a lookup
+		self.graph = transition_graph.TransitionGraph(self.states)
+
+		# matches free text to the formulations of all the states in one pass
+		self.formulation_matcher = helper.FormulationMatcher(
+			(state.name, formulation) for state in self.states.values()
+			for formulation in state.formulations)
+		# finds the closest states to free text that does not match any formulation
+		self.state_classifier = StateClassifier(
+			(state.name, formulation) for state in self.states.values()
+			for formulation in state.formulations)
+
+
 class FiniteStateMachine(object):
 
-	def __init__(self):
+	def __init__(
+		self, reload_seconds: float = 0, get_used_states: Callable[[], Set[str]] = None):
+		"""
+		:param reload_seconds: seconds between checks for changes in the
+			dialogue state files, 0 to disable reloading
+		:param get_used_states: function that returns the states that the
+			active rooms are in, so they are kept if their files remove them
+		"""
 		# users with limited actions (e.g. must wait for an operator answer)
 		self._limited_users = {}
-		self.states: Dict[str, dialogue_state.DialogueState] = {}
+		self._get_used_states = get_used_states or set
+		# states removed from the files but kept for the rooms that are in them
+		self._kept_states: Set[str] = set()
+		start_time = time.perf_counter()
 		self._load_states()
 		logger_crwiz.debug(
-			f"Finite State Machine: {len(self.states.keys())} states loaded")
+			f"Finite State Machine: {len(self.states.keys())} states loaded "
+			f"in {time.perf_counter() - start_time:.3f}s")
+
+		self._reload_seconds = reload_seconds
+		if reload_seconds > 0:
+			scheduler.schedule(
+				('reload_states', id(self)), reload_seconds, self._watch_states)
 
 	def _load_states(self):
 		"""
@@ -51,10 +95,87 @@ class FiniteStateMachine(object):
 
 		states_folder_path = os.path.join(
 			root_folder, 'knowledge_base', 'dialogue_states')
-		self.states = dialogue_state.load_dialogue_states(states_folder_path)
+		self._loader = dialogue_state.DialogueStateLoader(states_folder_path)
+		self._loaded_states = self._loader.load()
+		self._knowledge_base = KnowledgeBase(self._loaded_states)
 
-		self.fixed_states = [
-			state.name for state in self.states.values() if state.is_fixed]
+	def reload_states(self) -> bool:
+		"""
+		Reloads the dialogue states if their files changed. The new states
+		replace the old ones at once, so running rooms use them from
+		their next request. The states removed from the files are kept
+		while an active room is in them, and dropped in a later reload.
+
+		:return: True if the states were reloaded
+		"""
+		states = self._loader.reload()
+		if states is None:
+			if not self._kept_states:
+				return False
+			states = self._loaded_states
+
+		used_states = self._get_used_states()
+		kept_states = {
+			state_name: state for state_name, state in self.states.items()
+			if state_name not in states and state_name in used_states}
+		if states is self._loaded_states and kept_states.keys() == self._kept_states:
+			# the kept states are still in use
+			return False
+
+		try:
+			knowledge_base = KnowledgeBase(
+				{**states, **kept_states}, self._knowledge_base.version + 1)
+		except Exception as ex:
+			logger_crwiz.exception(f"Cannot reload the dialogue states: {ex}")
+			return False
+
+		removed_states = set(self.states.keys()).difference(states.keys(), kept_states.keys())
+		if removed_states:
+			logger_crwiz.warning(
+				f"Dialogue states removed while reloading: {sorted(removed_states)}")
+		if kept_states.keys() - self._kept_states:
+			logger_crwiz.warning(
+				f"Dialogue states removed but kept until no room is in them: "
+				f"{sorted(kept_states.keys() - self._kept_states)}")
+
+		self._loaded_states = states
+		self._kept_states = set(kept_states.keys())
+		self._knowledge_base = knowledge_base
+		logger_crwiz.info(
+			f"Finite State Machine: {len(knowledge_base.states)} states reloaded "
+			f"(version {knowledge_base.version})")
+		return True
+
+	def _watch_states(self):
+		try:
+			self.reload_states()
+		finally:
+			scheduler.schedule(
+				('reload_states', id(self)), self._reload_seconds, self._watch_states)
+
+	@property
+	def knowledge_base(self) -> KnowledgeBase:
+		return self._knowledge_base
+
+	@property
+	def states(self) -> Dict[str, dialogue_state.DialogueState]:
+		return self._knowledge_base.states
+
+	@property
+	def fixed_states(self) -> List[str]:
+		return self._knowledge_base.fixed_states
+
+	@property
+	def graph(self) -> transition_graph.TransitionGraph:
+		return self._knowledge_base.graph
+
+	@property
+	def formulation_matcher(self) -> helper.FormulationMatcher:
+		return self._knowledge_base.formulation_matcher
+
+	@property
+	def state_classifier(self) -> StateClassifier:
+		return self._knowledge_base.state_classifier
 
 	def get_state_utterances(
 		self, state_name: str, user_id=None, keep_formulations: bool = True) -> list:
@@ -92,54 +213,38 @@ class FiniteStateMachine(object):
 		return utterances
 
 	def get_state_transition_probabilities(
-		self, state_name, filter_fixed: bool = True) -> Dict[str, float]:
-		state = self.states[state_name]
-		if not state.transition_probabilities and not state.transitions:
-			return {}
-		else:
-			final_result = {}
-			try:
-				# build probabilities based on number of transitions for those missing
-				for transition, probability in state.transition_probabilities:
-					if not filter_fixed or not self.states[transition].is_fixed:
-						final_result[transition] = probability
-
-				# normalise the result, so the probabilities sum to 1
-				sum_prob = sum(final_result.values())
-				# logger_crwiz.debug(f"Prob sum for {state_name} is {sum_prob}")
-				if sum_prob != 1:
-					for key, val in final_result.items():
-						final_result[key] = val / sum_prob
-					# if the sum value is still not 1, add the remainder to a prob
-					sum_prob = sum(final_result.values())
-					if sum_prob != 1:
-						key = random.choice(final_result.keys())
-						final_result[key] = final_result[key] + (1 - sum_prob)
-				logger_crwiz.debug(
-					f"Hint for {state_name} computed to {final_result} "
-					f"({sum(final_result.values())}/1.0)")
-			except Exception as e:
-				print(f"Exception! {e}")
+		self, state_name, filter_fixed: bool = True,
+		subtask: str = None) -> Dict[str, float]:
+		"""
+		Gets the normalised probabilities of the transitions of a state.
+		They come from the cached distributions of the transition graph.
+
+		:param state_name: name of the state
+		:param filter_fixed: whether to leave out the fixed states
+		:param subtask: name of the current subtask (None to only
+			consider states without a subtask)
+		:return: dict with {state_name: probability}
+		"""
+		targets, probabilities = self.graph.get_distribution(
+			self.graph.get_id(state_name), subtask, filter_fixed)
 
-			return final_result
+		return {
+			self.graph.get_name(target): float(probability)
+			for target, probability in zip(targets, probabilities)}
 
 	def get_additional_utterances(self, active_room: ActiveRoom) -> list:
 		additional_utterances = []
-		user_states = get_user_states(active_room.wizard_id)
+		# newest first
+		user_states = list(reversed(active_room.recent_states))
 
-		if user_states and len(user_states) > 0:
+		if len(user_states) > 0:
 			# remove latest state (because it already doesn't have enough utterances)
 			current_state = user_states.pop(0)
 
-			while len(user_states) > 0:
-				# get state
-				this_state = user_states[0].current_state
-				# get transition states for that state
-				state_transitions = self.states[this_state].transitions
-
-				# filter those that do not correspond to current subtask
-				state_transitions = self.filter_transitions_by_subtask(
-					state_transitions, active_room.current_subtask)
+			for this_state in user_states:
+				# get transition states for that state in the current subtask
+				state_transitions = self.graph.get_transitions(
+					this_state, active_room.current_subtask.name)
 
 				# get the utterances for those transition states in a list
 				state_utterances = self.get_states_utterances(
@@ -147,33 +252,22 @@ class FiniteStateMachine(object):
 
 				# filter utterances by those already used
 				state_utterances = filter_used_transitions(
-					active_room.wizard_id, state_utterances)
+					active_room, state_utterances)
 				if len(state_utterances) > 0:
 					# add them to the list of additional utterances
 					additional_utterances.extend(state_utterances)
 					# break the loop if we found 1 state with possible transitions
 					break
-				else:
-					# keep looping until no more states or state with transitions
-					user_states.pop(0)
+				# otherwise, keep looping until no more states or state with transitions
 
 			if len(additional_utterances) > 0:
 				logger_crwiz.debug(
 					f"Adding extra utterances at state "
-					f"'{current_state.current_state}': "
+					f"'{current_state}': "
 					f"{[utt['state_name'] for utt in additional_utterances]}")
 		# return additional_utterances[:utterances_needed]
 		return additional_utterances
 
-	def filter_transitions_by_subtask(self, transitions: list, subtask: Subtask):
-		filtered_transitions = []
-		for transition in transitions:
-			if self.states[transition].subtask is None \
-				or subtask.name == self.states[transition].subtask:
-				filtered_transitions.append(transition)
-
-		return filtered_transitions
-
 	@staticmethod
 	def post_process_utterances(utterance_list: list) -> list:
 		result = []
@@ -192,11 +286,22 @@ class FiniteStateMachine(object):
 		self.submit_dialogue_choice(active_room, INITIAL_STATE, '')
 
 	def get_current_state_utterances(self, active_room: ActiveRoom) -> dict:
-		transitions = self.states[active_room.current_state].transitions
+		# the choices only change with the dialogue state (or if the states are
+		# reloaded), so they are computed and logged once per state
+		response = active_room.get_dialogue_choices(self.knowledge_base.version)
+		if response is None:
+			response = self._compute_current_state_utterances(active_room)
+			active_room.set_dialogue_choices(response, self.knowledge_base.version)
 
-		# filter those that do not correspond to current subtask
-		transitions = self.filter_transitions_by_subtask(
-			transitions, active_room.current_subtask)
+		if fake_actions.state_contains_action(active_room.current_state):
+			fake_actions.emit_action(active_room)
+
+		return response
+
+	def _compute_current_state_utterances(self, active_room: ActiveRoom) -> dict:
+		# transitions that correspond to the current subtask
+		transitions = self.graph.get_transitions(
+			active_room.current_state, active_room.current_subtask.name)
 
 		# get the utterances for those transition states
 		transition_utterances = self.get_states_utterances(
@@ -232,11 +337,36 @@ class FiniteStateMachine(object):
 			}
 		}
 
-		if fake_actions.state_contains_action(active_room.current_state):
-			fake_actions.emit_action(active_room)
-
 		return response
 
+	def match_utterance(self, utterance: str) -> Optional[Tuple[str, str]]:
+		"""
+		Finds the state and formulation that an utterance was made from
+		(e.g. free text typed by the wizard that is a formulation anyway).
+
+		:param utterance: text of the utterance
+		:return: tuple with the state name and formulation or None if none matches
+		"""
+		return self.formulation_matcher.match(utterance)
+
+	def predict_states(
+		self, utterance: str, k: int = DEFAULT_TOP_K) -> List[Tuple[str, float]]:
+		"""
+		Predicts the states that an utterance (e.g. free text) belongs to.
+		An utterance that matches a formulation gets its state with score 1.
+
+		:param utterance: text of the utterance
+		:param k: max number of states to return
+		:return: list of tuples with the state name and score, the best first
+		"""
+		match = self.match_utterance(utterance)
+		if match is None:
+			return self.state_classifier.classify(utterance, k)
+
+		return [(match[0], 1.0)] + [
+			prediction for prediction in self.state_classifier.classify(utterance, k)
+			if prediction[0] != match[0]][:k - 1]
+
 	def submit_dialogue_choice(self, active_room: ActiveRoom, state_name, text):
 		if state_name not in self.states.keys():
 			print(self.states)
@@ -244,6 +374,7 @@ class FiniteStateMachine(object):
 			raise ValueError(f"State '{state_name}' not found in self.states")
 
 		active_room.current_state = state_name
+		active_room.add_state_history(state_name)
 		db.session.add(StateHistory(
 			user_id=active_room.wizard_id,
 			previous_state=active_room.previous_state,
@@ -266,30 +397,32 @@ class FiniteStateMachine(object):
 		# only give hint if not requested for the same state before
 		# or if we are in a limiting state
 		if active_room.current_state_hint is None:
-			probabilities = self.get_state_transition_probabilities(
-				active_room.current_state)
 			state_utterances = self.get_current_state_utterances(active_room)
 			utterances = [
 				utt['state_name']
 				for utt in state_utterances['choice_selection']['elements']]
 
-			# compute hint
-			hint = None
-			if len(probabilities) > 0:
-				try:
-					for _ in range(1000):
-						tmp_hint = numpy.random.choice(
-							list(probabilities.keys()), 1,
-							p=list(probabilities.values()))[0]
-						if tmp_hint in utterances:
-							hint = tmp_hint
-							break
-				except ValueError:
-					pass
+			if active_room.predicted_state is not None \
+					and active_room.predicted_state[0] in utterances:
+				# the wizard typed free text that most likely belongs to one of
+				# the choices, so that choice is what the wizard was looking for
+				hint, probability = active_room.predicted_state
+			else:
+				# compute hint with a single draw over the offered utterances
+				targets, probabilities = self.graph.get_distribution(
+					self.graph.get_id(active_room.current_state),
+					active_room.current_subtask.name)
+				hint, probability = sample_hint(
+					[self.graph.get_name(target) for target in targets],
+					probabilities, utterances)
 
 			if hint is None:
 				hint = random.choice(utterances)
 				logger_crwiz.debug(f"Selected random hint {hint} from {utterances}")
+			else:
+				logger_crwiz.debug(
+					f"Hint for {active_room.current_state} computed to {hint} "
+					f"({probability})")
 
 			state_name = [
 				state['state_name']
@@ -300,7 +433,7 @@ class FiniteStateMachine(object):
 			response = {
 				'utterance_id': state_name,
 				# 'state_name': hint,
-				'probability': probabilities[hint] if hint in probabilities else 0,
+				'probability': probability,
 			}
 
 			active_room.log_user_event("fsa_request_task_hint", {
@@ -331,30 +464,58 @@ def get_last_state_formulation(user_id, state: dialogue_state.DialogueState):
 	:param state: dialogue state
 	:return: str with formulation or None
 	"""
-	logs = get_user_logs_for_event(user_id, constants.EVENT_FSM_GET_TRANSITIONS)
-	if len(logs) == 0 or logs[0]['data']['current_state'] != \
+	last_log = get_last_user_log_for_event(
+		user_id, constants.EVENT_FSM_GET_TRANSITIONS)
+	if last_log is None or last_log['data']['current_state'] != \
 		dialogue_utils.get_user_dialogue_state(user_id):
 		# this does not apply if there are not previous formulations at this state
 		return None
 
 	else:
-		last_utterances = logs[0]['data']['possible_utterances']
+		last_utterances = last_log['data']['possible_utterances']
 		for utterance in last_utterances:
 			if utterance['state_name'] == state.name:
-				for formulation in state.formulations:
-					if helper.match_utterance_to_state_formulation(
-						utterance['utterance'], formulation):
-						return formulation
+				formulation = state.match_formulation(utterance['utterance'])
+				if formulation is not None:
+					return formulation
 
 	return None
 
 
-def filter_used_transitions(user_id, state_utterances: list) -> list:
+def sample_hint(
+	state_names: list, probabilities: numpy.ndarray,
+	utterances: list) -> Tuple[Optional[str], float]:
+	"""
+	Samples a hint from a distribution over states, only considering
+	the states that are offered as utterances to the wizard.
+
+	:param state_names: names of the states in the distribution
+	:param probabilities: probabilities aligned with state_names
+	:param utterances: names of the states offered to the wizard
+	:return: tuple with (state name, its original probability),
+		(None, 0) if none of the offered states has any probability
+	"""
+	if len(state_names) == 0:
+		return None, 0
+
+	offered = numpy.array([name in utterances for name in state_names])
+	masked_probabilities = probabilities * offered
+	total = masked_probabilities.sum()
+	if total <= 0:
+		return None, 0
+
+	index = numpy.random.choice(
+		len(state_names), p=masked_probabilities / total)
+	return state_names[index], float(probabilities[index])
+
+
+def filter_used_transitions(
+	active_room: ActiveRoom, state_utterances: list) -> list:
 	filtered_transitions = []
 
 	for state_utterance in state_utterances:
 		# avoid adding states that trigger gazebo
-		if not check_used_state(user_id, state_utterance['state_name']):
+		if not active_room.check_used_state(state_utterance['state_name']):
 			# state not used before
 			filtered_transitions.append(state_utterance)
 
@@ -9,23 +9,29 @@ Author: Javier Chiyah, Heriot-Watt University, 2019
 """
 
 import json
-from typing import Dict
+import time
+import contextlib
+from typing import Dict, Iterator, Optional, Set
 
 from flask import Response
 
-from .. import db, socketio
+from .. import db, socketio, settings
 
 from ..api import log
 
 from ..models.user import User
 from ..models.room import Room
+from ..models.log import event_cache, log_buffer
 
 from ..socket_logic import user_logic
 from ..socket_logic import room_logic
 
 from . import logger_crwiz, finite_state_machine, game_token
 from .active_room import Subtask, ActiveRoom, SUBTASK_END
-from .utils import constants, post_task_analysis
+from .utils import constants, helper
+from .utils.room_state import create_room_state_backend
+from .utils.hash_ring import HashRing
+from .analysis_queue import analysis_queue
 
 
 class JSONResponse(Response):
@@ -38,18 +44,33 @@ class JSONResponse(Response):
 		if 'mimetype' not in kwargs and 'contenttype' not in kwargs:
 			kwargs['mimetype'] = 'application/json'
 
-		if not response_dict:
-			response_dict = {}
+		super(JSONResponse, self).__init__(status=status, **kwargs)
 
-		super(JSONResponse, self).__init__(
-			response=json.dumps(response_dict),
-			status=status,
-			**kwargs
-		)
+		# the data is kept as a dict and only serialised when the body is needed
+		self._response_dict = dict(response_dict) if response_dict else {}
+		self._is_serialised = False
 
 	@property
-	def response_dict(self):
-		return json.loads(self.response[0])
+	def response(self):
+		"""
+		Body of the response, serialised from response_dict the first time
+		it is needed (e.g. when Flask sends it) or after it changes.
+		"""
+		if not self._is_serialised:
+			self._is_serialised = True
+			self.set_data(json.dumps(self._response_dict))
+		return self._response
+
+	@response.setter
+	def response(self, value):
+		self._response = value
+
+	@property
+	def response_dict(self) -> dict:
+		"""
+		Data of the response, without serialising it (e.g. to emit it in a socket).
+		"""
+		return self._response_dict
 
 	def add_data(self, additional_data: dict, status: int = None):
 		"""
@@ -68,12 +89,9 @@ class JSONResponse(Response):
 				self.set_status(400)
 			# raise ValueError("Trying to add data to response with invalid attribute")
 
-		# load current response
-		tmp_response = self.response_dict  # json.loads(self.response[0])
-		# extend it with the additional data
-		tmp_response.update(additional_data)
-		# modify the response content
-		self.set_data(json.dumps(tmp_response))
+		# extend the response with the additional data, it is serialised later
+		self._response_dict.update(additional_data)
+		self._is_serialised = False
 
 	def set_status(self, status_code: int):
 		"""
@@ -85,11 +103,31 @@ class JSONResponse(Response):
 		self.status_code = status_code
 
 
+# seconds to remember that a user has no task room, so the DB is not queried again
+UNKNOWN_USER_SECONDS = 30
+UNKNOWN_USERS_MAX_SIZE = 1000
+
+
 class TaskManager:
 
 	def __init__(self):
-		self.state_machine = finite_state_machine.FiniteStateMachine()
+		self.state_machine = finite_state_machine.FiniteStateMachine(
+			settings.knowledge_base_reload_seconds, self.get_used_states)
 		self.active_rooms: Dict[str, ActiveRoom] = {}
+		# participants (wizard and operator) of the active rooms to their room
+		self._user_rooms: Dict[int, str] = {}
+		# users without a task room, to when they should be looked up again
+		self._unknown_users: Dict[int, float] = {}
+		# state of the active rooms, shared with the other workers (if any)
+		self.room_states = create_room_state_backend(settings.room_state_backend)
+		# other workers log events too, so the latest ones cannot be cached here
+		event_cache.set_enabled(not self.room_states.shared)
+		# id of this worker process, e.g. to know which one runs the timers of a room
+		self.worker_id = helper.get_worker_id()
+		# which instance owns each task room, None if rooms are not sharded
+		self.instance_id = settings.instance_id
+		self.ring: Optional[HashRing] = \
+			HashRing(settings.instances) if settings.instances else None
 
 	def __del__(self):
 		"""
@@ -110,8 +148,150 @@ class TaskManager:
 		:return: None
 		"""
 		self.active_rooms[room_name] = ActiveRoom(
-			room_name, user_id, self.timeout_task_timer)
+			room_name, user_id, self.timeout_task_timer, self.worker_id)
 		self.state_machine.initialise_room_fsa(self.active_rooms[room_name])
+		self.index_room(self.active_rooms[room_name])
+		self.save_room(self.active_rooms[room_name])
+
+	def get_active_room(self, room_name: str) -> Optional[ActiveRoom]:
+		"""
+		Gets an active room. If the room state backend is shared with other
+		workers, the room is first updated (or created) from its latest state.
+
+		:param room_name: name of the room
+		:return: ActiveRoom or None if the room is not active
+		"""
+		if self.room_states.shared:
+			state = self.room_states.load(room_name)
+			if state is None:
+				if room_name in self.active_rooms:
+					# deleted by another worker
+					self.active_rooms.pop(room_name).cancel_timers()
+					self.unindex_room(room_name)
+			elif room_name in self.active_rooms:
+				self.active_rooms[room_name].restore(
+					state, delete_room_from_task_manager)
+			else:
+				active_room = ActiveRoom(
+					room_name, state['wizard_id'], self.timeout_task_timer, self.worker_id)
+				active_room.restore(state, delete_room_from_task_manager)
+				self.active_rooms[room_name] = active_room
+				self.index_room(active_room)
+
+		return self.active_rooms.get(room_name)
+
+	@contextlib.contextmanager
+	def edit_room(self, room_name: str) -> Iterator[Optional[ActiveRoom]]:
+		"""
+		Locks a room and gets its latest state, so it can be changed without
+		other workers changing it meanwhile. The room is saved at the end,
+		unless it was deleted or an exception was raised.
+
+		:param room_name: name of the room
+		:return: ActiveRoom or None if the room is not active
+		"""
+		with self.room_states.lock(room_name):
+			active_room = self.get_active_room(room_name)
+			yield active_room
+			if active_room is not None and self.active_rooms.get(room_name) is active_room:
+				self.save_room(active_room)
+
+	def get_used_states(self) -> Set[str]:
+		"""
+		Gets the dialogue states that the active rooms are in, including
+		the rooms of other workers if the room state backend is shared.
+
+		:return: set of state names
+		"""
+		if not self.room_states.shared:
+			return {
+				active_room.current_state for active_room in list(self.active_rooms.values())
+				if not active_room.task_finished}
+
+		used_states = set()
+		for room_name in self.room_states.room_names():
+			state = self.room_states.load(room_name)
+			if state is not None and not state['task_finished']:
+				used_states.add(state['current_state'])
+		return used_states
+
+	def get_room_owner(self, room_name: str) -> Optional[str]:
+		"""
+		Gets the instance that owns a task room.
+
+		:param room_name: name of the room
+		:return: id of the instance or None if the room is not sharded
+		"""
+		if self.ring is None or not room_name.startswith("wizard_task"):
+			return None
+		return self.ring.get_worker(room_name)
+
+	def owns_room(self, room_name: str) -> bool:
+		"""
+		Checks whether this instance should serve a room.
+
+		:param room_name: name of the room
+		:return: True if the room is owned by this instance or is not sharded
+		"""
+		owner = self.get_room_owner(room_name)
+		return owner is None or owner == self.instance_id
+
+	def _get_misdirected_response(self, room_name: str) -> JSONResponse:
+		"""
+		Response for a call about a room that another instance owns.
+
+		:param room_name: name of the room
+		:return: JSONResponse with status 421 and the owner of the room
+		"""
+		response = JSONResponse()
+		response.add_data({
+			'reason': f"Room '{room_name}' is served by another instance",
+			'owner': self.get_room_owner(room_name)
+		}, 421)
+		return response
+
+	def save_room(self, active_room: ActiveRoom):
+		"""
+		Saves the state of an active room in the room state backend.
+		It should be called after changing the room.
+
+		:param active_room: active room to save
+		:return: None
+		"""
+		self.room_states.save(active_room.name, active_room.to_dict())
+
+	def index_room(self, active_room: ActiveRoom):
+		"""
+		Adds the participants of an active room to the user to room index.
+
+		:param active_room: active room to index
+		:return: None
+		"""
+		for user_id in [active_room.wizard_id, *active_room.participants.keys()]:
+			self._user_rooms[user_id] = active_room.name
+			self._unknown_users.pop(user_id, None)
+
+	def forget_unknown_user(self, user_id: int):
+		"""
+		Forgets that a user had no task room, so the next get_room_name()
+		looks it up again. It should be called when the user joins one.
+
+		:param user_id: id of the user
+		:return: None
+		"""
+		self._unknown_users.pop(user_id, None)
+
+	def unindex_room(self, room_name: str):
+		"""
+		Removes the participants of a room from the user to room index.
+
+		:param room_name: name of the room
+		:return: None
+		"""
+		for user_id in [
+				user_id for user_id, name in self._user_rooms.items()
+				if name == room_name]:
+			del self._user_rooms[user_id]
 
 	def start_task_timer(self, room_name: str):
 		"""
@@ -135,10 +315,13 @@ class TaskManager:
 		:param room_name: name of the room
 		:return: None
 		"""
-		if room_name in self.active_rooms:
-			logger_crwiz.info(
-				f"Timeout triggered for task in room '{room_name}'")
-			self.close_active_room(self.active_rooms[room_name])
+		with self.edit_room(room_name) as active_room:
+			# the room could have been closed or its timer moved to another worker
+			if active_room is not None and not active_room.task_finished \
+					and active_room.timer_worker == self.worker_id:
+				logger_crwiz.info(
+					f"Timeout triggered for task in room '{room_name}'")
+				self.close_active_room(active_room)
 
 	def get_dialogue_options(self, user_id) -> JSONResponse:
 		"""
@@ -157,20 +340,27 @@ class TaskManager:
 				{'reason': f"Cannot find room for user {user_id}"}, 400)
 			return response
 
-		if room_name not in self.active_rooms:
-			self.initialise_room(room_name, user_id)
+		if not self.owns_room(room_name):
+			return self._get_misdirected_response(room_name)
 
-		elif self.active_rooms[room_name].task_finished:
-			response.add_data(
-				{'reason': f"Room task has already finished"}, 200)
-			return response
+		# other workers could change the room meanwhile
+		with self.room_states.lock(room_name):
+			active_room = self.get_active_room(room_name)
+			if active_room is None:
+				self.initialise_room(room_name, user_id)
+				active_room = self.active_rooms[room_name]
+
+			elif active_room.task_finished:
+				response.add_data(
+					{'reason': f"Room task has already finished"}, 200)
+				return response
 
-		response.add_data(
-			self.state_machine.get_current_state_utterances(
-				self.active_rooms[room_name]
-			))
+			response.add_data(
+				self.state_machine.get_current_state_utterances(active_room))
+			# the dialogue choices are cached in the room
+			self.save_room(active_room)
 
-		self.active_rooms[room_name].emit_status_update()
+			active_room.emit_status_update()
 		return response
 
 	def submit_dialogue_choice(self, user_id, state_name, text) -> JSONResponse:
@@ -192,28 +382,55 @@ class TaskManager:
 				{'reason': f"Cannot find room for user {user_id}"}, 400)
 			return response
 
+		if not self.owns_room(room_name):
+			return self._get_misdirected_response(room_name)
+
 		if not text or text == "":
 			# text empty, so not valid to start with
 			response.add_data({'reason': 'text is empty'}, 400)
 			return response
 
-		if self.active_rooms[room_name].task_finished:
-			response.add_data(
-				{'reason': f"Room task has already finished"}, 200)
-			return response
-
-		if state_name != "":
-			response.add_data(
-				self.state_machine.submit_dialogue_choice(
-					self.active_rooms[room_name], state_name, text
-				))
+		# other workers could change the room meanwhile
+		with self.room_states.lock(room_name):
+			active_room = self.get_active_room(room_name)
+			if active_room is None:
+				response.add_data({'reason': "Room is not active"}, 400)
+				return response
+
+			if active_room.task_finished:
+				response.add_data(
+					{'reason': f"Room task has already finished"}, 200)
+				return response
+
+			if state_name != "":
+				response.add_data(
+					self.state_machine.submit_dialogue_choice(
+						active_room, state_name, text
+					))
+
+				if active_room.previous_state == \
+					finite_state_machine.INITIAL_STATE:
+					self.start_task_timer(room_name)
+
+			else:
+				# free text, log the states it most likely belongs to
+				predictions = self.state_machine.predict_states(text)
+				# and keep the best one for the hints, see get_task_hint()
+				active_room.predicted_state = predictions[0] if predictions else None
+				active_room.log_user_event(
+					constants.EVENT_FSM_PREDICT_STATE, {
+						'current_state': active_room.current_state,
+						'utterance': text,
+						'predicted_state': predictions[0][0] if predictions else None,
+						'predictions': [
+							{'state_name': state_name, 'score': score}
+							for state_name, score in predictions]
+					})
 
-			if self.active_rooms[room_name].previous_state == \
-				finite_state_machine.INITIAL_STATE:
-				self.start_task_timer(room_name)
+			self.save_room(active_room)
 
-		self.active_rooms[room_name].emit_status_update()
-		emit_dialogue_choices(self.active_rooms[room_name])
+			active_room.emit_status_update()
+			emit_dialogue_choices(active_room)
 		return response
 
 	def request_task_hint(self, user_id) -> JSONResponse:
@@ -235,13 +452,22 @@ class TaskManager:
 				{'reason': f"Cannot find room for user {user_id}"}, 400)
 			return response
 
-		hint, dialogue_choices = \
-			self.state_machine.get_task_hint(self.active_rooms[room_name])
+		if not self.owns_room(room_name):
+			return self._get_misdirected_response(room_name)
+
+		# other workers could change the room meanwhile
+		with self.room_states.lock(room_name):
+			active_room = self.get_active_room(room_name)
+			if active_room is None:
+				response.add_data({'reason': "Room is not active"}, 400)
+				return response
+
+			hint, dialogue_choices = self.state_machine.get_task_hint(active_room)
+			self.save_room(active_room)
 
-		response.add_data(hint)
+			response.add_data(hint)
 
-		emit_dialogue_choices(
-			self.active_rooms[room_name], JSONResponse(dialogue_choices))
+			emit_dialogue_choices(active_room, JSONResponse(dialogue_choices))
 		return response
 
 	def close_active_room(
@@ -306,24 +532,41 @@ class TaskManager:
 					'name': user.name, 'game_token': user.game_token
 				}
 
+			# write any buffered logs before the room logs are analysed and exported
+			log_buffer.flush()
+			self.save_room(active_room)
+
 			emit_close_room(active_room, participants=participants, reason=reason)
 
 	def get_room_name(self, user_id):
 		"""
 		Gets the name of the room for the user.
 
-		:param user_id: id of the wizard
+		:param user_id: id of the wizard or the operator
 		:return: name of the room as string or None
 		"""
-		for name, room in self.active_rooms.items():
-			if room.wizard_id == user_id:
-				return name
+		if user_id in self._user_rooms:
+			return self._user_rooms[user_id]
+
+		now = time.monotonic()
+		if self._unknown_users.get(user_id, 0) > now:
+			return None
 
 		# if we are here then it's the first time for this user, get from the DB
-		room = User.query.get(user_id).get_task_room()
+		user = User.query.get(user_id)
+		room = user.get_task_room() if user else None
 		# room not found
 		if not room:
+			if len(self._unknown_users) >= UNKNOWN_USERS_MAX_SIZE:
+				self._unknown_users = {
+					user_id: expiry for user_id, expiry in self._unknown_users.items()
+					if expiry > now}
+			self._unknown_users[user_id] = now + UNKNOWN_USER_SECONDS
 			return None
+
+		if room.name in self.active_rooms:
+			# a participant that joined after the room was indexed
+			self._user_rooms[user_id] = room.name
 		return room.name
 
 
@@ -348,7 +591,7 @@ def emit_dialogue_choices(
 
 	socketio.emit("dialogue_choices", {
 		'room_name': active_room.name,
-		**response.get_json(),
+		**response.response_dict,
 		**kwargs
 	}, room=active_room.name)
 
@@ -356,12 +599,14 @@ def emit_dialogue_choices(
 def emit_close_room(active_room: ActiveRoom, **kwargs):
 	"""
 	Sends a close_room message so the HelperBot hands out the Amazon Turk
-	codes to the participants.
+	codes to the participants, and queues the post-task analysis of the room.
+	The HelperBot exports the logs of the room again once it is analysed.
 
 	:param active_room: active room to close
 	:return: None
 	"""
-	post_task_analysis.perform_post_task_analysis(active_room.name)
+	# the analysis runs in the background, see AnalysisQueue
+	analysis_queue.add(active_room.name)
 
 	socketio.emit("close_room", {
 		'room_name': active_room.name,
@@ -396,26 +641,26 @@ def _user_finish_task(data):
 		logger_crwiz.warning(f"user does not exist")
 		return False, "user does not exist"
 
-	if room_name not in task_manager.active_rooms:
-		logger_crwiz.warning(f"room '{room_name}' does not exist")
-		return False, "room does not exist"
+	with task_manager.edit_room(room_name) as active_room:
+		if active_room is None:
+			logger_crwiz.warning(f"room '{room_name}' does not exist")
+			return False, "room does not exist"
 
-	if not task_manager.active_rooms[room_name].can_finish_task:
-		logger_crwiz.warning(f"task in '{room_name}' cannot finish yet")
-		return False, "task cannot finish yet"
+		if not active_room.can_finish_task:
+			logger_crwiz.warning(f"task in '{room_name}' cannot finish yet")
+			return False, "task cannot finish yet"
 
-	# if we reach this, the user is valid, the room exists and it can be finished
-	# add participants, so it is easier for the HelperBot
-	data['participants'] = task_manager.active_rooms[room_name].participants
+		# if we reach this, the user is valid, the room exists and it can be finished
+		# add participants, so it is easier for the HelperBot
+		data['participants'] = active_room.participants
 
-	socketio.emit("user_finish_task", data, room=room_name)
+		socketio.emit("user_finish_task", data, room=room_name)
 
-	log.log_event(constants.EVENT_USER_END_TASK, user, Room.query.get(room_name), data={
-		'seconds_since_start': task_manager.active_rooms[room_name].elapsed_seconds
-	})
+		log.log_event(constants.EVENT_USER_END_TASK, user, Room.query.get(room_name), data={
+			'seconds_since_start': active_room.elapsed_seconds
+		})
 
-	task_manager.close_active_room(
-		task_manager.active_rooms[room_name], user_triggered=True)
+		task_manager.close_active_room(active_room, user_triggered=True)
 
 	return True
 
@@ -445,20 +690,21 @@ def _close_room_on_user_disconnect(data):
 		logger_crwiz.warning(f"user does not exist")
 		return False, "user does not exist"
 
-	if room_name not in task_manager.active_rooms:
-		logger_crwiz.warning(f"room '{room_name}' does not exist")
-		return False, "room does not exist"
+	with task_manager.edit_room(room_name) as active_room:
+		if active_room is None:
+			logger_crwiz.warning(f"room '{room_name}' does not exist")
+			return False, "room does not exist"
 
-	log.log_event(constants.EVENT_DISCONNECT_END_TASK, current_user, Room.query.get(room_name), data={
-		'seconds_since_start': task_manager.active_rooms[room_name].elapsed_seconds,
-		'disconnected_user_id': user_id
-	})
+		log.log_event(constants.EVENT_DISCONNECT_END_TASK, current_user, Room.query.get(room_name), data={
+			'seconds_since_start': active_room.elapsed_seconds,
+			'disconnected_user_id': user_id
+		})
 
-	task_manager.close_active_room(
-		task_manager.active_rooms[room_name], False,
-		reason_id=constants.TASK_END_USER_DISCONNECTED,
-		reason="Your partner has been away for too long, the game cannot continue."
-	)
+		task_manager.close_active_room(
+			active_room, False,
+			reason_id=constants.TASK_END_USER_DISCONNECTED,
+			reason="Your partner has been away for too long, the game cannot continue."
+		)
 
 	return True
 
@@ -479,7 +725,11 @@ def _close_room_feedback(data):
 	room_logic.update_room_properties({'read_only': True}, room_name=room_name)
 
 	# starts a timer that will invalidate the participant's tokens after X time
-	task_manager.active_rooms[room_name].start_token_timer(delete_room_from_task_manager)
+	with task_manager.edit_room(room_name) as active_room:
+		if active_room is None:
+			logger_crwiz.warning(f"room '{room_name}' does not exist")
+			return False, "room does not exist"
+		active_room.start_token_timer(delete_room_from_task_manager)
 
 	logger_crwiz.debug(f"Finished closing room '{room_name}")
 
@@ -492,8 +742,15 @@ def delete_room_from_task_manager(room_name):
 	:param room_name: name of the room
 	:return: None
 	"""
-	task_manager.active_rooms[room_name].invalidate_user_tokens()
-	del task_manager.active_rooms[room_name]
+	with task_manager.edit_room(room_name) as active_room:
+		# the room could have been deleted or its timer moved to another worker
+		if active_room is None or active_room.timer_worker != task_manager.worker_id:
+			return
+		active_room.invalidate_user_tokens()
+		del task_manager.active_rooms[room_name]
+		task_manager.room_states.delete(room_name)
+		task_manager.unindex_room(room_name)
+		event_cache.clear_room(room_name)
 	logger_crwiz.debug(
 		f"Room {room_name} deleted from active rooms "
 		f"{[room.name for room in task_manager.active_rooms.values()]}")
@@ -24,6 +24,7 @@ EVENT_GENERATE_GAME_TOKEN = 'generate_game_token'
 
 EVENT_FSM_GET_TRANSITIONS = 'fsa_get_state_transitions'
 EVENT_FSM_CHANGE_STATE = 'fsa_state_change'
+EVENT_FSM_PREDICT_STATE = 'fsa_predict_state'
 
 
 # Task End Type IDs
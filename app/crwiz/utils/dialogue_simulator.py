@@ -0,0 +1,302 @@
+"""
+dialogue_simulator
+------------------
+
+Markov chain of the dialogues of a knowledge base, to estimate how long they
+are, how likely they are to finish and how accurate the hints are before
+running a study.
+
+The chain has a node for each (state, subtask) reachable from the initial
+state, since the transitions available depend on the subtask (see
+TransitionGraph) and the milestone states change it (see
+ActiveRoom.check_state_for_milestones()). The next state is drawn from the
+same distribution as the hints of the Wizard, so the fixed states are left
+out. The end state and the states without transitions are absorbing.
+
+The chain is kept as a sparse matrix (CSR arrays), so it can be analysed
+exactly as an absorbing chain and simulated with batches of random walks
+that advance together with numpy. SciPy is used to solve the absorbing
+chain if it is installed, otherwise the solution is iterated.
+
+The estimates of a knowledge base are printed with:
+python -m knowledge_base.simulate
+"""
+
+import collections
+from typing import Dict, List, Mapping, Optional, Tuple
+
+import numpy
+
+try:
+	import scipy.sparse
+	import scipy.sparse.linalg
+except ImportError:
+	scipy = None
+
+
+DEFAULT_WALKS = 1000000
+DEFAULT_MAX_STEPS = 100
+
+# tolerance and max iterations to solve the absorbing chain without SciPy
+SOLVE_TOLERANCE = 1e-10
+SOLVE_MAX_ITERATIONS = 100000
+
+
+class DialogueChain:
+	"""
+	Absorbing Markov chain of the dialogues of a TransitionGraph.
+	"""
+
+	def __init__(
+		self, graph, initial_state: str, end_state: str,
+		initial_subtask: Optional[str], milestones: Mapping[str, str]):
+		"""
+		:param graph: TransitionGraph of the dialogue states
+		:param initial_state: state where the dialogues start
+		:param end_state: state where the dialogues end
+		:param initial_subtask: subtask where the dialogues start
+		:param milestones: dict with {state name: subtask it changes to}
+		"""
+		self._graph = graph
+		self._end_state = graph.get_id(end_state) if end_state in graph else None
+		self._subtasks: Tuple[Optional[str], ...] = (None,) + tuple(graph.subtasks)
+		milestone_subtasks = {
+			graph.get_id(state_name): self._get_subtask_index(subtask)
+			for state_name, subtask in milestones.items() if state_name in graph}
+		self._milestones = tuple(sorted(milestone_subtasks))
+
+		# nodes are numbered in breadth first order from the initial node
+		start = (graph.get_id(initial_state), self._get_subtask_index(initial_subtask))
+		node_ids: Dict[Tuple[int, int], int] = {start: 0}
+		nodes = [start]
+		indptr = [0]
+		indices: List[int] = []
+		data: List[float] = []
+		queue = collections.deque([start])
+		while queue:
+			state_id, subtask_index = queue.popleft()
+			if state_id != self._end_state:
+				targets, probabilities = graph.get_distribution(
+					state_id, self._subtasks[subtask_index])
+				if len(targets) > 0 and probabilities.sum() <= 0:
+					# only fixed states had probability, choose evenly
+					probabilities = numpy.full(len(targets), 1 / len(targets))
+				for target, probability in zip(targets, probabilities):
+					if probability <= 0:
+						continue
+					node = (target, milestone_subtasks.get(target, subtask_index))
+					if node not in node_ids:
+						node_ids[node] = len(nodes)
+						nodes.append(node)
+						queue.append(node)
+					indices.append(node_ids[node])
+					data.append(probability)
+			indptr.append(len(indices))
+
+		self._node_states = numpy.array([state_id for state_id, _ in nodes], dtype=numpy.intp)
+		self._indptr = numpy.array(indptr, dtype=numpy.intp)
+		self._indices = numpy.array(indices, dtype=numpy.intp)
+		self._data = numpy.array(data, dtype=numpy.float64)
+		self._rows = numpy.repeat(numpy.arange(len(nodes)), numpy.diff(self._indptr))
+
+		self._is_end = self._node_states == self._end_state
+		self._is_absorbing = numpy.diff(self._indptr) == 0
+		self._is_trapped = ~self._is_absorbing & ~self._get_can_absorb()
+		self._is_stop = self._is_absorbing | self._is_trapped
+
+		# cumulative probabilities of each row shifted by the row number, so
+		# the next node of many walks is found with a single searchsorted()
+		self._cumulative = self._rows + _segment_cumsum(self._data, self._indptr)
+		# most likely next node of each node (-1 if absorbing)
+		self._best_next = numpy.full(len(nodes), -1, dtype=numpy.intp)
+		rows = ~self._is_absorbing
+		self._best_next[rows] = self._indices[
+			self._indptr[:-1][rows] + _segment_argmax(self._data, self._indptr)[rows]]
+
+	def __len__(self) -> int:
+		return len(self._node_states)
+
+	@property
+	def transitions(self) -> int:
+		return len(self._indices)
+
+	def _get_subtask_index(self, subtask: Optional[str]) -> int:
+		# subtasks without states behave like None (see TransitionGraph)
+		return self._subtasks.index(subtask) if subtask in self._subtasks else 0
+
+	def _get_can_absorb(self) -> numpy.ndarray:
+		# breadth first search from the absorbing nodes over the reversed edges
+		order = numpy.argsort(self._indices, kind="stable")
+		sources = self._rows[order]
+		starts = numpy.searchsorted(self._indices[order], numpy.arange(len(self) + 1))
+
+		can_absorb = self._is_absorbing.copy()
+		queue = collections.deque(numpy.flatnonzero(can_absorb).tolist())
+		while queue:
+			node = queue.popleft()
+			for source in sources[starts[node]:starts[node + 1]].tolist():
+				if not can_absorb[source]:
+					can_absorb[source] = True
+					queue.append(source)
+		return can_absorb
+
+	def analyse(self) -> Dict[str, object]:
+		"""
+		Analyses the chain as an absorbing chain. Nodes that can never be
+		absorbed (the dialogue loops forever) are treated as absorbing.
+
+		:return: dict with the expected length of the dialogues (steps until
+			they are absorbed), the probability that they reach the end state
+			and the expected accuracy of the hints, sampled like the Wizard
+			gets them or the most likely one
+		"""
+		transient = ~self._is_stop
+		squared = numpy.bincount(
+			self._rows, weights=self._data ** 2, minlength=len(self))
+		best = numpy.zeros(len(self))
+		best[~self._is_absorbing] = numpy.maximum.reduceat(
+			self._data, self._indptr[:-1][~self._is_absorbing])
+
+		# probability of going from each node to an end node in one step
+		to_end = numpy.bincount(
+			self._rows, weights=self._data * self._is_end[self._indices], minlength=len(self))
+
+		steps, completion, hints, best_hints = self._solve(
+			transient, numpy.stack([numpy.ones(len(self)), to_end, squared, best], axis=1))
+		if self._is_end[0]:
+			completion = 1.0
+
+		return {
+			'nodes': len(self),
+			'transitions': self.transitions,
+			'trapped_nodes': int(self._is_trapped.sum()),
+			'expected_length': float(steps),
+			'completion_probability': float(completion),
+			'hint_accuracy': float(hints / steps) if steps > 0 else None,
+			'best_hint_accuracy': float(best_hints / steps) if steps > 0 else None
+		}
+
+	def _solve(self, transient: numpy.ndarray, rewards: numpy.ndarray) -> numpy.ndarray:
+		"""
+		Gets the expected total reward from the initial node until absorption,
+		solving (I - Q) x = r over the transient nodes.
+
+		:param transient: boolean vector of the transient nodes
+		:param rewards: matrix with a column of rewards per node for each result
+		:return: numpy array with the expected total of each column
+		"""
+		if not transient[0]:
+			return numpy.zeros(rewards.shape[1])
+
+		transient_ids = numpy.flatnonzero(transient)
+		positions = numpy.full(len(self), -1, dtype=numpy.intp)
+		positions[transient_ids] = numpy.arange(len(transient_ids))
+		keep = transient[self._rows] & transient[self._indices]
+		rows = positions[self._rows[keep]]
+		columns = positions[self._indices[keep]]
+		values = self._data[keep]
+		rewards = rewards[transient_ids]
+
+		if scipy is not None:
+			q = scipy.sparse.csr_matrix(
+				(values, (rows, columns)), shape=(len(transient_ids),) * 2)
+			solution = scipy.sparse.linalg.spsolve(
+				(scipy.sparse.identity(len(transient_ids), format='csr') - q).tocsc(), rewards)
+			return numpy.asarray(solution).reshape(len(transient_ids), -1)[0]
+
+		solution = rewards.copy()
+		for _ in range(SOLVE_MAX_ITERATIONS):
+			following = numpy.zeros_like(solution)
+			for column in range(rewards.shape[1]):
+				following[:, column] = numpy.bincount(
+					rows, weights=values * solution[columns, column],
+					minlength=len(transient_ids))
+			previous, solution = solution, rewards + following
+			if numpy.max(numpy.abs(solution - previous)) <= \
+				SOLVE_TOLERANCE * max(1.0, numpy.max(numpy.abs(solution))):
+				break
+		return solution[0]
+
+	def simulate(
+		self, walks: int = DEFAULT_WALKS, max_steps: int = DEFAULT_MAX_STEPS,
+		seed: int = None) -> Dict[str, object]:
+		"""
+		Simulates dialogues as random walks from the initial node, all of them
+		advancing together. Each step also draws a hint like the Wizard gets
+		it and compares it and the most likely state with the actual next state.
+		Walks stop when they are absorbed or trapped (like in analyse()).
+
+		:param walks: number of dialogues to simulate
+		:param max_steps: max number of steps of each dialogue
+		:param seed: seed of the random numbers, for repeatable results
+		:return: dict with the results of the simulated dialogues
+		"""
+		rng = numpy.random.default_rng(seed)
+		positions = numpy.zeros(walks, dtype=numpy.intp)
+		steps = numpy.zeros(walks, dtype=numpy.intp)
+		milestones = numpy.zeros((len(self._milestones), walks), dtype=bool)
+		milestone_states = numpy.array(self._milestones, dtype=numpy.intp)
+		hints = 0
+		best_hints = 0
+
+		active = numpy.flatnonzero(numpy.full(walks, not self._is_stop[0]))
+		for _ in range(max_steps):
+			if len(active) == 0:
+				break
+			nodes = positions[active]
+			following = self._sample(nodes, rng)
+			hints += int(numpy.count_nonzero(self._sample(nodes, rng) == following))
+			best_hints += int(numpy.count_nonzero(self._best_next[nodes] == following))
+
+			positions[active] = following
+			steps[active] += 1
+			following_states = self._node_states[following]
+			for index, state_id in enumerate(milestone_states):
+				milestones[index, active[following_states == state_id]] = True
+			active = active[~self._is_stop[following]]
+
+		ended = self._is_end[positions]
+		dead_ends = self._is_absorbing[positions] & ~ended
+		trapped = self._is_trapped[positions]
+		total_steps = int(steps.sum())
+		return {
+			'walks': walks,
+			'completion_rate': float(ended.mean()) if walks else None,
+			'dead_end_rate': float(dead_ends.mean()) if walks else None,
+			'trapped_rate': float(trapped.mean()) if walks else None,
+			'truncated_rate': len(active) / walks if walks else None,
+			'mean_length': float(steps.mean()) if walks else None,
+			'mean_completed_length': float(steps[ended].mean()) if ended.any() else None,
+			'median_completed_length': float(numpy.median(steps[ended])) if ended.any() else None,
+			'hint_accuracy': hints / total_steps if total_steps else None,
+			'best_hint_accuracy': best_hints / total_steps if total_steps else None,
+			'milestone_rates': {
+				self._graph.get_name(state_id): float(reached.mean()) if walks else None
+				for state_id, reached in zip(self._milestones, milestones)}
+		}
+
+	def _sample(self, nodes: numpy.ndarray, rng: numpy.random.Generator) -> numpy.ndarray:
+		# row r has cumulative probabilities in (r, r + 1], see __init__()
+		choices = numpy.searchsorted(
+			self._cumulative, nodes + rng.random(len(nodes)), side='right')
+		choices = numpy.clip(choices, self._indptr[nodes], self._indptr[nodes + 1] - 1)
+		return self._indices[choices]
+
+
+def _segment_cumsum(values: numpy.ndarray, indptr: numpy.ndarray) -> numpy.ndarray:
+	# cumulative sum that restarts at each segment of indptr
+	cumulative = numpy.cumsum(values)
+	lengths = numpy.diff(indptr)
+	offsets = numpy.concatenate(([0.0], cumulative))[indptr[:-1]]
+	return cumulative - numpy.repeat(offsets, lengths)
+
+
+def _segment_argmax(values: numpy.ndarray, indptr: numpy.ndarray) -> numpy.ndarray:
+	# position of the max of each segment of indptr (0 for empty segments)
+	lengths = numpy.diff(indptr)
+	rows = numpy.repeat(numpy.arange(len(lengths)), lengths)
+	order = numpy.lexsort((-values, rows))
+	result = numpy.zeros(len(lengths), dtype=numpy.intp)
+	non_empty = lengths > 0
+	result[non_empty] = order[indptr[:-1][non_empty]] - indptr[:-1][non_empty]
+	return result
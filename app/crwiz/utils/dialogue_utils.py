@@ -1,5 +1,5 @@
 
-from app.models.log import get_user_logs_for_event
+from app.models.log import get_user_logs_for_event, get_last_user_log_for_event
 
 from . import constants
 
@@ -55,6 +55,12 @@ def get_state_change_log_data(user_id, state_name: str) -> dict:
 	:param state_name: name of the state
 	:return: dict with the log data
 	"""
+	# most of the time it is the current state of the user
+	last_log = get_last_user_log_for_event(
+		user_id, constants.EVENT_FSM_CHANGE_STATE)
+	if last_log is not None and last_log['data']['current_state'] == state_name:
+		return last_log
+
 	state_logs = get_user_logs_for_event(user_id, constants.EVENT_FSM_CHANGE_STATE)
 
 	for log in state_logs:
@@ -69,5 +75,5 @@ def get_user_dialogue_state(user_id) -> str:
 	:param user_id: id of the user (wizard id)
 	:return: name of the state
 	"""
-	return get_user_logs_for_event(
-		user_id, constants.EVENT_FSM_CHANGE_STATE)[0]['data']['current_state']
+	return get_last_user_log_for_event(
+		user_id, constants.EVENT_FSM_CHANGE_STATE)['data']['current_state']
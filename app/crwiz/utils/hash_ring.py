@@ -0,0 +1,90 @@
+"""
+hash_ring
+---------
+
+Consistent hash ring to decide which worker owns each room. Every worker is
+placed in the ring several times (virtual nodes), so the rooms are spread
+evenly and adding or removing a worker only moves the rooms of that worker.
+
+The TaskManager builds one from the INSTANCES setting when it starts (the
+workers of the ring are instances there, each one with its own processes),
+and answers the requests about rooms owned by other instances with a 421
+(see TaskManager.owns_room()), so they must be restarted to change them.
+"""
+
+import bisect
+import hashlib
+from typing import Iterable, List, Optional, Tuple
+
+
+# virtual nodes of each worker in the ring
+DEFAULT_REPLICAS = 100
+
+
+def _hash(key: str) -> int:
+	# md5 is not used for security here, only to spread the keys evenly
+	return int.from_bytes(hashlib.md5(key.encode("utf-8")).digest()[:8], "big")
+
+
+class HashRing:
+	"""
+	Maps keys (room names) to workers. The same set of workers always gives
+	the same mapping, regardless of the order they were added in.
+	"""
+
+	def __init__(self, workers: Iterable[str] = (), replicas: int = DEFAULT_REPLICAS):
+		self._replicas = replicas
+		self._workers: List[str] = []
+		self._ring: List[Tuple[int, str]] = []
+		self._hashes: List[int] = []
+		for worker in workers:
+			self.add_worker(worker)
+
+	def __len__(self) -> int:
+		return len(self._workers)
+
+	def __contains__(self, worker: str) -> bool:
+		return worker in self._workers
+
+	@property
+	def workers(self) -> List[str]:
+		return list(self._workers)
+
+	def add_worker(self, worker: str):
+		"""
+		Adds a worker to the ring.
+
+		:param worker: id of the worker
+		:return: None
+		"""
+		if worker in self._workers:
+			return
+		self._workers.append(worker)
+		for replica in range(self._replicas):
+			bisect.insort(self._ring, (_hash(f"{worker}#{replica}"), worker))
+		self._hashes = [node_hash for node_hash, _ in self._ring]
+
+	def remove_worker(self, worker: str):
+		"""
+		Removes a worker from the ring (e.g. when it is drained).
+
+		:param worker: id of the worker
+		:return: None
+		"""
+		if worker not in self._workers:
+			return
+		self._workers.remove(worker)
+		self._ring = [node for node in self._ring if node[1] != worker]
+		self._hashes = [node_hash for node_hash, _ in self._ring]
+
+	def get_worker(self, key: str) -> Optional[str]:
+		"""
+		Gets the worker that owns a key, the first one clockwise in the ring.
+
+		:param key: key to look up (e.g. room name)
+		:return: id of the worker or None if the ring is empty
+		"""
+		if not self._ring:
+			return None
+		index = bisect.bisect(self._hashes, _hash(key)) % len(self._ring)
+		return self._ring[index][1]
@@ -1,9 +1,12 @@
 
+import os
 import re
 import time
+import socket
 # import calendar
 # import datetime
 from logging import getLogger
+from typing import Iterable, List, Optional, Pattern, Tuple
 
 
 def get_unix_timestamp() -> float:
@@ -11,27 +14,137 @@ def get_unix_timestamp() -> float:
 	return time.time()
 
 
-def match_utterance_to_state_formulation(utterance, state_formulation) -> bool:
-	regex1 = re.compile(r"\[.*\]+", re.IGNORECASE)
-	regex2 = re.compile(r"{[^}]+}", re.IGNORECASE)
-	regex3 = re.compile(r"\s*<[^>]+>\s*", re.IGNORECASE)
+def get_worker_id() -> str:
+	"""
+	Gets the id of this worker process, unique across machines.
+
+	:return: str with hostname-pid
+	"""
+	return f"{socket.gethostname()}-{os.getpid()}"
+
+
+def is_worker_stopped(worker_id: str) -> bool:
+	"""
+	Checks whether a worker from get_worker_id() has stopped. Only the
+	workers of this machine can be checked, the others are assumed alive.
+
+	:param worker_id: id of the worker (hostname-pid)
+	:return: bool
+	"""
+	hostname, _, pid = worker_id.rpartition("-")
+	if hostname != socket.gethostname() or not pid.isdigit():
+		return False
+	try:
+		os.kill(int(pid), 0)
+	except ProcessLookupError:
+		return True
+	except OSError:
+		pass
+	return False
+
 
-	state_formulation = re.sub(regex1, r".*", state_formulation)
+_REGEX_OPTIONAL = re.compile(r"\[.*\]+", re.IGNORECASE)
+_REGEX_SLOT = re.compile(r"{[^}]+}", re.IGNORECASE)
+_REGEX_TAG = re.compile(r"\s*<[^>]+>\s*", re.IGNORECASE)
+
+
+def formulation_to_pattern(state_formulation: str) -> str:
+	"""
+	Transforms a state formulation into a regex pattern, so the slots
+	(e.g. {robot.name}) and optional parts match any text.
+
+	:param state_formulation: formulation of a dialogue state
+	:return: str with the pattern, without anchors
+	"""
+	state_formulation = re.sub(_REGEX_OPTIONAL, r".*", state_formulation)
 	state_formulation = re.sub(r"{area}", r".*", state_formulation)
 	state_formulation = re.sub(r"{robot.name}", r"([^\\s]*|.*[0-9])", state_formulation)
-	state_formulation = re.sub(regex2, r"[^\\s]*", state_formulation)
-	state_formulation = re.sub(regex3, r".*", state_formulation)
+	state_formulation = re.sub(_REGEX_SLOT, r"[^\\s]*", state_formulation)
+	state_formulation = re.sub(_REGEX_TAG, r".*", state_formulation)
 	state_formulation = state_formulation.replace("?", r"\?")
 
-	if re.match(regex2, state_formulation) or re.match(regex3, state_formulation):
+	if re.match(_REGEX_SLOT, state_formulation) or re.match(_REGEX_TAG, state_formulation):
 		getLogger("orca-slurk").warning(
-			f"Issue matching instances: {state_formulation} vs {utterance}")
+			f"Issue matching instances: {state_formulation}")
+
+	return state_formulation.strip()
+
+
+def compile_formulation(state_formulation: str) -> Optional[Pattern]:
+	"""
+	Compiles a state formulation into a regex that matches whole utterances.
+	To match many utterances, keep the regex or use a FormulationMatcher.
 
-	# print(f"matching {state_formulation} to {utterance}")
+	:param state_formulation: formulation of a dialogue state
+	:return: compiled regex or None if the formulation is not a valid regex
+	"""
+	pattern = formulation_to_pattern(state_formulation)
 	try:
-		return bool(re.match(
-			f"^{state_formulation.strip()}$", utterance.strip(), re.IGNORECASE))
-	except Exception as ex:
+		return re.compile(f"^{pattern}$", re.IGNORECASE)
+	except re.error as ex:
 		getLogger("orca-slurk").exception(
-			f"Exception when trying to match '{state_formulation}' "
-			f"to '{utterance}: {ex}")
+			f"Exception when trying to compile '{pattern}': {ex}")
+		return None
+
+
+def match_utterance_to_state_formulation(utterance, state_formulation) -> bool:
+	regex = compile_formulation(state_formulation)
+	return regex is not None and bool(regex.match(utterance.strip()))
+
+
+class FormulationMatcher:
+	"""
+	Matches utterances to a list of formulations in one pass, with a single
+	regex that has an alternative for each formulation. The first formulation
+	(in the order given) that matches the whole utterance is returned.
+	The regex is compiled when the matcher is built, e.g. with the states
+	of a knowledge base, so matching an utterance never compiles anything.
+	"""
+
+	def __init__(self, formulations: Iterable[Tuple[str, str]]):
+		"""
+		:param formulations: tuples with a key (e.g. state name) and a formulation
+		"""
+		self._formulations: List[Tuple[str, str]] = []
+		# regex of each formulation, to match them one by one if they cannot be joined
+		self._regexes: List[Pattern] = []
+		self._regex: Optional[Pattern] = None
+
+		alternatives = []
+		for key, formulation in formulations:
+			regex = compile_formulation(formulation)
+			if regex is None:
+				continue
+			# each alternative is anchored, like the regex of compile_formulation
+			alternatives.append(f"(?P<f{len(self._formulations)}>{regex.pattern})")
+			self._formulations.append((key, formulation))
+			self._regexes.append(regex)
+
+		if alternatives:
+			try:
+				self._regex = re.compile("|".join(alternatives), re.IGNORECASE)
+			except re.error:
+				# e.g. inline flags in a formulation, match them one by one
+				self._regex = None
+
+	def __len__(self) -> int:
+		return len(self._formulations)
+
+	def match(self, utterance: str) -> Optional[Tuple[str, str]]:
+		"""
+		Finds the formulation that matches an utterance.
+
+		:param utterance: text to match
+		:return: tuple with the key and the formulation or None if none matches
+		"""
+		utterance = utterance.strip()
+		if self._regex is not None:
+			match = self._regex.match(utterance)
+			if match is None:
+				return None
+			return self._formulations[int(match.lastgroup[1:])]
+
+		for formulation, regex in zip(self._formulations, self._regexes):
+			if regex.match(utterance):
+				return formulation
+		return None
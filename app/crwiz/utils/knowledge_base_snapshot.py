@@ -0,0 +1,458 @@
+"""
+knowledge_base_snapshot
+-----------------------
+
+Compiled snapshot of the dialogue state files, so they can be loaded without
+parsing YAML. The snapshot is a flat binary file (no pickle), little-endian:
+
+- header: magic, format version, counts and CRC32 of the rest of the file
+- string table: offsets (uint32) followed by the UTF-8 strings
+- files: name, mtime, size and SHA1 of each YAML file it was built from
+- states: fixed-size records pointing to ranges of the tables below
+- formulations, transitions and probabilities: arrays of string ids (and floats)
+
+It is read through mmap, and it is only used if the YAML files did not change
+since it was built (same names, mtimes and sizes).
+
+It only saves parsing the YAML files: the states are stored as they are in
+them, and all of them are decoded when the snapshot is loaded. The transition
+graph, the formulation matchers and the state classifier are built from the
+states afterwards, like when they are loaded from YAML, since they need all
+the states at once and compiled regexes cannot be stored in the file.
+
+Build it with: python -m knowledge_base.snapshot build
+
+DialogueStateLoader.load() falls back to the YAML files if the snapshot is
+out of date or raises a SnapshotError.
+"""
+
+import os
+import json
+import mmap
+import time
+import zlib
+import struct
+import hashlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple, Union
+
+import yaml
+
+
+SNAPSHOT_MAGIC = b"CRWIZKB\x00"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_EXTENSION = ".snapshot"
+
+# magic, version, files, states, strings, formulations, transitions, probabilities, crc32
+_HEADER = struct.Struct("<8sIIIIIIII")
+# name, mtime_ns, size, sha1
+_FILE = struct.Struct("<Iqq20s")
+# file, name, subtask (or _NONE), is_fixed, slots (JSON),
+# (start, count) of formulations, transitions and probabilities
+_STATE = struct.Struct("<IIIBxxxIIIIIII")
+# state name and probability
+_PROBABILITY = struct.Struct("<Id")
+_UINT32 = struct.Struct("<I")
+
+_NONE = 0xFFFFFFFF
+
+# the C loader is much faster, if PyYAML was built with libyaml
+_SafeLoader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+# files are only parsed in parallel if there are enough to pay off starting the processes
+PARALLEL_MIN_FILES = 64
+
+
+class SnapshotError(ValueError):
+	"""
+	The snapshot cannot be read (e.g. it is corrupted or from another version).
+	"""
+
+
+class StateFileError(ValueError):
+	"""
+	A dialogue state file cannot be parsed.
+	"""
+
+
+def get_snapshot_path(folder_path: str) -> str:
+	"""
+	Gets the default path of the snapshot of a folder, next to the folder.
+
+	:param folder_path: folder with the dialogue state files
+	:return: str with the path
+	"""
+	return os.path.normpath(folder_path) + SNAPSHOT_EXTENSION
+
+
+def parse_state_file(file_name: str, content: bytes) -> List[dict]:
+	"""
+	Parses the content of a YAML file into the properties of the states that
+	it defines. Files named fixed_states* have several fixed states with
+	{name: formulation}, the rest have a single state.
+
+	:param file_name: name of the file
+	:param content: content of the file
+	:return: list of dicts with the state properties
+	"""
+	properties = yaml.load(content, Loader=_SafeLoader)
+	if file_name.startswith('fixed_states'):
+		return [{
+			'name': name,
+			'formulations': [formulation],
+			'transition_states': [],
+			'transition_probabilities': {},
+			'subtask': None,
+			'slots': [],
+			'is_fixed': True
+		} for name, formulation in properties.items()]
+
+	return [{
+		'name': properties['name'],
+		'formulations': properties.get('formulations') or [],
+		'transition_states': properties.get('transition_states') or [],
+		'transition_probabilities': dict(properties.get('transition_probabilities') or {}),
+		'subtask': properties.get('subtask'),
+		'slots': properties.get('slots') or [],
+		'is_fixed': False
+	}]
+
+
+def _parse_state_file(file: Tuple[str, bytes]) -> Union[List[dict], StateFileError]:
+	# runs in the processes of parse_state_files(), errors are sent back as values
+	try:
+		return parse_state_file(*file)
+	except (yaml.YAMLError, KeyError, TypeError, AttributeError) as ex:
+		return StateFileError(f"{type(ex).__name__}: {ex}")
+
+
+def parse_state_files(
+	files: Sequence[Tuple[str, bytes]],
+	processes: Optional[int] = 1) -> List[Union[List[dict], StateFileError]]:
+	"""
+	Parses several YAML files (see parse_state_file()), in a pool of processes
+	if there are enough of them. The pool is only meant for the offline tools
+	(e.g. building the snapshot): its processes are spawned, so they do not
+	inherit gevent or the app, and they import this module by itself.
+
+	:param files: tuples with the name and content of each file
+	:param processes: max number of processes, None for the number of CPUs,
+		1 to parse them in this process (e.g. in the app)
+	:return: list aligned with files, with the state properties of each file
+		or a StateFileError if it could not be parsed
+	"""
+	processes = min(processes or os.cpu_count() or 1, len(files))
+	if processes <= 1 or len(files) < PARALLEL_MIN_FILES:
+		return [_parse_state_file(file) for file in files]
+
+	try:
+		with ProcessPoolExecutor(
+				processes, mp_context=multiprocessing.get_context("spawn")) as executor:
+			return list(executor.map(
+				_parse_state_file, files, chunksize=-(-len(files) // processes)))
+	except (OSError, BrokenProcessPool):
+		# e.g. processes cannot be started here, parse them in this process
+		return [_parse_state_file(file) for file in files]
+
+
+def list_state_files(folder_path: str) -> List[str]:
+	"""
+	Lists the YAML files of a folder, in the order they are merged.
+
+	:param folder_path: folder with the dialogue state files
+	:return: sorted list of file names
+	"""
+	return sorted(file for file in os.listdir(folder_path) if file.endswith('.yaml'))
+
+
+class Snapshot:
+	"""
+	Snapshot read through mmap. Strings are only decoded when they are used.
+	"""
+
+	def __init__(self, path: str):
+		self._path = path
+		with open(path, 'rb') as f:
+			try:
+				self._buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+			except ValueError:
+				raise SnapshotError(f"Snapshot '{path}' is empty")
+
+		if len(self._buffer) < _HEADER.size:
+			raise SnapshotError(f"Snapshot '{path}' is truncated")
+		magic, version, self._n_files, self._n_states, n_strings, n_formulations, \
+			n_transitions, n_probabilities, crc = _HEADER.unpack_from(self._buffer, 0)
+		if magic != SNAPSHOT_MAGIC:
+			raise SnapshotError(f"'{path}' is not a knowledge base snapshot")
+		if version != SNAPSHOT_VERSION:
+			raise SnapshotError(
+				f"Snapshot '{path}' has version {version}, expected {SNAPSHOT_VERSION}")
+		with memoryview(self._buffer) as view, view[_HEADER.size:] as body:
+			crc_body = zlib.crc32(body)
+		if crc_body != crc:
+			raise SnapshotError(f"Snapshot '{path}' is corrupted")
+
+		# offsets of each section
+		self._string_offsets = _HEADER.size
+		self._strings = self._string_offsets + (n_strings + 1) * _UINT32.size
+		strings_size = _UINT32.unpack_from(
+			self._buffer, self._string_offsets + n_strings * _UINT32.size)[0]
+		self._files = self._strings + strings_size
+		self._states = self._files + self._n_files * _FILE.size
+		self._formulations = self._states + self._n_states * _STATE.size
+		self._transitions = self._formulations + n_formulations * _UINT32.size
+		self._probabilities = self._transitions + n_transitions * _UINT32.size
+		if self._probabilities + n_probabilities * _PROBABILITY.size != len(self._buffer):
+			raise SnapshotError(f"Snapshot '{path}' is truncated")
+
+	def __len__(self) -> int:
+		return self._n_states
+
+	@property
+	def path(self) -> str:
+		return self._path
+
+	def close(self):
+		self._buffer.close()
+
+	def _get_string(self, string_id: int) -> Optional[str]:
+		if string_id == _NONE:
+			return None
+		start, end = struct.unpack_from(
+			"<II", self._buffer, self._string_offsets + string_id * _UINT32.size)
+		return self._buffer[self._strings + start:self._strings + end].decode('utf-8')
+
+	def _get_strings(self, section: int, start: int, count: int) -> List[str]:
+		return [
+			self._get_string(string_id) for string_id, in
+			struct.iter_unpack("<I", self._buffer[
+				section + start * _UINT32.size:section + (start + count) * _UINT32.size])]
+
+	def get_files(self) -> List[Tuple[str, int, int, str]]:
+		"""
+		Gets the YAML files the snapshot was built from.
+
+		:return: list of tuples with the name, mtime_ns, size and SHA1 (hex)
+		"""
+		files = []
+		for index in range(self._n_files):
+			name_id, mtime_ns, size, sha1 = _FILE.unpack_from(
+				self._buffer, self._files + index * _FILE.size)
+			files.append((self._get_string(name_id), mtime_ns, size, sha1.hex()))
+		return files
+
+	def get_states(self) -> List[Tuple[str, dict]]:
+		"""
+		Gets the properties of the states (see parse_state_file()).
+
+		:return: list of tuples with the name of their file and the properties
+		"""
+		file_names = [file[0] for file in self.get_files()]
+		states = []
+		for index in range(self._n_states):
+			file_index, name_id, subtask_id, is_fixed, slots_id, \
+				formulations_start, formulations_count, \
+				transitions_start, transitions_count, \
+				probabilities_start, probabilities_count = _STATE.unpack_from(
+					self._buffer, self._states + index * _STATE.size)
+
+			start = self._probabilities + probabilities_start * _PROBABILITY.size
+			probabilities = {
+				self._get_string(string_id): probability
+				for string_id, probability in _PROBABILITY.iter_unpack(self._buffer[
+					start:start + probabilities_count * _PROBABILITY.size])}
+
+			states.append((file_names[file_index], {
+				'name': self._get_string(name_id),
+				'formulations': self._get_strings(
+					self._formulations, formulations_start, formulations_count),
+				'transition_states': self._get_strings(
+					self._transitions, transitions_start, transitions_count),
+				'transition_probabilities': probabilities,
+				'subtask': self._get_string(subtask_id),
+				'slots': json.loads(self._get_string(slots_id)),
+				'is_fixed': bool(is_fixed)
+			}))
+		return states
+
+	def is_fresh(self, folder_path: str) -> bool:
+		"""
+		Checks whether the YAML files are the same ones the snapshot was built
+		from, comparing their names, modification times and sizes.
+
+		:param folder_path: folder with the dialogue state files
+		:return: True if the snapshot can be used instead of the files
+		"""
+		files = self.get_files()
+		if [file[0] for file in files] != list_state_files(folder_path):
+			return False
+		for name, mtime_ns, size, _ in files:
+			stat = os.stat(os.path.join(folder_path, name))
+			if (stat.st_mtime_ns, stat.st_size) != (mtime_ns, size):
+				return False
+		return True
+
+
+def read_snapshot(path: str) -> Snapshot:
+	"""
+	Opens a snapshot.
+
+	:param path: path of the snapshot
+	:return: Snapshot
+	:raises SnapshotError: if the snapshot cannot be read
+	"""
+	return Snapshot(path)
+
+
+def write_snapshot(
+	path: str, files: Iterable[Tuple[str, int, int, str, List[dict]]]) -> int:
+	"""
+	Writes a snapshot, replacing the previous one atomically.
+
+	:param path: path of the snapshot
+	:param files: tuples with the name, mtime_ns, size, SHA1 (hex)
+		and list of state properties of each file
+	:return: number of states written
+	"""
+	strings: Dict[str, int] = {}
+
+	def string_id(value: Optional[str]) -> int:
+		if value is None:
+			return _NONE
+		return strings.setdefault(str(value), len(strings))
+
+	file_records = []
+	state_records = []
+	formulations: List[int] = []
+	transitions: List[int] = []
+	probabilities: List[Tuple[int, float]] = []
+	for file_index, (name, mtime_ns, size, sha1, states) in enumerate(files):
+		file_records.append(_FILE.pack(string_id(name), mtime_ns, size, bytes.fromhex(sha1)))
+		for state in states:
+			state_records.append(_STATE.pack(
+				file_index, string_id(state['name']), string_id(state['subtask']),
+				state['is_fixed'], string_id(json.dumps(state['slots'], default=str)),
+				len(formulations), len(state['formulations']),
+				len(transitions), len(state['transition_states']),
+				len(probabilities), len(state['transition_probabilities'])))
+			formulations.extend(string_id(formulation) for formulation in state['formulations'])
+			transitions.extend(string_id(transition) for transition in state['transition_states'])
+			probabilities.extend(
+				(string_id(transition), float(probability))
+				for transition, probability in state['transition_probabilities'].items())
+
+	encoded_strings = [value.encode('utf-8') for value in strings]
+	string_offsets = [0]
+	for value in encoded_strings:
+		string_offsets.append(string_offsets[-1] + len(value))
+
+	body = b"".join([
+		struct.pack(f"<{len(string_offsets)}I", *string_offsets),
+		*encoded_strings,
+		*file_records,
+		*state_records,
+		struct.pack(f"<{len(formulations)}I", *formulations),
+		struct.pack(f"<{len(transitions)}I", *transitions),
+		*(_PROBABILITY.pack(*probability) for probability in probabilities)
+	])
+	header = _HEADER.pack(
+		SNAPSHOT_MAGIC, SNAPSHOT_VERSION, len(file_records), len(state_records),
+		len(strings), len(formulations), len(transitions), len(probabilities),
+		zlib.crc32(body))
+
+	with open(f"{path}.tmp", 'wb') as f:
+		f.write(header)
+		f.write(body)
+	os.replace(f"{path}.tmp", path)
+	return len(state_records)
+
+
+def build_snapshot(
+	folder_path: str, path: str = None,
+	processes: Optional[int] = None) -> Tuple[str, int, float]:
+	"""
+	Parses the YAML files of a folder and writes them into a snapshot.
+
+	:param folder_path: folder with the dialogue state files
+	:param path: path of the snapshot, None for get_snapshot_path(folder_path)
+	:param processes: max number of processes to parse the files (see parse_state_files())
+	:return: tuple with the path, number of states and seconds it took
+	:raises StateFileError: if a file cannot be parsed
+	"""
+	start_time = time.perf_counter()
+	path = path or get_snapshot_path(folder_path)
+
+	files = []
+	contents = []
+	for name in list_state_files(folder_path):
+		file_path = os.path.join(folder_path, name)
+		stat = os.stat(file_path)
+		with open(file_path, 'rb') as f:
+			content = f.read()
+		files.append((name, stat.st_mtime_ns, stat.st_size, hashlib.sha1(content).hexdigest()))
+		contents.append((name, content))
+
+	file_states = parse_state_files(contents, processes)
+	for (name, *_), states in zip(files, file_states):
+		if isinstance(states, StateFileError):
+			raise StateFileError(f"Cannot parse '{name}': {states}")
+	files = [(*file, states) for file, states in zip(files, file_states)]
+
+	states = write_snapshot(path, files)
+	return path, states, time.perf_counter() - start_time
+
+
+def verify_snapshot(folder_path: str, path: str = None) -> List[str]:
+	"""
+	Checks that a snapshot can be read and has the same states as the YAML files.
+
+	:param folder_path: folder with the dialogue state files
+	:param path: path of the snapshot, None for get_snapshot_path(folder_path)
+	:return: list with the problems found, empty if there are none
+	"""
+	path = path or get_snapshot_path(folder_path)
+	try:
+		snapshot = read_snapshot(path)
+	except (OSError, SnapshotError) as ex:
+		return [str(ex)]
+
+	problems = []
+	try:
+		if not snapshot.is_fresh(folder_path):
+			problems.append("The YAML files changed since the snapshot was built")
+
+		snapshot_states: Dict[str, List[dict]] = {}
+		for file_name, state in snapshot.get_states():
+			snapshot_states.setdefault(file_name, []).append(state)
+
+		file_hashes = {file[0]: file[3] for file in snapshot.get_files()}
+		for name in list_state_files(folder_path):
+			with open(os.path.join(folder_path, name), 'rb') as f:
+				content = f.read()
+			if name not in file_hashes:
+				problems.append(f"File '{name}' is not in the snapshot")
+			elif hashlib.sha1(content).hexdigest() != file_hashes[name]:
+				problems.append(f"File '{name}' has different content")
+			elif _normalise_states(parse_state_file(name, content)) != \
+					_normalise_states(snapshot_states.get(name, [])):
+				problems.append(f"States of file '{name}' do not match the snapshot")
+	finally:
+		snapshot.close()
+
+	return problems
+
+
+def _normalise_states(states: List[dict]) -> List[dict]:
+	# like the states after a round trip through a snapshot
+	return [{
+		**state,
+		'name': str(state['name']),
+		'formulations': [str(formulation) for formulation in state['formulations']],
+		'transition_states': [str(transition) for transition in state['transition_states']],
+		'transition_probabilities': {
+			str(transition): float(probability)
+			for transition, probability in state['transition_probabilities'].items()},
+		'subtask': str(state['subtask']) if state['subtask'] is not None else None,
+		'slots': json.loads(json.dumps(state['slots'], default=str)),
+	} for state in states]
@@ -0,0 +1,307 @@
+"""
+knowledge_base_validator
+------------------------
+
+Static checks of the dialogue states, so problems in the knowledge base are
+found before deploying it instead of in the middle of a dialogue:
+
+- transitions and probabilities that reference states that do not exist
+- probabilities that are negative or do not sum to 1
+- entries of STATES_WITH_PROBABILITY_MAPPING that do not resolve
+- states that cannot be reached from the initial state
+- dead ends and states from which the end of the dialogue cannot be reached
+
+The dialogue is analysed as a graph of (state, subtask) nodes, since the
+transitions available depend on the subtask and the milestone states change
+it (see ActiveRoom.check_state_for_milestones()). Every analysis is a breadth
+first search over that graph, so it takes linear time in the number of
+transitions.
+
+Run it with: python -m knowledge_base.validate
+"""
+
+import collections
+from typing import Dict, Iterable, List, Mapping, Optional, Set, Tuple
+
+
+INITIAL_STATE = 'start'
+END_STATE = 'inform_end'
+INITIAL_SUBTASK = 'introduction'
+# states that change the subtask when reached, see ActiveRoom.check_state_for_milestones()
+SUBTASK_MILESTONES = {'trigger_subtask': 'finish'}
+
+# difference allowed between the sum of the probabilities of a state and 1
+PROBABILITY_TOLERANCE = 1e-6
+
+LEVEL_ERROR = 'error'
+LEVEL_WARNING = 'warning'
+
+Node = Tuple[str, Optional[str]]
+
+
+class Issue:
+	"""
+	Problem found in the knowledge base.
+	"""
+
+	def __init__(self, level: str, message: str, state_name: str = None, file_name: str = None):
+		self.level = level
+		self.message = message
+		self.state_name = state_name
+		self.file_name = file_name
+
+	def __str__(self) -> str:
+		location = ":".join(
+			str(part) for part in (self.file_name, self.state_name) if part is not None)
+		return f"{self.level.upper()} {location}: {self.message}" if location \
+			else f"{self.level.upper()}: {self.message}"
+
+
+class ValidationReport:
+	"""
+	Issues and metrics of a knowledge base.
+	"""
+
+	def __init__(self):
+		self.issues: List[Issue] = []
+		self.metrics: Dict[str, object] = {}
+
+	@property
+	def errors(self) -> List[Issue]:
+		return [issue for issue in self.issues if issue.level == LEVEL_ERROR]
+
+	@property
+	def warnings(self) -> List[Issue]:
+		return [issue for issue in self.issues if issue.level == LEVEL_WARNING]
+
+	def add(self, level: str, message: str, state_name: str = None, file_name: str = None):
+		self.issues.append(Issue(level, message, state_name, file_name))
+
+
+class StateGraph:
+	"""
+	Graph of (state, subtask) nodes of a knowledge base. Transitions to a state
+	with a subtask are only available in that subtask, whereas transitions to
+	a state without subtask are available in all of them (like TransitionGraph).
+	"""
+
+	def __init__(
+		self, states: Mapping[str, dict],
+		milestones: Mapping[str, str] = None):
+		"""
+		:param states: dict with {state name: properties} (see parse_state_file())
+		:param milestones: dict with {state name: subtask it changes to}
+		"""
+		self._states = states
+		self._milestones = dict(SUBTASK_MILESTONES if milestones is None else milestones)
+		self._successors: Dict[Node, List[Node]] = {}
+
+	def get_successors(self, node: Node) -> List[Node]:
+		"""
+		Gets the nodes that can follow a node.
+
+		:param node: tuple with the state name and current subtask
+		:return: list of nodes
+		"""
+		successors = self._successors.get(node)
+		if successors is not None:
+			return successors
+
+		state_name, subtask = node
+		successors = []
+		for target in self._states[state_name]['transition_states']:
+			if target not in self._states:
+				continue
+			target_subtask = self._states[target]['subtask']
+			if target_subtask is None or target_subtask == subtask:
+				successors.append((target, self._milestones.get(target, subtask)))
+		self._successors[node] = successors
+		return successors
+
+	def search(self, start: Node) -> Dict[Node, int]:
+		"""
+		Breadth first search from a node.
+
+		:param start: node to start from
+		:return: dict with {node: distance from start} of the reachable nodes
+		"""
+		distances = {start: 0}
+		queue = collections.deque([start])
+		while queue:
+			node = queue.popleft()
+			for successor in self.get_successors(node):
+				if successor not in distances:
+					distances[successor] = distances[node] + 1
+					queue.append(successor)
+		return distances
+
+	def search_backwards(self, targets: Iterable[Node], nodes: Iterable[Node]) -> Dict[Node, int]:
+		"""
+		Breadth first search over the reversed edges, to get the distance
+		from each node to the closest target.
+
+		:param targets: nodes to reach
+		:param nodes: nodes of the graph to consider
+		:return: dict with {node: distance to a target} of the nodes that reach one
+		"""
+		predecessors: Dict[Node, List[Node]] = collections.defaultdict(list)
+		for node in nodes:
+			for successor in self.get_successors(node):
+				predecessors[successor].append(node)
+
+		distances = {target: 0 for target in targets}
+		queue = collections.deque(distances.keys())
+		while queue:
+			node = queue.popleft()
+			for predecessor in predecessors[node]:
+				if predecessor not in distances:
+					distances[predecessor] = distances[node] + 1
+					queue.append(predecessor)
+		return distances
+
+
+def validate_states(
+	file_states: Iterable[Tuple[str, List[dict]]],
+	probability_mapping: Mapping[str, str] = None,
+	initial_state: str = INITIAL_STATE, end_state: str = END_STATE,
+	initial_subtask: str = INITIAL_SUBTASK,
+	milestones: Mapping[str, str] = None) -> ValidationReport:
+	"""
+	Validates the states of a knowledge base and computes metrics of its graph.
+
+	:param file_states: tuples with the file name and the properties of its
+		states (see parse_state_file()), in the order they are merged
+	:param probability_mapping: STATES_WITH_PROBABILITY_MAPPING to check
+	:param initial_state: state where the dialogues start
+	:param end_state: state where the dialogues end
+	:param initial_subtask: subtask where the dialogues start
+	:param milestones: dict with {state name: subtask it changes to}
+	:return: ValidationReport
+	"""
+	report = ValidationReport()
+
+	# merge the files like the app does, the last state with a name wins
+	states: Dict[str, dict] = {}
+	state_files: Dict[str, str] = {}
+	for file_name, properties in file_states:
+		for state in properties:
+			if state['name'] in states and not state['is_fixed']:
+				report.add(
+					LEVEL_WARNING, f"overwrites the state from '{state_files[state['name']]}'",
+					state['name'], file_name)
+			states[state['name']] = state
+			state_files[state['name']] = file_name
+
+	for state_name, state in states.items():
+		_validate_state(report, states, state, state_files[state_name])
+
+	for state_name, probability_file in (probability_mapping or {}).items():
+		if state_name not in states:
+			report.add(
+				LEVEL_WARNING,
+				f"STATES_WITH_PROBABILITY_MAPPING has unknown state '{state_name}'")
+		elif probability_file not in states and probability_file + '.yaml' not in state_files.values():
+			report.add(
+				LEVEL_WARNING,
+				f"STATES_WITH_PROBABILITY_MAPPING maps to unknown '{probability_file}'",
+				state_name, state_files[state_name])
+
+	for state_name in (initial_state, end_state):
+		if state_name not in states:
+			report.add(LEVEL_ERROR, f"state '{state_name}' does not exist")
+	if initial_state in states:
+		_analyse_graph(
+			report, states, state_files, StateGraph(states, milestones),
+			initial_state, end_state, initial_subtask)
+
+	report.metrics['states'] = len(states)
+	report.metrics['fixed_states'] = sum(state['is_fixed'] for state in states.values())
+	report.metrics['transitions'] = sum(
+		len(state['transition_states']) for state in states.values())
+	report.metrics['max_transitions'] = max(
+		(len(state['transition_states']) for state in states.values()), default=0)
+	return report
+
+
+def _validate_state(report: ValidationReport, states: Mapping[str, dict], state: dict, file_name: str):
+	name = state['name']
+	if not state['is_fixed'] and not state['formulations'] and name != INITIAL_STATE:
+		report.add(LEVEL_WARNING, "has no formulations", name, file_name)
+
+	transitions = state['transition_states']
+	for transition in transitions:
+		if transition not in states:
+			report.add(LEVEL_ERROR, f"transition to unknown state '{transition}'", name, file_name)
+	if len(set(transitions)) != len(transitions):
+		for transition, count in collections.Counter(transitions).items():
+			if count > 1:
+				report.add(LEVEL_WARNING, f"transition to '{transition}' is repeated", name, file_name)
+
+	probabilities = state['transition_probabilities']
+	valid_probabilities = True
+	for transition, probability in probabilities.items():
+		if transition not in states:
+			report.add(
+				LEVEL_ERROR, f"probability for unknown state '{transition}'", name, file_name)
+		elif transition not in transitions:
+			report.add(
+				LEVEL_WARNING, f"probability for '{transition}', which is not a transition",
+				name, file_name)
+		if not isinstance(probability, (int, float)) or probability < 0:
+			valid_probabilities = False
+			report.add(
+				LEVEL_ERROR, f"invalid probability {probability!r} for '{transition}'",
+				name, file_name)
+
+	if transitions and valid_probabilities:
+		total = sum(probabilities.get(transition, 0) for transition in set(transitions))
+		if total == 0:
+			report.add(
+				LEVEL_WARNING, "has no probabilities, its transitions are equally likely",
+				name, file_name)
+		elif abs(total - 1) > PROBABILITY_TOLERANCE:
+			report.add(
+				LEVEL_WARNING, f"probabilities sum to {total:g} instead of 1", name, file_name)
+
+
+def _analyse_graph(
+	report: ValidationReport, states: Mapping[str, dict], state_files: Mapping[str, str],
+	graph: StateGraph, initial_state: str, end_state: str, initial_subtask: str):
+	start = (initial_state, initial_subtask)
+	distances = graph.search(start)
+	reachable: Set[str] = {state_name for state_name, _ in distances}
+
+	for state_name, state in states.items():
+		# fixed states are offered apart from the transitions
+		if state_name not in reachable and not state['is_fixed']:
+			report.add(
+				LEVEL_WARNING, f"cannot be reached from '{initial_state}'",
+				state_name, state_files[state_name])
+
+	# dead ends, in the subtasks where they are reached
+	dead_ends = set()
+	for node in distances:
+		if node[0] != end_state and not graph.get_successors(node):
+			dead_ends.add(node[0])
+	for state_name in sorted(dead_ends):
+		report.add(
+			LEVEL_WARNING, "is a dead end, it has no transitions available",
+			state_name, state_files[state_name])
+
+	end_nodes = [node for node in distances if node[0] == end_state]
+	distances_to_end = graph.search_backwards(end_nodes, distances.keys())
+	if not end_nodes:
+		report.add(LEVEL_ERROR, f"'{end_state}' cannot be reached from '{initial_state}'")
+	else:
+		cannot_end = sorted(
+			{state_name for state_name, _ in distances}.difference(
+				state_name for state_name, _ in distances_to_end))
+		for state_name in cannot_end:
+			report.add(
+				LEVEL_WARNING, f"'{end_state}' cannot be reached from this state",
+				state_name, state_files[state_name])
+
+	report.metrics['reachable_states'] = len(reachable)
+	report.metrics['dead_ends'] = len(dead_ends)
+	report.metrics['shortest_dialogue'] = distances_to_end.get(start)
+	report.metrics['longest_shortest_path_to_end'] = max(distances_to_end.values(), default=None)
@@ -1,14 +1,23 @@
 
+import os
+import gzip
 import json
 import time
 import logging
 import datetime
+import threading
+from typing import Optional
 
 import requests
 
 
 LOG_DIR = "logs/task"
 PARTNER_NOT_FOUND_LOG = "partner_not_found.json"
+# last exported log id per room, see export_room_logs_incremental()
+EXPORT_STATE_FILE = "export_state.json"
+
+# rooms can be exported from several threads, but they share the state file
+_export_lock = threading.Lock()
 
 
 def get_room_logs(uri: str, token: str, room_name: str) -> dict:
@@ -75,6 +84,130 @@ def export_room_logs(uri: str, token: str, room_name: str):
 	export_logs(get_room_logs(uri, token, room_name))
 
 
+def get_room_analysis(uri: str, token: str, room_name: str) -> Optional[dict]:
+	"""
+	Gets the post-task analysis job of a room, with its status.
+
+	:param uri: uri of the host (e.g. localhost:5000/api/v2/)
+	:param token: token of the entity that is retrieving the analysis
+	:param room_name: name of the room
+	:return: dict with the job or None if the room is not queued yet
+	"""
+	try:
+		response = requests.get(
+			f"{uri}/room/{room_name}/analysis",
+			headers={'Authorization': f"Token {token}"}, timeout=10)
+	except requests.RequestException as e:
+		logging.warning(f"Could not get the analysis of room '{room_name}': {e}")
+		return None
+
+	if not response.ok:
+		if response.status_code != 404:
+			logging.warning(
+				f"Could not get the analysis of room '{room_name}': {response.status_code}")
+		return None
+	return response.json()
+
+
+def check_health(uri: str) -> bool:
+	"""
+	Checks that the server (and its database) is up. It is cheap enough
+	to be used as a keepalive.
+
+	:param uri: uri of the host (e.g. localhost:5000/api/v2/)
+	:return: True if the server is healthy
+	"""
+	try:
+		response = requests.get(f"{uri}/health", timeout=10)
+	except requests.RequestException as e:
+		logging.warning(f"Could not check the health of the server: {e}")
+		return False
+
+	if not response.ok:
+		logging.warning(f"Server is not healthy: {response.status_code}")
+	return response.ok
+
+
+def _load_export_state() -> dict:
+	try:
+		with open(f"{LOG_DIR}/{EXPORT_STATE_FILE}") as json_file:
+			return json.load(json_file)
+	except (FileNotFoundError, json.decoder.JSONDecodeError):
+		return {}
+
+
+def _save_export_state(export_state: dict):
+	# write to a temporary file first so the state is never half written
+	filename = f"{LOG_DIR}/{EXPORT_STATE_FILE}"
+	with open(f"{filename}.tmp", "w", encoding="utf-8") as f:
+		json.dump(export_state, f)
+	os.replace(f"{filename}.tmp", filename)
+
+
+def export_room_logs_incremental(
+		uri: str, token: str, room_name: str, compress: bool = False) -> int:
+	"""
+	Exports the logs of a room that have not been exported yet, appending
+	them as JSON Lines to logs/task/log_<room_name>.ndjson (.ndjson.gz if
+	compressed). The last exported log id of each room is kept in
+	EXPORT_STATE_FILE, so calling this again only fetches the new logs.
+
+	:param uri: uri of the host (e.g. localhost:5000/api/v2/)
+	:param token: token of the entity that is retrieving the logs
+	:param room_name: name of the room to export the logs
+	:param compress: whether to write the logs with gzip
+	:return: number of logs exported
+	"""
+	with _export_lock:
+		return _export_room_logs_incremental(uri, token, room_name, compress)
+
+
+def _export_room_logs_incremental(
+		uri: str, token: str, room_name: str, compress: bool) -> int:
+	export_state = _load_export_state()
+	since_id = export_state.get(room_name)
+
+	params = {'since_id': since_id} if since_id is not None else {}
+	response = requests.get(
+		f"{uri}/room/{room_name}/logs/stream", params=params, stream=True,
+		headers={'Authorization': f"Token {token}"})
+	if not response.ok:
+		logging.warning(f"Could not get logs for room '{room_name}'")
+		return 0
+
+	filename = f"{LOG_DIR}/log_{room_name}.ndjson"
+	if compress:
+		log_file = gzip.open(f"{filename}.gz", "ab")
+	else:
+		log_file = open(filename, "ab")
+
+	exported = 0
+	# id of the last log written to the file
+	last_id = None
+	try:
+		with log_file:
+			for line in response.iter_lines():
+				if not line:
+					continue
+				try:
+					log_id = json.loads(line)['id']
+				except (ValueError, KeyError, TypeError):
+					# the download was cut in the middle of a log, it is fetched next time
+					logging.warning(f"Incomplete log when exporting room '{room_name}'")
+					break
+				log_file.write(line + b"\n")
+				last_id = log_id
+				exported += 1
+	finally:
+		response.close()
+		# remember what was written, even if the download was interrupted
+		if last_id is not None:
+			export_state[room_name] = last_id
+			_save_export_state(export_state)
+
+	return exported
+
+
 def export_partner_not_found_log(user_id, game_token: str, seconds_waiting):
 	try:
 		with open(f"{LOG_DIR}/{PARTNER_NOT_FOUND_LOG}") as json_file:
@@ -1,24 +1,34 @@
-
 import datetime
 
 from ...api.log import log_event
 
-from ...models.log import get_room_logs_for_event, get_user_logs_for_event
-from ...models.user import User, get_user_messages
-from ...models.room import Room, get_room_user_messages
+from ...models.log import Log, iter_logs
+from ...models.user import User
+from ...models.room import Room
 
 from . import constants
 
 
 _HELPER_BOT_ID = 2
 
+# the only events needed for the analysis
+_ANALYSIS_EVENTS = [
+	constants.EVENT_START_TASK,
+	constants.EVENT_END_TASK,
+	constants.EVENT_ADVANCE_SUBTASK,
+	constants.EVENT_DISCONNECT_END_TASK,
+	"join",
+	"text_message",
+]
+
 
 def perform_post_task_analysis(room_name: str):
-	start_log = get_room_logs_for_event(room_name, constants.EVENT_START_TASK)
-	end_log = get_room_logs_for_event(room_name, constants.EVENT_END_TASK)
-	participants = _get_room_participants(room_name)
+	room_logs = _reduce_room_logs(room_name)
+	start_log = room_logs['start_log']
+	end_log = room_logs['end_log']
+	participants = room_logs['participants']
 
-	if len(start_log) == len(end_log) == len(participants.keys()) == 0:
+	if start_log is None and end_log is None and len(participants.keys()) == 0:
 		log_event(
 			'post_task_analysis_room_not_found', user=User.query.get(_HELPER_BOT_ID),
 			data={
@@ -28,32 +38,31 @@ def perform_post_task_analysis(room_name: str):
 
 	data = {
 		'mission_start_time':
-			start_log[0]['date_created'] if len(start_log) > 0 else '',
+			start_log['date_created'] if start_log is not None else '',
 		'mission_end_time':
-			end_log[0]['date_created'] if len(end_log) > 0 else '',
+			end_log['date_created'] if end_log is not None else '',
 		'mission_elapsed_time':
-			end_log[0]['date_created'] - start_log[0]['date_created']
-			if len(start_log) + len(end_log) > 1 else 0,
-		'subtask_inspect': _get_subtask_information(room_name, 'inspect'),
-		'subtask_extinguish': _get_subtask_information(room_name, 'extinguish'),
-		'subtask_assess_damage': _get_subtask_information(room_name, 'assess_damage'),
+			end_log['date_created'] - start_log['date_created']
+			if start_log is not None and end_log is not None else 0,
+		'subtask_inspect': _get_subtask_information(room_logs, 'inspect'),
+		'subtask_extinguish': _get_subtask_information(room_logs, 'extinguish'),
+		'subtask_assess_damage': _get_subtask_information(room_logs, 'assess_damage'),
 		'mission_end_reason': {
-			'id': end_log[0]['data']['reason_id'] if len(end_log) > 0 else '',
-			'description': end_log[0]['data']['reason'] if len(end_log) > 0 else ''
+			'id': end_log['data']['reason_id'] if end_log is not None else '',
+			'description': end_log['data']['reason'] if end_log is not None else ''
 		},
 		'participant_wizard': _get_user_message_information(
-			participants['fred']) if 'fred' in participants else None,
+			room_logs, participants['fred']) if 'fred' in participants else None,
 		'participant_operator': _get_user_message_information(
-			participants['operator']) if 'operator' in participants else None,
+			room_logs, participants['operator']) if 'operator' in participants else None,
 		# 'quiz_operator': _get_operator_quiz_information(
 		# 	participants['operator']) if 'operator' in participants else None,
-		'dialogue_summary': _get_dialogue_summary(room_name)
+		'dialogue_summary': room_logs['dialogue']
 	}
 
-	mission_subtask = get_room_logs_for_event(
-		room_name, constants.EVENT_ADVANCE_SUBTASK)
-	data['mission_subtask'] = mission_subtask[0]['data']['current_subtask'] \
-		if len(mission_subtask) > 0 else 'inspect'
+	subtask_logs = room_logs['subtask_logs']
+	data['mission_subtask'] = subtask_logs[-1]['log']['data']['current_subtask'] \
+		if len(subtask_logs) > 0 else 'inspect'
 	data['mission_successful'] = data['mission_subtask'] == 'assess_damage'
 
 	first_ever_msg = data['participant_wizard']
@@ -104,20 +113,71 @@ def perform_post_task_analysis(room_name: str):
 	return data
 
 
-def _get_room_participants(room_name: str) -> dict:
-	join_logs = get_room_logs_for_event(room_name, "join")
-
-	participants = {}
-	for msg in join_logs:
-		if msg['user']['id'] > 2 and msg['user']['id'] not in participants:
-			participants[msg['user']['name'].lower()] = msg['user']['id']
-
-	return participants
-
+def _reduce_room_logs(room_name: str) -> dict:
+	"""
+	Goes through the logs of a room once, in order, and keeps what
+	the analysis needs from them.
+
+	:param room_name: name of the room
+	:return: dict with the latest start and end task logs, the participants
+		by lowercase name, the messages of each user, the subtask logs with the
+		turns during each subtask, the latest disconnect log and the dialogue
+	"""
+	room_logs = {
+		'start_log': None,
+		'end_log': None,
+		'disconnect_log': None,
+		'participants': {},
+		'user_messages': {},
+		'subtask_logs': [],
+		'dialogue': [],
+	}
 
-def _get_user_message_information(user_id) -> dict:
+	for log in iter_logs(
+			Log.room_id == room_name, Log.event.in_(_ANALYSIS_EVENTS)):
+		event = log['event']
+		user_id = log['user']['id']
+
+		if event == constants.EVENT_START_TASK:
+			room_logs['start_log'] = log
+		elif event == constants.EVENT_END_TASK:
+			room_logs['end_log'] = log
+			if len(room_logs['subtask_logs']) > 0:
+				# turns in the current subtask up to the (latest) end of the task
+				subtask = room_logs['subtask_logs'][-1]
+				subtask['turns_until_end'] = dict(subtask['turns'])
+		elif event == constants.EVENT_DISCONNECT_END_TASK:
+			room_logs['disconnect_log'] = log
+		elif event == constants.EVENT_ADVANCE_SUBTASK:
+			room_logs['subtask_logs'].append({
+				'log': log,
+				'turns': {'operator_turns': 0, 'wizard_turns': 0},
+				'turns_until_end': None
+			})
+		elif event == "join":
+			# keep the first user that joined with each name
+			if user_id > 2:
+				room_logs['participants'].setdefault(
+					log['user']['name'].lower(), user_id)
+		elif event == "text_message":
+			room_logs['dialogue'].append(log)
+			if user_id > 2:
+				room_logs['user_messages'].setdefault(user_id, []).append(log)
+				if len(room_logs['subtask_logs']) > 0:
+					turns = room_logs['subtask_logs'][-1]['turns']
+					if log['user']['name'] == 'Operator':
+						turns['operator_turns'] += 1
+					elif log['user']['name'] == 'Fred':
+						turns['wizard_turns'] += 1
+
+	room_logs['dialogue'] = _get_dialogue_summary(room_logs['dialogue'])
+
+	return room_logs
+
+
+def _get_user_message_information(room_logs: dict, user_id) -> dict:
 	this_user = User.query.get(user_id)
-	user_messages = get_user_messages(user_id, order_desc=False)
+	user_messages = room_logs['user_messages'].get(user_id, [])
 
 	data = {
 		'user_id': user_id,
@@ -147,65 +207,62 @@ def _get_user_message_information(user_id) -> dict:
 			'message_log_id': last_msg['id']
 		}
 
-	disconnected_log = get_user_logs_for_event(
-		2, constants.EVENT_DISCONNECT_END_TASK)
-	data['disconnected'] = len(disconnected_log) > 0 \
-		and disconnected_log[0]['data']['disconnected_user_id'] == user_id
+	disconnected_log = room_logs['disconnect_log']
+	data['disconnected'] = disconnected_log is not None \
+		and disconnected_log['data']['disconnected_user_id'] == user_id
 
 	return data
 
 
-def _get_subtask_information(room_name: str, subtask_name: str) -> dict:
-	end_log = get_room_logs_for_event(room_name, constants.EVENT_END_TASK)
-	subtask_logs = get_room_logs_for_event(
-		room_name, constants.EVENT_ADVANCE_SUBTASK, order_desc=False)
+def _get_subtask_information(room_logs: dict, subtask_name: str) -> dict:
+	subtask_logs = room_logs['subtask_logs']
 
 	subtask_start = None
 	subtask_end = None
-	for subtask_log in subtask_logs:
-		if subtask_log['data']['current_subtask'] == subtask_name:
+	for index, subtask_log in enumerate(subtask_logs):
+		if subtask_log['log']['data']['current_subtask'] == subtask_name:
 			# trigger at next iteration
-			subtask_start = subtask_log
+			subtask_start = index
 		elif subtask_start is not None:
-			subtask_end = subtask_log
+			subtask_end = subtask_log['log']
 			break
 
 	if subtask_start is not None:
-		if subtask_end is None:
-			subtask_end = end_log[0] if len(end_log) > 0 else subtask_start
-
-		user_messages = get_room_user_messages(room_name, subtask_start['id'])
-		user_messages = [
-			msg for msg in user_messages if msg['id'] <= subtask_end['id']]
+		start_log = subtask_logs[subtask_start]['log']
+		if subtask_end is not None:
+			turns = subtask_logs[subtask_start]['turns']
+		else:
+			# the subtask lasted until the end of the task, if it ended after it
+			end_log = room_logs['end_log']
+			turns = subtask_logs[subtask_start]['turns_until_end']
+			if end_log is not None and turns is not None:
+				subtask_end = end_log
+			else:
+				subtask_end = end_log if end_log is not None else start_log
+				turns = {'operator_turns': 0, 'wizard_turns': 0}
 
 		return {
 			'subtask_elapsed_time': subtask_end['data']['seconds_since_start']
-			- subtask_start['data']['seconds_since_start'],
+			- start_log['data']['seconds_since_start'],
 			'subtask_start_time': {
-				'timestamp': subtask_start['date_created'],
-				'seconds_since_start': subtask_start['data']['seconds_since_start']
+				'timestamp': start_log['date_created'],
+				'seconds_since_start': start_log['data']['seconds_since_start']
 			},
 			'subtask_end_time': {
 				'timestamp': subtask_end['date_created'],
 				'seconds_since_start': subtask_end['data']['seconds_since_start']
 			},
-			'messages': {
-				'operator_turns': len([
-					msg for msg in user_messages if msg['user']['name'] == 'Operator']),
-				'wizard_turns': len([
-					msg for msg in user_messages if msg['user']['name'] == 'Fred']),
-			}
+			'messages': dict(turns)
 		}
 
 	return {}
 
 
-def _get_dialogue_summary(room_name: str) -> dict:
-	user_messages = get_room_user_messages(room_name, bot_msgs=True)
-
+def _get_dialogue_summary(messages: list) -> dict:
 	dialogue = {}
 
-	for msg in user_messages:
+	# the most recent messages first
+	for msg in reversed(messages):
 		time_val = datetime.datetime.fromtimestamp(msg['date_created'])\
 			.strftime('%H:%M:%S')
 		dialogue[f"{time_val}_{msg['user']['name'][:4]}_{msg['id']}"] = \
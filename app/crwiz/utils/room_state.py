@@ -0,0 +1,309 @@
+"""
+room_state
+----------
+
+Backends to keep the state of the active rooms (see ActiveRoom.to_dict()),
+so it can be shared by several workers. The state of a room is a dict that
+can be serialised to JSON.
+
+- memory:// keeps it in the process, only for a single worker
+- sqlite:///path/to/file.db shares it between the workers of a machine
+- redis://host:port/db shares it between machines (needs the redis package)
+
+Each backend also locks rooms (see RoomStateBackend.lock()), so a worker can
+load, change and save a room without other workers changing it meanwhile.
+The shared backends give up a lock after LOCK_SECONDS, in case the worker
+holding it dies.
+"""
+
+import abc
+import json
+import time
+import uuid
+import sqlite3
+import threading
+import contextlib
+from typing import Dict, Iterator, List, Optional
+
+
+# seconds until a lock is released if the worker holding it does not release it
+LOCK_SECONDS = 30
+# seconds to wait for a lock before giving up
+LOCK_TIMEOUT = 10
+# seconds between attempts to get a lock
+LOCK_RETRY_SECONDS = 0.01
+
+
+class RoomStateBackend(abc.ABC):
+	"""
+	Base class of the room state backends.
+	"""
+
+	# whether other processes can change the state, so it must be reloaded
+	shared = False
+
+	def __init__(self):
+		# locks held by the current thread (or greenlet), with how many times
+		self._held_locks = threading.local()
+
+	@contextlib.contextmanager
+	def lock(self, room_name: str, timeout: float = LOCK_TIMEOUT) -> Iterator[None]:
+		"""
+		Locks a room while the context is active. The lock is reentrant for
+		the same thread (or greenlet).
+
+		:param room_name: name of the room
+		:param timeout: seconds to wait for the lock
+		:raises TimeoutError: if the lock could not be acquired in time
+		"""
+		held_locks = getattr(self._held_locks, "rooms", None)
+		if held_locks is None:
+			held_locks = self._held_locks.rooms = {}
+
+		if room_name in held_locks:
+			token, count = held_locks[room_name]
+			held_locks[room_name] = (token, count + 1)
+		else:
+			token = uuid.uuid4().hex
+			deadline = time.monotonic() + timeout
+			while not self._acquire(room_name, token):
+				if time.monotonic() >= deadline:
+					raise TimeoutError(f"Could not lock room '{room_name}'")
+				time.sleep(LOCK_RETRY_SECONDS)
+			held_locks[room_name] = (token, 1)
+
+		try:
+			yield
+		finally:
+			token, count = held_locks[room_name]
+			if count > 1:
+				held_locks[room_name] = (token, count - 1)
+			else:
+				del held_locks[room_name]
+				self._release(room_name, token)
+
+	@abc.abstractmethod
+	def _acquire(self, room_name: str, token: str) -> bool:
+		"""
+		Tries to lock a room once.
+
+		:param room_name: name of the room
+		:param token: unique value of this lock, to release it later
+		:return: True if the room was locked
+		"""
+
+	@abc.abstractmethod
+	def _release(self, room_name: str, token: str):
+		"""
+		Releases the lock of a room, if it is still held with the token.
+
+		:param room_name: name of the room
+		:param token: value given to _acquire()
+		:return: None
+		"""
+
+	@abc.abstractmethod
+	def load(self, room_name: str) -> Optional[dict]:
+		"""
+		Loads the state of a room.
+
+		:param room_name: name of the room
+		:return: dict with the state or None if the room is not stored
+		"""
+
+	@abc.abstractmethod
+	def save(self, room_name: str, state: dict):
+		"""
+		Saves the state of a room, replacing the previous one.
+
+		:param room_name: name of the room
+		:param state: dict with the state
+		:return: None
+		"""
+
+	@abc.abstractmethod
+	def delete(self, room_name: str):
+		"""
+		Deletes the state of a room, if it is stored.
+
+		:param room_name: name of the room
+		:return: None
+		"""
+
+	@abc.abstractmethod
+	def room_names(self) -> List[str]:
+		"""
+		Gets the names of the stored rooms.
+
+		:return: list with room names
+		"""
+
+
+class MemoryRoomStateBackend(RoomStateBackend):
+	"""
+	Keeps the states in a dict in this process.
+	"""
+
+	def __init__(self):
+		super().__init__()
+		self._states: Dict[str, str] = {}
+		self._locks: Dict[str, str] = {}
+		self._locks_lock = threading.Lock()
+
+	def _acquire(self, room_name: str, token: str) -> bool:
+		with self._locks_lock:
+			if room_name in self._locks:
+				return False
+			self._locks[room_name] = token
+			return True
+
+	def _release(self, room_name: str, token: str):
+		with self._locks_lock:
+			if self._locks.get(room_name) == token:
+				del self._locks[room_name]
+
+	def load(self, room_name: str) -> Optional[dict]:
+		state = self._states.get(room_name)
+		return json.loads(state) if state is not None else None
+
+	def save(self, room_name: str, state: dict):
+		# stored as JSON so it behaves like the other backends
+		self._states[room_name] = json.dumps(state)
+
+	def delete(self, room_name: str):
+		self._states.pop(room_name, None)
+
+	def room_names(self) -> List[str]:
+		return list(self._states.keys())
+
+
+class SQLiteRoomStateBackend(RoomStateBackend):
+	"""
+	Keeps the states in a SQLite file, shared by the processes of a machine.
+	"""
+
+	shared = True
+
+	def __init__(self, path: str):
+		super().__init__()
+		self._path = path
+		self._local = threading.local()
+		with self._connection() as connection:
+			connection.execute(
+				"CREATE TABLE IF NOT EXISTS room_state ("
+				"name TEXT PRIMARY KEY, state TEXT NOT NULL, date_modified REAL NOT NULL)")
+			connection.execute(
+				"CREATE TABLE IF NOT EXISTS room_lock ("
+				"name TEXT PRIMARY KEY, token TEXT NOT NULL, expires REAL NOT NULL)")
+
+	def _connection(self) -> sqlite3.Connection:
+		# sqlite connections cannot be shared between threads
+		connection = getattr(self._local, "connection", None)
+		if connection is None:
+			connection = sqlite3.connect(self._path, timeout=10)
+			connection.execute("PRAGMA journal_mode=WAL")
+			self._local.connection = connection
+		return connection
+
+	def _acquire(self, room_name: str, token: str) -> bool:
+		now = time.time()
+		with self._connection() as connection:
+			connection.execute(
+				"DELETE FROM room_lock WHERE name = ? AND expires < ?", (room_name, now))
+			cursor = connection.execute(
+				"INSERT OR IGNORE INTO room_lock (name, token, expires) VALUES (?, ?, ?)",
+				(room_name, token, now + LOCK_SECONDS))
+			return cursor.rowcount == 1
+
+	def _release(self, room_name: str, token: str):
+		with self._connection() as connection:
+			connection.execute(
+				"DELETE FROM room_lock WHERE name = ? AND token = ?", (room_name, token))
+
+	def load(self, room_name: str) -> Optional[dict]:
+		row = self._connection().execute(
+			"SELECT state FROM room_state WHERE name = ?", (room_name,)).fetchone()
+		return json.loads(row[0]) if row is not None else None
+
+	def save(self, room_name: str, state: dict):
+		with self._connection() as connection:
+			connection.execute(
+				"INSERT OR REPLACE INTO room_state (name, state, date_modified) "
+				"VALUES (?, ?, ?)", (room_name, json.dumps(state), time.time()))
+
+	def delete(self, room_name: str):
+		with self._connection() as connection:
+			connection.execute("DELETE FROM room_state WHERE name = ?", (room_name,))
+
+	def room_names(self) -> List[str]:
+		return [
+			row[0] for row in
+			self._connection().execute("SELECT name FROM room_state").fetchall()]
+
+
+class RedisRoomStateBackend(RoomStateBackend):
+	"""
+	Keeps the states in Redis. The client only needs get, set (with nx and px),
+	delete and scan_iter like redis.Redis, so anything compatible with it can be used.
+	"""
+
+	shared = True
+
+	def __init__(self, client, prefix: str = "crwiz:room_state:"):
+		super().__init__()
+		self._client = client
+		self._prefix = prefix
+		self._lock_prefix = prefix + "lock:"
+
+	def _acquire(self, room_name: str, token: str) -> bool:
+		return bool(self._client.set(
+			self._lock_prefix + room_name, token, nx=True, px=int(LOCK_SECONDS * 1000)))
+
+	def _release(self, room_name: str, token: str):
+		value = self._client.get(self._lock_prefix + room_name)
+		if isinstance(value, bytes):
+			value = value.decode("utf-8")
+		if value == token:
+			self._client.delete(self._lock_prefix + room_name)
+
+	def load(self, room_name: str) -> Optional[dict]:
+		state = self._client.get(self._prefix + room_name)
+		return json.loads(state) if state is not None else None
+
+	def save(self, room_name: str, state: dict):
+		self._client.set(self._prefix + room_name, json.dumps(state))
+
+	def delete(self, room_name: str):
+		self._client.delete(self._prefix + room_name)
+
+	def room_names(self) -> List[str]:
+		names = []
+		for key in self._client.scan_iter(match=self._prefix + "*"):
+			if isinstance(key, bytes):
+				key = key.decode("utf-8")
+			if not key.startswith(self._lock_prefix):
+				names.append(key[len(self._prefix):])
+		return names
+
+
+def create_room_state_backend(url: Optional[str]) -> RoomStateBackend:
+	"""
+	Creates the room state backend for a url (see the module description).
+
+	:param url: url of the backend, None for memory://
+	:return: RoomStateBackend
+	:raises ValueError: if the url is not supported
+	"""
+	if not url or url == "memory://":
+		return MemoryRoomStateBackend()
+	elif url.startswith("sqlite:///"):
+		return SQLiteRoomStateBackend(url[len("sqlite:///"):])
+	elif url.startswith("redis://") or url.startswith("rediss://"):
+		try:
+			import redis
+		except ImportError:
+			raise ValueError(
+				f"The redis package is needed for the room state backend '{url}'")
+		return RedisRoomStateBackend(redis.Redis.from_url(url))
+
+	raise ValueError(f"Unknown room state backend '{url}'")
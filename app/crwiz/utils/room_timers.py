@@ -0,0 +1,163 @@
+"""
+room_timers
+-----------
+
+Timers of an active room: the timeout of its task and the one that
+invalidates the tokens of the participants once it has finished.
+
+When several workers share the rooms (see room_state), each of them loads
+its own ActiveRoom, but the timers of a room are only scheduled in the
+worker that started them (timer_worker), so they do not run in all of them.
+They are kept as end times in the state of the room, and scheduled again
+with restore() if they change or move to this worker. The timers of a
+worker that has stopped are taken over by the next one that restores them.
+"""
+
+import time
+from logging import getLogger
+from typing import Callable, Hashable, Optional
+
+
+class RoomTimers:
+	"""
+	Holds the timers of a room and schedules them in a Scheduler.
+	"""
+
+	def __init__(
+		self, room_name: str, worker_id: Optional[str], scheduler,
+		timeout_callback: Callable, is_worker_stopped: Callable[[str], bool] = None):
+		self.room_name = room_name
+		# this worker and the one that runs the timers of the room
+		self.worker_id = worker_id
+		self.timer_worker: Optional[str] = None
+		self.end_time: Optional[float] = None
+		self.token_end_time: Optional[float] = None
+		self._scheduler = scheduler
+		self._timeout_callback = timeout_callback
+		self._is_worker_stopped = is_worker_stopped
+		self._room_timer: Optional[Hashable] = None
+		self._token_timer: Optional[Hashable] = None
+
+	@property
+	def room_timer(self) -> Optional[Hashable]:
+		"""
+		Key of the room timeout in the scheduler, None if it was not set.
+		"""
+		return self._room_timer
+
+	@room_timer.setter
+	def room_timer(self, key: Optional[Hashable]):
+		if self._room_timer is not None:
+			# scheduling the same key again already replaced the previous timeout
+			if key != self._room_timer:
+				self._scheduler.cancel(self._room_timer)
+			getLogger("crwiz").debug(f"Timeout for room '{self.room_name}' cancelled")
+		self._room_timer = key
+
+	@property
+	def token_timer(self) -> Optional[Hashable]:
+		"""
+		Key of the token timeout in the scheduler, None if it was not set.
+		"""
+		return self._token_timer
+
+	def set_end_time(self, seconds: float, start_timer: bool = True):
+		"""
+		Sets when the task of the room ends and schedules its timeout.
+
+		:param seconds: seconds from now, ignored if not positive
+		:param start_timer: False to only set the end time
+		:return: None
+		"""
+		if seconds > 0:
+			self.end_time = time.time() + seconds
+			if start_timer:
+				self.timer_worker = self.worker_id
+				self.room_timer = self._scheduler.schedule(
+					('room_timeout', self.room_name), seconds + 1,
+					self._timeout_callback, [self.room_name])
+
+	def start_token_timer(self, timeout_callback: Callable, seconds: float):
+		"""
+		Schedules the timeout of the tokens of the participants.
+
+		:param timeout_callback: function called with the room name
+		:param seconds: seconds from now
+		:return: None
+		"""
+		self.token_end_time = time.time() + seconds
+		self.timer_worker = self.worker_id
+		self._token_timer = self._scheduler.schedule(
+			('token_timeout', self.room_name), seconds, timeout_callback, [self.room_name])
+
+	def cancel(self):
+		"""
+		Cancels all the timers of the room.
+
+		:return: None
+		"""
+		if self.room_timer is not None:
+			self.room_timer = None
+		if self._token_timer is not None:
+			self._scheduler.cancel(self._token_timer)
+			self._token_timer = None
+
+	def to_dict(self) -> dict:
+		"""
+		Returns the timers as a dict that can be serialised to JSON.
+
+		:return: dict
+		"""
+		return {
+			'end_time': self.end_time,
+			'room_timer': self.room_timer is not None,
+			'timer_worker': self.timer_worker,
+			'token_end_time': self.token_end_time,
+		}
+
+	def restore(
+		self, state: dict, task_finished: bool, token_timeout_callback: Callable = None):
+		"""
+		Restores the timers from to_dict(). They are scheduled again if they
+		changed, but only if this worker runs them (see timer_worker).
+
+		:param state: dict from to_dict()
+		:param task_finished: whether the task of the room has finished
+		:param token_timeout_callback: callback for the token timer,
+			if it has to be started in this worker
+		:return: None
+		"""
+		now = time.time()
+		had_timers = self.timer_worker == self.worker_id
+		self.timer_worker = state.get('timer_worker')
+		if self.timer_worker is not None and self.timer_worker != self.worker_id \
+				and self._is_worker_stopped is not None \
+				and self._is_worker_stopped(self.timer_worker):
+			# nobody else would run them, it is saved with the next change of the room
+			self.timer_worker = self.worker_id
+		has_timers = self.timer_worker == self.worker_id
+		if state['room_timer'] and not task_finished:
+			if not has_timers:
+				# the timeout runs in another worker, only its key is kept here
+				self._scheduler.cancel(('room_timeout', self.room_name))
+				self._room_timer = ('room_timeout', self.room_name)
+			elif self.room_timer is None or not had_timers \
+					or self.end_time != state['end_time']:
+				self.room_timer = self._scheduler.schedule(
+					('room_timeout', self.room_name), max(state['end_time'] - now, 0) + 1,
+					self._timeout_callback, [self.room_name])
+		elif task_finished and self.room_timer is not None:
+			self.room_timer = None
+		self.end_time = state['end_time']
+
+		if state['token_end_time'] is not None and token_timeout_callback is not None:
+			if not has_timers:
+				if self._token_timer is not None:
+					self._scheduler.cancel(self._token_timer)
+					self._token_timer = None
+			elif self._token_timer is None or not had_timers \
+					or self.token_end_time != state['token_end_time']:
+				self._token_timer = self._scheduler.schedule(
+					('token_timeout', self.room_name), max(state['token_end_time'] - now, 0),
+					token_timeout_callback, [self.room_name])
+		self.token_end_time = state['token_end_time']
@@ -0,0 +1,235 @@
+"""
+scheduler
+---------
+
+Heap-based scheduler that keeps the timers of the process in a single thread,
+instead of starting a threading.Timer (a thread or a greenlet) for each of them.
+Timers are identified by a key, so scheduling the same key again reschedules it.
+
+Due callbacks are handed to an executor, so a slow one (e.g. closing a room)
+does not delay the others. By default each one runs in a new thread, which is
+a greenlet in the app since gevent patches the threads.
+"""
+
+import heapq
+import itertools
+import threading
+import time
+from logging import getLogger
+from typing import Callable, Dict, Hashable, List, Optional, Sequence, Tuple
+
+
+# position of each field in the heap entries
+_DEADLINE, _SEQUENCE, _KEY, _CALLBACK, _ARGS = range(5)
+
+
+class Scheduler:
+	"""
+	Runs callbacks after a delay. Scheduling, rescheduling and cancelling a
+	timer are O(log n). Cancelled timers are left in the heap and skipped when
+	they reach the top, and the heap is rebuilt if they become the majority.
+
+	Due callbacks are started in deadline order by the executor, which is
+	called like executor(function, *args), so they may run at the same time.
+	"""
+
+	def __init__(self, name: str = "scheduler", executor: Callable = None):
+		self._name = name
+		self._executor = executor or start_thread
+		# entries are [deadline, sequence, key, callback, args], the
+		# sequence keeps the order of timers with the same deadline
+		self._heap: List[list] = []
+		self._entries: Dict[Hashable, list] = {}
+		self._sequence = itertools.count()
+		self._cancelled = 0
+		self._condition = threading.Condition()
+		self._thread: Optional[threading.Thread] = None
+
+	def __len__(self) -> int:
+		return len(self._entries)
+
+	def __contains__(self, key: Hashable) -> bool:
+		return key in self._entries
+
+	def schedule(
+		self, key: Optional[Hashable], delay: float, callback: Callable,
+		args: Sequence = ()) -> Hashable:
+		"""
+		Schedules a callback to run after a delay. If there is already a timer
+		with the same key, it is replaced.
+
+		:param key: key of the timer, None to generate a unique one
+		:param delay: seconds until the callback runs
+		:param callback: function to call
+		:param args: arguments for the callback
+		:return: key of the timer
+		"""
+		if key is None:
+			key = (self._name, next(self._sequence))
+
+		with self._condition:
+			self._remove(key)
+			self._push(key, time.monotonic() + delay, callback, tuple(args))
+			self._start()
+		return key
+
+	def reschedule(self, key: Hashable, delay: float) -> bool:
+		"""
+		Changes when a pending timer runs, keeping its callback.
+
+		:param key: key of the timer
+		:param delay: seconds from now until the callback runs
+		:return: True if the timer was pending
+		"""
+		with self._condition:
+			entry = self._remove(key)
+			if entry is None:
+				return False
+			self._push(key, time.monotonic() + delay, entry[_CALLBACK], entry[_ARGS])
+		return True
+
+	def cancel(self, key: Hashable) -> bool:
+		"""
+		Cancels a pending timer.
+
+		:param key: key of the timer
+		:return: True if the timer was pending
+		"""
+		with self._condition:
+			return self._remove(key) is not None
+
+	def get_remaining(self, key: Hashable) -> Optional[float]:
+		"""
+		Gets how long until a timer runs.
+
+		:param key: key of the timer
+		:return: seconds until the timer runs or None if it is not pending
+		"""
+		entry = self._entries.get(key)
+		if entry is None:
+			return None
+		return max(entry[_DEADLINE] - time.monotonic(), 0)
+
+	def pending(self) -> List[Tuple[Hashable, float]]:
+		"""
+		Gets the pending timers, the earliest first.
+
+		:return: list of tuples with the key and the seconds until it runs
+		"""
+		now = time.monotonic()
+		with self._condition:
+			entries = sorted(self._entries.values())
+		return [(entry[_KEY], max(entry[_DEADLINE] - now, 0)) for entry in entries]
+
+	def set_executor(self, executor: Callable):
+		"""
+		Changes how the due callbacks are run.
+
+		:param executor: function called like executor(function, *args),
+			e.g. socketio.start_background_task
+		:return: None
+		"""
+		self._executor = executor
+
+	def stop(self):
+		"""
+		Cancels all the timers and stops the scheduler thread.
+		Scheduling a new timer starts it again.
+
+		:return: None
+		"""
+		with self._condition:
+			self._heap.clear()
+			self._entries.clear()
+			self._cancelled = 0
+			self._thread = None
+			self._condition.notify_all()
+
+	def _push(self, key: Hashable, deadline: float, callback: Callable, args: tuple):
+		entry = [deadline, next(self._sequence), key, callback, args]
+		self._entries[key] = entry
+		heapq.heappush(self._heap, entry)
+		if self._heap[0] is entry:
+			# wake up the thread, it is waiting for a later deadline
+			self._condition.notify()
+
+	def _remove(self, key: Hashable) -> Optional[list]:
+		entry = self._entries.pop(key, None)
+		if entry is not None:
+			cancelled_entry = list(entry)
+			entry[_CALLBACK] = None
+			self._cancelled += 1
+			if self._cancelled > len(self._entries) and self._cancelled > 64:
+				self._heap = [
+					entry for entry in self._heap if entry[_CALLBACK] is not None]
+				heapq.heapify(self._heap)
+				self._cancelled = 0
+			return cancelled_entry
+		return None
+
+	def _start(self):
+		if self._thread is None:
+			self._thread = threading.Thread(
+				target=self._run, name=self._name, daemon=True)
+			self._thread.start()
+
+	def _run(self):
+		while True:
+			with self._condition:
+				entry = self._wait_next()
+			if entry is None:
+				return
+
+			try:
+				self._executor(_run_callback, entry[_KEY], entry[_CALLBACK], entry[_ARGS])
+			except Exception as ex:
+				getLogger("crwiz").exception(
+					f"Timer {entry[_KEY]} could not be started: {ex}")
+
+	def _wait_next(self) -> Optional[list]:
+		"""
+		Waits until the next timer is due and takes it out of the scheduler.
+		Must be called with the condition acquired.
+
+		:return: heap entry or None if the scheduler was stopped
+		"""
+		while self._thread is threading.current_thread():
+			while self._heap and self._heap[0][_CALLBACK] is None:
+				heapq.heappop(self._heap)
+				self._cancelled -= 1
+
+			if not self._heap:
+				self._condition.wait()
+				continue
+
+			timeout = self._heap[0][_DEADLINE] - time.monotonic()
+			if timeout > 0:
+				self._condition.wait(timeout)
+				continue
+
+			entry = heapq.heappop(self._heap)
+			del self._entries[entry[_KEY]]
+			return entry
+
+		return None
+
+
+def start_thread(function: Callable, *args):
+	"""
+	Default executor of the scheduler, runs a function in a new daemon thread.
+
+	:param function: function to call
+	:param args: arguments for the function
+	:return: None
+	"""
+	threading.Thread(target=function, args=args, daemon=True).start()
+
+
+def _run_callback(key: Hashable, callback: Callable, args: tuple):
+	try:
+		callback(*args)
+	except Exception as ex:
+		getLogger("crwiz").exception(f"Timer {key} raised an exception: {ex}")
+
+
+scheduler = Scheduler()
@@ -0,0 +1,148 @@
+"""
+state_classifier
+----------------
+
+Classifies free text into the dialogue states that it most likely belongs to.
+The formulations of the states are indexed once as TF-IDF vectors of their
+word n-grams, kept as an inverted index (term -> formulations), so classifying
+a text only touches the formulations that share a term with it.
+
+The FiniteStateMachine uses it to log the states that the free text of the
+Wizard most likely belongs to (see FiniteStateMachine.predict_states()), and
+the best one is given as the hint if it is one of the dialogue choices (see
+FiniteStateMachine.get_task_hint()).
+"""
+
+import re
+import math
+from typing import Dict, Iterable, List, Tuple
+
+import numpy
+
+
+# n-grams of words used as terms, (1, 2) means words and pairs of words
+NGRAM_RANGE = (1, 2)
+DEFAULT_TOP_K = 3
+
+# slots, optional parts and tags of the formulations (see helper.formulation_to_pattern)
+_REGEX_PLACEHOLDER = re.compile(r"\[[^\]]*\]|{[^}]*}|<[^>]*>")
+_REGEX_WORD = re.compile(r"[a-z0-9]+(?:'[a-z]+)?")
+
+
+def get_terms(text: str, ngram_range: Tuple[int, int] = NGRAM_RANGE) -> List[str]:
+	"""
+	Normalises a text and splits it into n-grams of words. Placeholders of
+	the formulations (e.g. {robot.name}) are left out.
+
+	:param text: text to split
+	:param ngram_range: min and max number of words of each term
+	:return: list of terms, repeated if they appear several times
+	"""
+	words = _REGEX_WORD.findall(_REGEX_PLACEHOLDER.sub(" ", text.lower()))
+	terms = []
+	for n in range(ngram_range[0], ngram_range[1] + 1):
+		terms.extend(" ".join(words[i:i + n]) for i in range(len(words) - n + 1))
+	return terms
+
+
+class StateClassifier:
+	"""
+	TF-IDF index of the formulations of the dialogue states. The score of a
+	state is the cosine similarity between the text and its closest formulation.
+	"""
+
+	def __init__(
+		self, formulations: Iterable[Tuple[str, str]],
+		ngram_range: Tuple[int, int] = NGRAM_RANGE):
+		"""
+		:param formulations: tuples with the state name and a formulation
+		:param ngram_range: min and max number of words of each term
+		"""
+		self._ngram_range = ngram_range
+
+		state_index: Dict[str, int] = {}
+		documents: List[Dict[str, int]] = []
+		document_states = []
+		for state_name, formulation in formulations:
+			counts: Dict[str, int] = {}
+			for term in get_terms(formulation, ngram_range):
+				counts[term] = counts.get(term, 0) + 1
+			if not counts:
+				continue
+			documents.append(counts)
+			document_states.append(state_index.setdefault(state_name, len(state_index)))
+
+		self._state_names: Tuple[str, ...] = tuple(state_index.keys())
+		self._document_states = numpy.array(document_states, dtype=numpy.intp)
+
+		# smoothed idf, like a document with every term was indexed once
+		document_frequency: Dict[str, int] = {}
+		for counts in documents:
+			for term in counts:
+				document_frequency[term] = document_frequency.get(term, 0) + 1
+		self._idf: Dict[str, float] = {
+			term: math.log((1 + len(documents)) / (1 + frequency)) + 1
+			for term, frequency in document_frequency.items()}
+		self._unknown_idf = math.log(1 + len(documents)) + 1
+
+		# normalised tf-idf weights, grouped by term
+		postings: Dict[str, Tuple[List[int], List[float]]] = {}
+		for document_id, counts in enumerate(documents):
+			weights = {term: count * self._idf[term] for term, count in counts.items()}
+			norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+			for term, weight in weights.items():
+				document_ids, term_weights = postings.setdefault(term, ([], []))
+				document_ids.append(document_id)
+				term_weights.append(weight / norm)
+
+		self._postings: Dict[str, Tuple[numpy.ndarray, numpy.ndarray]] = {
+			term: (
+				numpy.array(document_ids, dtype=numpy.intp),
+				numpy.array(term_weights, dtype=numpy.float64))
+			for term, (document_ids, term_weights) in postings.items()}
+
+	def __len__(self) -> int:
+		return len(self._document_states)
+
+	@property
+	def state_names(self) -> Tuple[str, ...]:
+		return self._state_names
+
+	def classify(self, text: str, k: int = DEFAULT_TOP_K) -> List[Tuple[str, float]]:
+		"""
+		Gets the states that a text most likely belongs to.
+
+		:param text: text to classify (e.g. free text typed by the wizard)
+		:param k: max number of states to return
+		:return: list of tuples with the state name and score (0 to 1),
+			the best first and only states with a score over 0
+		"""
+		counts: Dict[str, int] = {}
+		for term in get_terms(text, self._ngram_range):
+			counts[term] = counts.get(term, 0) + 1
+		if k <= 0 or not any(term in self._postings for term in counts):
+			return []
+
+		# terms that were never indexed add nothing to the similarity,
+		# but they make the text less similar to every formulation
+		weights = {
+			term: count * self._idf.get(term, self._unknown_idf)
+			for term, count in counts.items()}
+		norm = math.sqrt(sum(weight * weight for weight in weights.values()))
+		weights = {term: weight for term, weight in weights.items() if term in self._postings}
+
+		document_ids = numpy.concatenate([self._postings[term][0] for term in weights])
+		document_weights = numpy.concatenate([
+			self._postings[term][1] * (weight / norm) for term, weight in weights.items()])
+		document_scores = numpy.bincount(
+			document_ids, weights=document_weights, minlength=len(self._document_states))
+
+		state_scores = numpy.zeros(len(self._state_names))
+		numpy.maximum.at(state_scores, self._document_states, document_scores)
+
+		k = min(k, len(state_scores))
+		best = numpy.argpartition(-state_scores, k - 1)[:k]
+		best = best[numpy.argsort(-state_scores[best], kind="stable")]
+		return [
+			(self._state_names[state_id], float(state_scores[state_id]))
+			for state_id in best if state_scores[state_id] > 0]
@@ -0,0 +1,206 @@
+"""
+transition_graph
+----------------
+
+Immutable, integer-indexed transition graph compiled from the loaded dialogue
+states. Each state gets an adjacency list per subtask and a normalised
+probability vector aligned with it, so getting the transitions of a state is
+a lookup instead of a walk over the states.
+
+The FiniteStateMachine compiles one each time the dialogue states are loaded,
+so the subtask of each transition is only checked once.
+"""
+
+from logging import getLogger
+from typing import Dict, Mapping, Optional, Tuple
+
+import numpy
+
+
+class TransitionGraph:
+	"""
+	Compiled view of the transitions between dialogue states.
+
+	States are anything with the attributes of a DialogueState (name,
+	transitions, transition_probabilities, subtask and is_fixed).
+	Transitions to a state with a subtask are only available in that subtask,
+	whereas transitions to a state without subtask are available in all of them.
+	The subtask None means that only states without a subtask are available.
+	"""
+
+	def __init__(self, states: Mapping[str, object]):
+		self._names: Tuple[str, ...] = tuple(states.keys())
+		self._index: Dict[str, int] = {
+			name: index for index, name in enumerate(self._names)}
+
+		state_list = [states[name] for name in self._names]
+		self._state_subtasks: Tuple[Optional[str], ...] = tuple(
+			state.subtask for state in state_list)
+		self._is_fixed = numpy.array(
+			[state.is_fixed for state in state_list], dtype=bool)
+		self._is_fixed.flags.writeable = False
+
+		self._subtasks: Tuple[str, ...] = tuple(sorted(set(
+			subtask for subtask in self._state_subtasks if subtask is not None)))
+
+		# transitions as ids, dropping those to states that do not exist
+		all_transitions = []
+		for state in state_list:
+			transition_ids = []
+			for transition in state.transitions:
+				if transition in self._index:
+					transition_ids.append(self._index[transition])
+				else:
+					getLogger("crwiz").warning(
+						f"State '{state.name}' has a transition to unknown "
+						f"state '{transition}'")
+			all_transitions.append(transition_ids)
+
+		self._adjacency: Dict[Optional[str], Tuple[Tuple[int, ...], ...]] = {}
+		self._probabilities: Dict[Optional[str], Tuple[numpy.ndarray, ...]] = {}
+		for subtask in (None,) + self._subtasks:
+			adjacency = []
+			probabilities = []
+			for state, transition_ids in zip(state_list, all_transitions):
+				targets = tuple(
+					target for target in transition_ids
+					if self._state_subtasks[target] is None
+					or self._state_subtasks[target] == subtask)
+				adjacency.append(targets)
+				probabilities.append(_normalise(numpy.array([
+					state.transition_probabilities.get(self._names[target], 0)
+					for target in targets], dtype=float)))
+
+			self._adjacency[subtask] = tuple(adjacency)
+			self._probabilities[subtask] = tuple(probabilities)
+
+		# distributions are computed on first use, see get_distribution()
+		self._distributions: Dict[
+			Tuple[int, bool, Optional[str]],
+			Tuple[Tuple[int, ...], numpy.ndarray]] = {}
+
+	def __len__(self) -> int:
+		return len(self._names)
+
+	def __contains__(self, state_name: str) -> bool:
+		return state_name in self._index
+
+	@property
+	def names(self) -> Tuple[str, ...]:
+		return self._names
+
+	@property
+	def subtasks(self) -> Tuple[str, ...]:
+		return self._subtasks
+
+	@property
+	def is_fixed(self) -> numpy.ndarray:
+		"""
+		Read-only boolean vector, True for the fixed states.
+
+		:return: numpy array indexed by state id
+		"""
+		return self._is_fixed
+
+	def get_id(self, state_name: str) -> int:
+		return self._index[state_name]
+
+	def get_name(self, state_id: int) -> str:
+		return self._names[state_id]
+
+	def get_transition_ids(
+		self, state_id: int, subtask: Optional[str] = None) -> Tuple[int, ...]:
+		"""
+		Gets the ids of the states that can follow a state in a subtask.
+
+		:param state_id: id of the state
+		:param subtask: name of the current subtask
+		:return: tuple with state ids
+		"""
+		return self._get_adjacency(subtask)[state_id]
+
+	def get_transitions(
+		self, state_name: str, subtask: Optional[str] = None) -> Tuple[str, ...]:
+		"""
+		Gets the names of the states that can follow a state in a subtask.
+
+		:param state_name: name of the state
+		:param subtask: name of the current subtask
+		:return: tuple with state names
+		"""
+		return tuple(
+			self._names[target] for target in
+			self.get_transition_ids(self._index[state_name], subtask))
+
+	def get_transition_probabilities(
+		self, state_id: int, subtask: Optional[str] = None) -> numpy.ndarray:
+		"""
+		Gets the normalised probabilities of the transitions of a state,
+		aligned with get_transition_ids(state_id, subtask).
+
+		:param state_id: id of the state
+		:param subtask: name of the current subtask
+		:return: read-only numpy array that sums to 1 (or is empty)
+		"""
+		if subtask not in self._probabilities:
+			subtask = None
+		return self._probabilities[subtask][state_id]
+
+	def get_distribution(
+		self, state_id: int, subtask: Optional[str] = None,
+		filter_fixed: bool = True) -> Tuple[Tuple[int, ...], numpy.ndarray]:
+		"""
+		Gets the distribution over the states that can follow a state, optionally
+		leaving out the fixed states. Distributions are cached by
+		(state_id, filter_fixed, subtask), so this is only computed once.
+
+		:param state_id: id of the state
+		:param subtask: name of the current subtask
+		:param filter_fixed: whether to leave out the fixed states
+		:return: tuple with the state ids and a read-only numpy array
+			with their probabilities (empty if there are no transitions)
+		"""
+		if subtask not in self._probabilities:
+			subtask = None
+		key = (state_id, filter_fixed, subtask)
+		if key not in self._distributions:
+			targets = self._adjacency[subtask][state_id]
+			probabilities = self._probabilities[subtask][state_id]
+			if filter_fixed and len(targets) > 0:
+				keep = ~self._is_fixed[list(targets)]
+				targets = tuple(
+					target for target, kept in zip(targets, keep) if kept)
+				# only renormalise what is left, do not spread the
+				# probability evenly like _normalise() would if all are 0
+				probabilities = probabilities[keep]
+				if probabilities.sum() > 0:
+					probabilities = probabilities / probabilities.sum()
+				probabilities.flags.writeable = False
+
+			self._distributions[key] = (targets, probabilities)
+
+		return self._distributions[key]
+
+	def _get_adjacency(self, subtask: Optional[str]):
+		if subtask not in self._adjacency:
+			subtask = None
+		return self._adjacency[subtask]
+
+
+def _normalise(probabilities: numpy.ndarray) -> numpy.ndarray:
+	"""
+	Normalises a vector of probabilities so it sums to 1. If all of them
+	are 0, each element gets the same probability.
+
+	:param probabilities: numpy array with probabilities
+	:return: read-only numpy array
+	"""
+	total = probabilities.sum()
+	if len(probabilities) > 0:
+		if total > 0:
+			probabilities = probabilities / total
+		else:
+			probabilities = numpy.full(len(probabilities), 1 / len(probabilities))
+
+	probabilities.flags.writeable = False
+	return probabilities
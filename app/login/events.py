@@ -7,6 +7,7 @@ from flask_login import login_required, current_user, logout_user
 
 from .. import db, socketio
 from ..api.log import log_event
+from ..crwiz.task_manager import task_manager
 
 
 @socketio.on('connect')
@@ -25,6 +26,11 @@ def connect():
             room.current_users.append(current_user)
 
         if room.name.startswith("wizard_task"):
+            # the user may have missed status updates while disconnected
+            active_room = task_manager.get_active_room(room.name)
+            if active_room is not None:
+                active_room.mark_status_dirty()
+
             # user has connected back, let the bot know
             socketio.emit('user_connect', {
                 'user': {
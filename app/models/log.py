@@ -1,3 +1,10 @@
+import types
+import threading
+import collections
+import collections.abc
+from logging import getLogger
+from typing import Dict, List, Optional, Tuple
+
 from .. import db
 
 from . import Base
@@ -5,6 +12,16 @@ from . import Base
 import bson
 
 
+# buffered logs are written once there are this many of them...
+LOG_BUFFER_SIZE = 50
+# ...or once the oldest of them has waited for this many seconds
+LOG_BUFFER_SECONDS = 2
+# number of logs loaded per query when iterating over them (see iter_logs)
+LOG_PAGE_SIZE = 500
+# max number of (user, event) logs kept in the event_cache
+EVENT_CACHE_MAX_SIZE = 10000
+
+
 class Log(Base):
     __tablename__ = 'Log'
 
@@ -13,6 +30,12 @@ class Log(Base):
     room_id = db.Column(db.String(100), db.ForeignKey("Room.name"))
     data = db.Column(db.LargeBinary, nullable=False)
 
+    # the log queries filter by user or room and event, ordered by id
+    __table_args__ = (
+        db.Index('ix_Log_user_id_event_id', 'user_id', 'event', 'id'),
+        db.Index('ix_Log_room_id_event_id', 'room_id', 'event', 'id'),
+    )
+
     def as_dict(self):
         base = dict({
             'event': self.event,
@@ -26,43 +49,399 @@ class Log(Base):
         return dict(base)
 
 
+class LogView(collections.abc.Mapping):
+    """
+    Read-only log with the same keys as Log.as_dict(), built from the
+    columns of a query instead of a Log object. The data is only
+    decoded (and the dates converted) the first time they are accessed.
+    Columns that were not loaded are not part of the view, except for
+    the user name, which is None.
+    """
+
+    __slots__ = ('_columns', '_values')
+
+    def __init__(self, **columns):
+        self._columns = columns
+        self._values = {}
+
+    def __getitem__(self, key):
+        if key not in self._values:
+            self._values[key] = self._load(key)
+        return self._values[key]
+
+    def __iter__(self):
+        return (key for key in _LOG_VIEW_KEYS if key in self)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
+
+    def __contains__(self, key) -> bool:
+        return key in _LOG_VIEW_KEYS and _LOG_VIEW_KEYS[key] in self._columns
+
+    def _load(self, key):
+        if key not in self:
+            raise KeyError(key)
+
+        if key == 'user':
+            return {
+                'id': self._columns['user_id'],
+                'name': self._columns.get('user_name'),
+            }
+        elif key == 'data':
+            return bson.loads(self._columns['data'])
+        elif key in ('date_created', 'date_modified'):
+            return self._columns[key].timestamp()
+        else:
+            return self._columns[_LOG_VIEW_KEYS[key]]
+
+    def as_dict(self) -> dict:
+        """
+        Returns the log as a dict, decoding everything.
+
+        :return: dict
+        """
+        return {key: self[key] for key in self}
+
+
+# keys of a LogView with the column needed for each of them
+_LOG_VIEW_KEYS = {
+    'event': 'event',
+    'user': 'user_id',
+    'room': 'room_id',
+    'data': 'data',
+    'id': 'id',
+    'date_created': 'date_created',
+    'date_modified': 'date_modified',
+}
+
+
+class LogBuffer:
+    """
+    Buffers Log rows and writes them with a single multi-row INSERT once
+    there are LOG_BUFFER_SIZE of them or LOG_BUFFER_SECONDS have passed.
+    The buffered rows do not have an id until they are written.
+    Call flush() before reading logs that may still be buffered.
+    The rows are written in their own transaction, so flushing never commits
+    or rolls back the session of the caller (except with an in-memory SQLite
+    database, which only has one connection). If the rows cannot be written,
+    they are kept and written in the next flush.
+    """
+
+    def __init__(self):
+        self._rows: List[dict] = []
+        self._lock = threading.Lock()
+        self._timer = None
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def add(self, row: dict):
+        """
+        Adds a row to the buffer, writing the buffer if it is full.
+
+        :param row: dict with the Log columns
+        :return: None
+        """
+        with self._lock:
+            self._rows.append(row)
+            is_full = len(self._rows) >= LOG_BUFFER_SIZE
+            if not is_full:
+                self._start_timer()
+
+        if is_full:
+            self.flush()
+
+    def flush(self) -> bool:
+        """
+        Writes all the buffered rows to the database.
+
+        :return: True if the rows were written (or there were none)
+        """
+        with self._lock:
+            rows, self._rows = self._rows, []
+            self._cancel_timer()
+
+        if len(rows) == 0:
+            return True
+
+        try:
+            with db.engine.begin() as connection:
+                connection.execute(Log.__table__.insert(), rows)
+        except Exception as ex:
+            # put the rows back in front of the ones added meanwhile
+            with self._lock:
+                self._rows[:0] = rows
+                self._start_timer()
+            getLogger("slurk").exception(
+                f"Could not write {len(rows)} buffered logs, "
+                f"retrying in {LOG_BUFFER_SECONDS} seconds: {ex}")
+            return False
+
+        return True
+
+    def _flush_on_timer(self):
+        self.flush()
+
+    def _start_timer(self):
+        # must be called with the lock acquired
+        if self._timer is None:
+            from ..crwiz.utils.scheduler import scheduler
+            self._timer = scheduler.schedule(
+                ('log_buffer', id(self)), LOG_BUFFER_SECONDS, self._flush_on_timer)
+
+    def _cancel_timer(self):
+        # must be called with the lock acquired
+        if self._timer is not None:
+            from ..crwiz.utils.scheduler import scheduler
+            scheduler.cancel(self._timer)
+            self._timer = None
+
+
+log_buffer = LogBuffer()
+
+
+def create_log_indexes():
+    """
+    Creates the indexes of the Log table if they do not exist yet.
+    db.create_all() only creates them along with a new table, so this
+    adds them to databases created before they existed.
+
+    :return: None
+    """
+    for index in Log.__table__.indexes:
+        index.create(bind=db.engine, checkfirst=True)
+
+
+def query_logs(
+    *criteria, order_desc: bool = True, limit: int = None,
+    after_id: int = None, user_names: bool = True, data: bool = True) -> list:
+    """
+    Gets the logs that match the given criteria ordered by id.
+    Only the needed columns are loaded and the data is decoded on first use.
+
+    :param criteria: SQLAlchemy filter criteria (e.g. Log.event == 'join')
+    :param order_desc: True to start from the most recent log
+    :param limit: maximum number of logs to return, None for all of them
+    :param after_id: only get logs with a greater id than this one
+    :param user_names: whether to load the name of the users ('user' key)
+    :param data: whether to load the data of the logs ('data' key)
+    :return: list with logs as LogView
+    """
+    from .user import User
+
+    columns = [
+        Log.id, Log.event, Log.user_id, Log.room_id,
+        Log.date_created, Log.date_modified]
+    if data:
+        columns.append(Log.data)
+    query = db.session.query(*columns)
+    if user_names:
+        query = query.add_columns(User._name.label('user_name'))\
+            .outerjoin(User, User.id == Log.user_id)
+
+    query = query.filter(*criteria)
+    if after_id is not None:
+        query = query.filter(Log.id > after_id)
+    query = query.order_by(Log.id.desc() if order_desc else Log.id.asc())
+    if limit is not None:
+        query = query.limit(limit)
+
+    return [LogView(**row._asdict()) for row in query.all()]
+
+
+def iter_logs(*criteria, since_id: int = None, page_size: int = None):
+    """
+    Iterates over the logs that match the given criteria from the oldest,
+    loading them in pages by id so only one page is in memory at a time.
+
+    :param criteria: SQLAlchemy filter criteria (e.g. Log.event == 'join')
+    :param since_id: only get logs with a greater id than this one
+    :param page_size: number of logs per query, defaults to LOG_PAGE_SIZE
+    :return: generator of logs as LogView
+    """
+    log_buffer.flush()
+    page_size = page_size or LOG_PAGE_SIZE
+    last_id = since_id
+    while True:
+        logs = query_logs(
+            *criteria, order_desc=False, limit=page_size, after_id=last_id)
+        yield from logs
+        if len(logs) < page_size:
+            break
+        last_id = logs[-1]['id']
+
+
 def get_user_logs_for_event(
-    user_id, event_name: str, order_desc: bool = True) -> list:
+    user_id, event_name: str, order_desc: bool = True,
+    limit: int = None, after_id: int = None) -> list:
     """
     Gets all the logs for a particular user event starting from
     the most recent one.
 
     :param user_id: id of the user responsible for the event
     :param event_name: name of the event
-    :return: list with logs as dict
+    :param order_desc: True to start from the most recent log
+    :param limit: maximum number of logs to return, None for all of them
+    :param after_id: only get logs with a greater id than this one
+    :return: list with logs as LogView
     """
-    order_by = Log.id.desc() if order_desc else Log.id.asc()
-    logs = Log.query.order_by(order_by).filter(
+    log_buffer.flush()
+    return query_logs(
         Log.user_id == user_id,
-        Log.event == event_name
-    ).all()
-    if logs:
-        return [log.as_dict() for log in logs]
-    else:
-        return []
+        Log.event == event_name,
+        order_desc=order_desc, limit=limit, after_id=after_id)
 
 
 def get_room_logs_for_event(
-    room_name: str, event_name: str, order_desc: bool = True) -> list:
+    room_name: str, event_name: str, order_desc: bool = True,
+    limit: int = None, after_id: int = None) -> list:
     """
     Gets all the logs for a particular room event starting from
     the most recent one.
 
     :param room_name: room id to search for events
     :param event_name: name of the event
-    :return: list with logs as dict
+    :param order_desc: True to start from the most recent log
+    :param limit: maximum number of logs to return, None for all of them
+    :param after_id: only get logs with a greater id than this one
+    :return: list with logs as LogView
     """
-    order_by = Log.id.desc() if order_desc else Log.id.asc()
-    logs = Log.query.order_by(order_by).filter(
+    log_buffer.flush()
+    return query_logs(
         Log.room_id == room_name,
-        Log.event == event_name
-    ).all()
-    if logs:
-        return [log.as_dict() for log in logs]
-    else:
-        return []
+        Log.event == event_name,
+        order_desc=order_desc, limit=limit, after_id=after_id)
+
+
+class EventCache:
+    """
+    Cache with the latest logged event of each type for each user, limited to
+    EVENT_CACHE_MAX_SIZE entries (the least recently used are dropped first).
+    Events are grouped by room, so they can be dropped once the room is closed.
+    The cached logs are in the same format as Log.as_dict(), but frozen (see
+    freeze()) when they are added, so they can be handed out without copying.
+
+    The cache only sees the events logged by this process, so it must be
+    disabled if other processes log events for the same users (e.g. when
+    the room state backend is shared by several workers).
+    """
+
+    def __init__(self, max_size: int = None):
+        self.enabled = True
+        self._max_size = max_size or EVENT_CACHE_MAX_SIZE
+        self._latest: "collections.OrderedDict[Tuple[int, str], dict]" = \
+            collections.OrderedDict()
+        self._rooms: Dict[Optional[str], set] = {}
+
+    def __len__(self) -> int:
+        return len(self._latest)
+
+    def set_enabled(self, enabled: bool):
+        """
+        Enables or disables the cache, dropping what it had.
+
+        :param enabled: whether to cache the events
+        :return: None
+        """
+        self.enabled = enabled
+        self._latest.clear()
+        self._rooms.clear()
+
+    def add(self, log: collections.abc.Mapping):
+        """
+        Adds a log to the cache if it is newer than the one cached for
+        the same user and event. Logs without id (still buffered) are
+        always newer.
+
+        :param log: log as dict (or LogView)
+        :return: None
+        """
+        if not self.enabled:
+            return
+
+        key = (log['user']['id'], log['event'])
+        cached_log = self._latest.get(key)
+        if cached_log is None or log['id'] is None \
+                or cached_log['id'] is None or cached_log['id'] < log['id']:
+            if cached_log is not None:
+                self._discard_room_key(cached_log['room'], key)
+            self._latest[key] = freeze(log)
+            self._latest.move_to_end(key)
+            self._rooms.setdefault(log['room'], set()).add(key)
+
+            while len(self._latest) > self._max_size:
+                old_key, old_log = self._latest.popitem(last=False)
+                self._discard_room_key(old_log['room'], old_key)
+
+    def get_latest(self, user_id, event_name: str) -> Optional[dict]:
+        """
+        Gets the latest cached log of an event for a user.
+
+        :param user_id: id of the user responsible for the event
+        :param event_name: name of the event
+        :return: frozen log or None if not cached
+        """
+        key = (user_id, event_name)
+        log = self._latest.get(key)
+        if log is not None:
+            self._latest.move_to_end(key)
+        return log
+
+    def clear_room(self, room_name: str):
+        """
+        Drops the cached logs that happened in a room.
+
+        :param room_name: name of the room
+        :return: None
+        """
+        for key in self._rooms.pop(room_name, set()):
+            if key in self._latest and self._latest[key]['room'] == room_name:
+                del self._latest[key]
+
+    def _discard_room_key(self, room_name: Optional[str], key: Tuple[int, str]):
+        keys = self._rooms.get(room_name)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._rooms[room_name]
+
+
+event_cache = EventCache()
+
+
+def freeze(value):
+    """
+    Returns a read-only copy of a value, with the mappings as MappingProxyType
+    and the lists as tuples. Values that cannot change are not copied.
+
+    :param value: value to freeze (e.g. a log)
+    :return: frozen value
+    """
+    if isinstance(value, types.MappingProxyType):
+        return value
+    if isinstance(value, collections.abc.Mapping):
+        return types.MappingProxyType({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, (set, frozenset)):
+        return frozenset(value)
+    return value
+
+
+def get_last_user_log_for_event(user_id, event_name: str) -> Optional[dict]:
+    """
+    Gets the latest log for a particular user event. It is answered from
+    the event_cache if possible, otherwise it only queries the latest log.
+
+    :param user_id: id of the user responsible for the event
+    :param event_name: name of the event
+    :return: read-only log or None if there are no logs
+    """
+    log = event_cache.get_latest(user_id, event_name)
+    if log is None:
+        logs = get_user_logs_for_event(user_id, event_name, limit=1)
+        if len(logs) > 0:
+            log = logs[0]
+            event_cache.add(log)
+
+    return log
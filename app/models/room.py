@@ -1,7 +1,7 @@
 from .. import db
 
 from . import user_room, current_user_room
-from .log import Log
+from .log import Log, query_logs, log_buffer
 
 
 ROOM_NAME_WAITING: str = "waiting_room"
@@ -37,22 +37,31 @@ class Room(db.Model):
         }
 
 
-def get_room_user_messages(room_id, minimum_id=0, bot_msgs=False) -> list:
-    logs = Log.query.order_by(Log.id.desc())\
-        .filter(
-            Log.room_id == room_id,
-            Log.event == "text_message",
-            Log.id > minimum_id)\
-        .all()
-    if logs:
-        logs = [log.as_dict() for log in logs]
-        logs = [log for log in logs if bot_msgs or log['user']['id'] > 2]
-        return logs
-    return []
+def get_room_user_messages(
+        room_id, minimum_id=0, bot_msgs=False, limit: int = None) -> list:
+    criteria = [Log.room_id == room_id, Log.event == "text_message"]
+    if not bot_msgs:
+        # the bots always have the first user ids
+        criteria.append(Log.user_id > 2)
+    return query_logs(*criteria, limit=limit, after_id=minimum_id)
+
+
+def count_room_user_messages(room_id) -> dict:
+    """
+    Counts the messages sent by each user in a room.
+
+    :param room_id: name of the room
+    :return: dict with {user_id: number of messages}
+    """
+    log_buffer.flush()
+    rows = db.session.query(Log.user_id, db.func.count(Log.id))\
+        .filter(Log.room_id == room_id, Log.event == "text_message")\
+        .group_by(Log.user_id).all()
+    return {user_id: count for user_id, count in rows}
 
 
 def get_room_last_user_message(room_id):
-    logs = get_room_user_messages(room_id)
+    logs = get_room_user_messages(room_id, limit=1)
     if len(logs) > 0:
         return logs[0]
     return None
@@ -8,7 +8,7 @@ from .. import db, login_manager
 from . import Base, user_room, current_user_room
 
 from .token import Token
-from .log import Log
+from .log import Log, query_logs
 
 
 class UserRole(enum.Enum):
@@ -136,17 +136,18 @@ def load_user_from_request(request):
     return None
 
 
-def get_user_messages(user_id, order_desc: bool = True) -> list:
-    order_by = Log.id.desc() if order_desc else Log.id.asc()
-    logs = Log.query.order_by(order_by).filter(Log.user_id == user_id)\
-        .filter(Log.event == "text_message").all()
-    if logs:
-        return [log.as_dict() for log in logs]
-    return []
+def get_user_messages(
+        user_id, order_desc: bool = True,
+        limit: int = None, after_id: int = None, data: bool = True) -> list:
+    return query_logs(
+        Log.user_id == user_id,
+        Log.event == "text_message",
+        order_desc=order_desc, limit=limit, after_id=after_id,
+        user_names=data, data=data)
 
 
 def get_user_last_message(user_id):
-    logs = get_user_messages(user_id)
+    logs = get_user_messages(user_id, limit=1)
     if len(logs) > 0:
         return logs[0]['data']['message']
     return None
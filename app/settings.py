@@ -6,6 +6,11 @@ class Settings:
     debug = False
     database_url = None
     drop_database_on_startup = None
+    room_state_backend = None
+    socketio_message_queue = None
+    instances = []
+    instance_id = None
+    knowledge_base_reload_seconds = 0
 
     @classmethod
     def from_object(cls, obj):
@@ -16,5 +21,10 @@ class Settings:
         cls.debug = getattr(obj, "DEBUG")
         cls.database_url = getattr(obj, "SQLALCHEMY_DATABASE_URI")
         cls.drop_database_on_startup = getattr(obj, "DROP_DATABASE_ON_STARTUP")
+        cls.room_state_backend = getattr(obj, "ROOM_STATE_BACKEND", None)
+        cls.socketio_message_queue = getattr(obj, "SOCKETIO_MESSAGE_QUEUE", None)
+        cls.instances = getattr(obj, "INSTANCES", [])
+        cls.instance_id = getattr(obj, "INSTANCE_ID", None)
+        cls.knowledge_base_reload_seconds = getattr(obj, "KNOWLEDGE_BASE_RELOAD_SECONDS", 0)
 
         return cls
@@ -88,7 +88,7 @@ class ChatNamespace(BaseNamespace):
 
     def start_timer(self):
         logger.info("Sending control message to avoid DB timeout")
-        log_utils.get_room_logs(uri, token, "waiting_room")
+        log_utils.check_health(uri)
         self.timer_thread = threading.Timer(DB_TIMER, self.start_timer)
         self.timer_thread.start()
 
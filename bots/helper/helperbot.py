@@ -12,12 +12,15 @@ from socketIO_client import BaseNamespace, SocketIO
 
 
 TIMER_DISCONNECTED_USER = 15  # how long to wait before closing the room in seconds
+ANALYSIS_CHECK_SECONDS = 10  # how often to check if the analysis of a room is done
+ANALYSIS_MAX_CHECKS = 60  # how many times to check before giving up
 
-# import log_utils from crwiz using a relative path (to avoid issues in deployment)
+# import log_utils and scheduler from crwiz using a relative path (to avoid issues in deployment)
 root_folder = os.path.join(os.path.split(os.path.abspath(__file__))[0], "..", "..")
 sys.path.insert(0, os.path.join(root_folder, "app", "crwiz", "utils"))
 sys.path.insert(0, os.path.join(root_folder, "app"))
 import log_utils
+from scheduler import scheduler
 
 logging.config.fileConfig(
 	fname=os.path.join(root_folder, "bots", "logging.conf"),
@@ -92,6 +95,7 @@ class ChatNamespace(BaseNamespace):
 			return
 		else:
 			self.terminated = True
+			scheduler.stop()
 
 	def on_user_connect(self, data):
 		"""
@@ -104,6 +108,7 @@ class ChatNamespace(BaseNamespace):
 		"""
 		if data['user']['id'] in self.disconnected_users:
 			self.disconnected_users.remove(data['user']['id'])
+			scheduler.cancel(('disconnected_user', data['user']['id']))
 
 			# send messages to users
 			for user_id in data['room']['users']:
@@ -215,7 +220,7 @@ class ChatNamespace(BaseNamespace):
 
 		# allow 1 second before sending the final messages
 		# so user's messages do not get mixed
-		threading.Timer(1, self.send_task_finished_messages, [data]).start()
+		scheduler.schedule(None, 1, self.send_task_finished_messages, [data])
 
 	def send_task_finished_messages(self, data):
 		room_name = data.get('room_name')
@@ -254,16 +259,42 @@ class ChatNamespace(BaseNamespace):
 
 		# wait a bit to leave the room so the users get these messages
 		# before closing the room permanently
-		threading.Timer(1, self.leave_task_room, [room_name]).start()
+		scheduler.schedule(None, 1, self.leave_task_room, [room_name])
 
 	def leave_task_room(self, room_name):
 		self.emit("leave_room", {'room': room_name}, self.leave_room_feedback)
 
-		log_utils.export_room_logs(uri, token, room_name)
+		log_utils.export_room_logs_incremental(uri, token, room_name)
 
 		# report back to the server that the bot has finished with the room
 		self.emit("close_room_feedback", {'room_name': room_name})
 
+		# the post-task analysis runs in the background in the server
+		scheduler.schedule(
+			None, ANALYSIS_CHECK_SECONDS, self.export_room_analysis, [room_name, 1])
+
+	def export_room_analysis(self, room_name, checks):
+		"""
+		Exports the logs of the room again once its post-task analysis is
+		done, so the analysis is appended to them.
+
+		:param room_name: name of the room
+		:param checks: number of times the analysis has been checked
+		:return: None
+		"""
+		job = log_utils.get_room_analysis(uri, token, room_name)
+		status = job['status'] if job is not None else None
+
+		if status == "done":
+			log_utils.export_room_logs_incremental(uri, token, room_name)
+		elif status == "failed":
+			logger.error(f"Post-task analysis of room '{room_name}' failed: {job.get('error')}")
+		elif checks < ANALYSIS_MAX_CHECKS:
+			scheduler.schedule(
+				None, ANALYSIS_CHECK_SECONDS, self.export_room_analysis, [room_name, checks + 1])
+		else:
+			logger.error(f"Post-task analysis of room '{room_name}' is not done, giving up")
+
 	def on_user_finish_task(self, data):
 		"""
 		Triggered when the user has decided to end the task.
@@ -292,9 +323,9 @@ class ChatNamespace(BaseNamespace):
 				}, self.message_response)
 
 	def start_disconnected_user_timer(self, room_name, user_id):
-		threading.Timer(
-			TIMER_DISCONNECTED_USER,
-			self.trigger_disconnected_user_timer, [room_name, user_id]).start()
+		scheduler.schedule(
+			('disconnected_user', user_id), TIMER_DISCONNECTED_USER,
+			self.trigger_disconnected_user_timer, [room_name, user_id])
 
 	def trigger_disconnected_user_timer(self, room_name, user_id):
 		if user_id in self.disconnected_users:
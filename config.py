@@ -31,6 +31,38 @@ if not SECRET_KEY:
 SQLALCHEMY_DATABASE_URI = os.environ.get("DATABASE_URL", default="sqlite:///:memory:")
 SQLALCHEMY_TRACK_MODIFICATIONS = environ_as_boolean("DATABASE_TRACK_MODIFICATIONS", default=False)
 SQLALCHEMY_ECHO = environ_as_boolean("DATABASE_ECHO", default=False)
+# the buffered logs are written in their own transaction (see LogBuffer), so the
+# requests must see what other transactions committed after they started
+SQLALCHEMY_ENGINE_OPTIONS = \
+    {"isolation_level": "READ COMMITTED"} if SQLALCHEMY_DATABASE_URI.startswith("mysql") else {}
 DROP_DATABASE_ON_STARTUP = environ_as_boolean("DROP_DATABASE_ON_STARTUP", default=False)
 # SQLALCHEMY_POOL_SIZE = 50
 # SQLALCHEMY_POOL_RECYCLE = 3600
+
+
+# Multiple workers config
+# where the state of the active rooms is kept (memory://, sqlite:///path or redis://host:port/db)
+ROOM_STATE_BACKEND = os.environ.get("ROOM_STATE_BACKEND", default="memory://")
+# message queue so the workers can emit to clients connected to other workers (e.g. redis://)
+SOCKETIO_MESSAGE_QUEUE = os.environ.get("SOCKETIO_MESSAGE_QUEUE", default=None)
+# instances (each one a gunicorn with its own workers) that serve the wizard_task rooms
+# (comma separated ids), each room is owned by one of them (see HashRing) and the proxy
+# must send its requests there. Empty means that any instance serves any room
+INSTANCES = [instance for instance in os.environ.get("INSTANCES", default="").split(",") if instance]
+INSTANCE_ID = os.environ.get("INSTANCE_ID", default=None)
+# gunicorn starts this many worker processes if -w is not given (see Procfile)
+WEB_CONCURRENCY = int(os.environ.get("WEB_CONCURRENCY", default=1))
+
+if max(WEB_CONCURRENCY, len(INSTANCES)) > 1:
+    # each worker would have its own rooms and could not emit to the clients of the others
+    if not ROOM_STATE_BACKEND or ROOM_STATE_BACKEND.startswith("memory://"):
+        raise ValueError("ROOM_STATE_BACKEND must be shared (sqlite or redis) to run several workers")
+    if not SOCKETIO_MESSAGE_QUEUE:
+        raise ValueError("SOCKETIO_MESSAGE_QUEUE not set to run several workers")
+if INSTANCES and INSTANCE_ID not in INSTANCES:
+    # the instance would not own any room, so it would reject every request about them
+    raise ValueError("INSTANCE_ID must be one of INSTANCES")
+
+# Knowledge base config
+# seconds between checks for changes in the dialogue state files, 0 to disable reloading
+KNOWLEDGE_BASE_RELOAD_SECONDS = float(os.environ.get("KNOWLEDGE_BASE_RELOAD_SECONDS", default=0))
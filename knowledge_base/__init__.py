@@ -0,0 +1,11 @@
+"""
+knowledge_base
+--------------
+
+Dialogue states of the Wizard (see dialogue_states/) and the tools to work
+with them offline, without starting the app:
+
+- python -m knowledge_base.snapshot build|verify
+- python -m knowledge_base.validate
+- python -m knowledge_base.simulate
+"""
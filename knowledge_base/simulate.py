@@ -0,0 +1,118 @@
+"""
+simulate
+--------
+
+Simulates the dialogues of the dialogue states as a Markov chain, to estimate
+their expected length, how likely they are to finish and how accurate the
+hints are before running a study.
+
+Usage (from the root folder):
+	python -m knowledge_base.simulate [-f FOLDER] [-j PROCESSES] [-n WALKS] [-s MAX_STEPS] [--seed SEED]
+"""
+
+import argparse
+import os
+import sys
+import time
+import types
+
+# import the modules from crwiz using a relative path (they do not need the app)
+root_folder = os.path.join(os.path.split(os.path.abspath(__file__))[0], "..")
+sys.path.insert(0, os.path.join(root_folder, "app", "crwiz", "utils"))
+import dialogue_simulator
+import knowledge_base_snapshot
+import knowledge_base_validator
+import transition_graph
+
+
+DIALOGUE_STATES_FOLDER = os.path.join(root_folder, "knowledge_base", "dialogue_states")
+
+
+def load_graph(folder_path: str, processes: int = None) -> transition_graph.TransitionGraph:
+	files = []
+	for file_name in knowledge_base_snapshot.list_state_files(folder_path):
+		with open(os.path.join(folder_path, file_name), 'rb') as file:
+			files.append((file_name, file.read()))
+
+	# merged like the app does, the last state with a name wins
+	states = {}
+	for (file_name, _), result in zip(files, knowledge_base_snapshot.parse_state_files(files, processes)):
+		if isinstance(result, knowledge_base_snapshot.StateFileError):
+			raise knowledge_base_snapshot.StateFileError(f"{file_name}: {result}")
+		for properties in result:
+			states[properties['name']] = types.SimpleNamespace(
+				transitions=properties['transition_states'], **properties)
+
+	return transition_graph.TransitionGraph(states)
+
+
+def simulate(
+	folder_path: str, processes: int = None, walks: int = dialogue_simulator.DEFAULT_WALKS,
+	max_steps: int = dialogue_simulator.DEFAULT_MAX_STEPS, seed: int = None) -> int:
+	try:
+		graph = load_graph(folder_path, processes)
+	except knowledge_base_snapshot.StateFileError as ex:
+		print(ex, file=sys.stderr)
+		return 1
+
+	for state_name in (knowledge_base_validator.INITIAL_STATE, knowledge_base_validator.END_STATE):
+		if state_name not in graph:
+			print(f"State '{state_name}' does not exist", file=sys.stderr)
+			return 1
+
+	chain = dialogue_simulator.DialogueChain(
+		graph, knowledge_base_validator.INITIAL_STATE, knowledge_base_validator.END_STATE,
+		knowledge_base_validator.INITIAL_SUBTASK, knowledge_base_validator.SUBTASK_MILESTONES)
+
+	start_time = time.time()
+	print("Absorbing chain:")
+	for name, value in chain.analyse().items():
+		print(f"  {name}: {_format(value)}")
+	print(f"  ({time.time() - start_time:.3f}s)")
+
+	start_time = time.time()
+	print(f"Simulation of {walks} dialogues (max {max_steps} steps):")
+	for name, value in chain.simulate(walks, max_steps, seed).items():
+		if isinstance(value, dict):
+			for state_name, rate in value.items():
+				print(f"  {name} {state_name}: {_format(rate)}")
+		else:
+			print(f"  {name}: {_format(value)}")
+	print(f"  ({time.time() - start_time:.3f}s)")
+	return 0
+
+
+def _format(value) -> str:
+	return f"{value:.4f}" if isinstance(value, float) else str(value)
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		description='Simulate the dialogues of the dialogue states')
+	parser.add_argument(
+		'-f', '--folder',
+		help='folder with the dialogue state files',
+		default=DIALOGUE_STATES_FOLDER)
+	parser.add_argument(
+		'-j', '--processes',
+		type=int,
+		help='max number of processes to parse the files (number of CPUs by default)',
+		default=None)
+	parser.add_argument(
+		'-n', '--walks',
+		type=int,
+		help='number of dialogues to simulate',
+		default=dialogue_simulator.DEFAULT_WALKS)
+	parser.add_argument(
+		'-s', '--max-steps',
+		type=int,
+		help='max number of steps of each dialogue',
+		default=dialogue_simulator.DEFAULT_MAX_STEPS)
+	parser.add_argument(
+		'--seed',
+		type=int,
+		help='seed of the random numbers, for repeatable results',
+		default=None)
+	args = parser.parse_args()
+
+	sys.exit(simulate(args.folder, args.processes, args.walks, args.max_steps, args.seed))
@@ -0,0 +1,70 @@
+"""
+snapshot
+--------
+
+Builds and verifies the compiled snapshot of the dialogue states, which the
+app loads instead of the YAML files while they do not change.
+
+Usage (from the root folder):
+	python -m knowledge_base.snapshot build [-f FOLDER] [-o OUTPUT] [-j PROCESSES]
+	python -m knowledge_base.snapshot verify [-f FOLDER] [-o OUTPUT]
+"""
+
+import argparse
+import os
+import sys
+
+# import knowledge_base_snapshot from crwiz using a relative path (it does not need the app)
+root_folder = os.path.join(os.path.split(os.path.abspath(__file__))[0], "..")
+sys.path.insert(0, os.path.join(root_folder, "app", "crwiz", "utils"))
+import knowledge_base_snapshot
+
+
+DIALOGUE_STATES_FOLDER = os.path.join(root_folder, "knowledge_base", "dialogue_states")
+
+
+def build(folder_path: str, path: str = None, processes: int = None) -> int:
+	try:
+		path, states, seconds = knowledge_base_snapshot.build_snapshot(
+			folder_path, path, processes)
+	except knowledge_base_snapshot.StateFileError as ex:
+		print(ex, file=sys.stderr)
+		return 1
+	print(f"Snapshot '{os.path.normpath(path)}' built with {states} states in {seconds:.3f}s")
+	return 0
+
+
+def verify(folder_path: str, path: str = None) -> int:
+	problems = knowledge_base_snapshot.verify_snapshot(folder_path, path)
+	for problem in problems:
+		print(problem, file=sys.stderr)
+
+	if problems:
+		return 1
+	print("Snapshot is up to date")
+	return 0
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(
+		description='Build or verify the snapshot of the dialogue states')
+	parser.add_argument('command', choices=['build', 'verify'])
+	parser.add_argument(
+		'-f', '--folder',
+		help='folder with the dialogue state files',
+		default=DIALOGUE_STATES_FOLDER)
+	parser.add_argument(
+		'-o', '--output',
+		help='path of the snapshot (next to the folder by default)',
+		default=None)
+	parser.add_argument(
+		'-j', '--processes',
+		type=int,
+		help='max number of processes to parse the files (number of CPUs by default)',
+		default=None)
+	args = parser.parse_args()
+
+	if args.command == 'build':
+		sys.exit(build(args.folder, args.output, args.processes))
+	else:
+		sys.exit(verify(args.folder, args.output))
@@ -0,0 +1,79 @@
+"""
+validate
+--------
+
+Validates the dialogue states (references, reachability from the initial
+state, dead ends and probabilities) and prints metrics of their graph, so
+problems in the knowledge base are found before deploying it.
+
+Usage (from the root folder):
+	python -m knowledge_base.validate [-f FOLDER] [-j PROCESSES] [--strict]
+
+Exits with 1 if there are errors (or warnings, with --strict).
+"""
+
+import argparse
+import os
+import sys
+
+# import the modules from crwiz using a relative path (they do not need the app)
+root_folder = os.path.join(os.path.split(os.path.abspath(__file__))[0], "..")
+sys.path.insert(0, os.path.join(root_folder, "app", "crwiz", "utils"))
+import constants
+import knowledge_base_snapshot
+import knowledge_base_validator
+
+
+DIALOGUE_STATES_FOLDER = os.path.join(root_folder, "knowledge_base", "dialogue_states")
+
+
+def validate(folder_path: str, processes: int = None, strict: bool = False) -> int:
+	files = []
+	for file_name in knowledge_base_snapshot.list_state_files(folder_path):
+		with open(os.path.join(folder_path, file_name), 'rb') as file:
+			files.append((file_name, file.read()))
+
+	file_states = []
+	parse_errors = []
+	results = knowledge_base_snapshot.parse_state_files(files, processes)
+	for (file_name, _), result in zip(files, results):
+		if isinstance(result, knowledge_base_snapshot.StateFileError):
+			parse_errors.append((file_name, result))
+		else:
+			file_states.append((file_name, result))
+
+	report = knowledge_base_validator.validate_states(
+		file_states, constants.STATES_WITH_PROBABILITY_MAPPING)
+
+	for file_name, error in parse_errors:
+		print(f"ERROR {file_name}: {error}", file=sys.stderr)
+	for issue in report.issues:
+		print(issue, file=sys.stderr)
+
+	print(f"files: {len(files)}")
+	for name, value in report.metrics.items():
+		print(f"{name}: {value}")
+
+	errors = len(parse_errors) + len(report.errors)
+	print(f"{errors} errors, {len(report.warnings)} warnings")
+	return 1 if errors or (strict and report.warnings) else 0
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='Validate the dialogue states')
+	parser.add_argument(
+		'-f', '--folder',
+		help='folder with the dialogue state files',
+		default=DIALOGUE_STATES_FOLDER)
+	parser.add_argument(
+		'-j', '--processes',
+		type=int,
+		help='max number of processes to parse the files (number of CPUs by default)',
+		default=None)
+	parser.add_argument(
+		'--strict',
+		action='store_true',
+		help='exit with an error if there are warnings too')
+	args = parser.parse_args()
+
+	sys.exit(validate(args.folder, args.processes, args.strict))
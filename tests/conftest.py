@@ -0,0 +1,6 @@
+import os
+import sys
+
+# the tests import the modules of crwiz/utils directly, without starting the app
+sys.path.insert(0, os.path.join(
+	os.path.split(os.path.abspath(__file__))[0], "..", "app", "crwiz", "utils"))
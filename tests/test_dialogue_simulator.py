@@ -0,0 +1,101 @@
+import types
+
+import pytest
+
+import dialogue_simulator
+from dialogue_simulator import DialogueChain
+from transition_graph import TransitionGraph
+
+
+def create_graph(*states) -> TransitionGraph:
+	return TransitionGraph({state.name: state for state in states})
+
+
+def create_state(
+	name: str, probabilities: dict = None, subtask: str = None) -> types.SimpleNamespace:
+	probabilities = probabilities or {}
+	return types.SimpleNamespace(
+		name=name, transitions=list(probabilities), transition_probabilities=probabilities,
+		subtask=subtask, is_fixed=False)
+
+
+@pytest.fixture
+def chain():
+	# start -> ask, which repeats itself half of the times and otherwise
+	# ends the dialogue or reaches a dead end:
+	# - steps from ask: s = 1 + s / 2, so s = 2, and 3 from start
+	# - completion from ask: p = 1 / 4 + p / 2, so p = 1 / 2
+	# - hints (sum of squared probabilities): 1 at start and 3 / 8 for each
+	#   of the 2 visits to ask, so (1 + 3 / 4) / 3 = 7 / 12
+	# - best hints (max probability): 1 at start and 1 / 2 at ask, so 2 / 3
+	return DialogueChain(create_graph(
+		create_state('start', {'ask': 1}),
+		create_state('ask', {'ask': 0.5, 'end': 0.25, 'dead_end': 0.25}),
+		create_state('dead_end'),
+		create_state('end')), 'start', 'end', None, {})
+
+
+@pytest.fixture(params=["scipy", "iterative"])
+def solver(request, monkeypatch):
+	if request.param == "scipy":
+		if dialogue_simulator.scipy is None:
+			pytest.skip("scipy is not installed")
+	else:
+		monkeypatch.setattr(dialogue_simulator, "scipy", None)
+
+
+def test_analyse(chain, solver):
+	results = chain.analyse()
+	assert results['nodes'] == 4
+	assert results['transitions'] == 4
+	assert results['trapped_nodes'] == 0
+	assert results['expected_length'] == pytest.approx(3)
+	assert results['completion_probability'] == pytest.approx(0.5)
+	assert results['hint_accuracy'] == pytest.approx(7 / 12)
+	assert results['best_hint_accuracy'] == pytest.approx(2 / 3)
+
+
+def test_simulate_agrees_with_analyse(chain):
+	results = chain.simulate(walks=200000, seed=1)
+	assert results['walks'] == 200000
+	assert results['truncated_rate'] < 0.001
+	assert results['mean_length'] == pytest.approx(3, abs=0.05)
+	assert results['completion_rate'] == pytest.approx(0.5, abs=0.01)
+	assert results['dead_end_rate'] == pytest.approx(0.5, abs=0.01)
+	assert results['trapped_rate'] == 0
+	assert results['hint_accuracy'] == pytest.approx(7 / 12, abs=0.01)
+	assert results['best_hint_accuracy'] == pytest.approx(2 / 3, abs=0.01)
+
+
+def test_simulate_is_repeatable_with_a_seed(chain):
+	assert chain.simulate(walks=1000, seed=7) == chain.simulate(walks=1000, seed=7)
+
+
+def test_milestone_changes_the_subtask(solver):
+	# the end state is only available in the subtask that trigger changes to,
+	# so start always goes to trigger first
+	chain = DialogueChain(create_graph(
+		create_state('start', {'trigger': 0.5, 'end': 0.5}),
+		create_state('trigger', {'end': 1}),
+		create_state('end', subtask='finish')),
+		'start', 'end', 'introduction', {'trigger': 'finish'})
+
+	results = chain.analyse()
+	assert results['expected_length'] == pytest.approx(2)
+	assert results['completion_probability'] == pytest.approx(1)
+	assert chain.simulate(walks=100, seed=1)['milestone_rates'] == {'trigger': 1.0}
+
+
+def test_loop_without_end_is_trapped(solver):
+	chain = DialogueChain(create_graph(
+		create_state('start', {'ask': 1}),
+		create_state('ask', {'answer': 1}),
+		create_state('answer', {'ask': 1}),
+		create_state('end')), 'start', 'end', None, {})
+
+	results = chain.analyse()
+	assert results['trapped_nodes'] == 3
+	assert results['completion_probability'] == 0
+	simulation = chain.simulate(walks=10, seed=1)
+	assert simulation['trapped_rate'] == 1
+	assert simulation['mean_length'] == 0
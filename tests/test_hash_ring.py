@@ -0,0 +1,64 @@
+from hash_ring import HashRing
+
+
+ROOMS = [f"wizard_task-{index}" for index in range(1000)]
+
+
+def get_owners(ring: HashRing) -> dict:
+	return {room: ring.get_worker(room) for room in ROOMS}
+
+
+def test_empty_ring_has_no_owner():
+	ring = HashRing()
+	assert len(ring) == 0
+	assert ring.get_worker("wizard_task-1") is None
+
+
+def test_ownership_is_stable():
+	owners = get_owners(HashRing(["a", "b", "c"]))
+
+	# same workers in another order, or added one by one, give the same owners
+	assert get_owners(HashRing(["c", "a", "b"])) == owners
+	ring = HashRing()
+	for worker in ["b", "c", "a"]:
+		ring.add_worker(worker)
+	assert get_owners(ring) == owners
+
+	# every worker owns a share of the rooms
+	assert set(owners.values()) == {"a", "b", "c"}
+	for worker in "abc":
+		assert list(owners.values()).count(worker) > len(ROOMS) / 10
+
+
+def test_adding_a_worker_only_moves_rooms_to_it():
+	ring = HashRing(["a", "b", "c"])
+	owners = get_owners(ring)
+	ring.add_worker("d")
+	new_owners = get_owners(ring)
+
+	moved = [room for room in ROOMS if owners[room] != new_owners[room]]
+	assert moved
+	assert all(new_owners[room] == "d" for room in moved)
+	# about a quarter of the rooms, with some margin for the hashing
+	assert len(moved) < len(ROOMS) / 2
+
+
+def test_removing_a_worker_only_moves_its_rooms():
+	ring = HashRing(["a", "b", "c"])
+	owners = get_owners(ring)
+	ring.remove_worker("b")
+	new_owners = get_owners(ring)
+
+	assert "b" not in ring
+	assert set(new_owners.values()) == {"a", "c"}
+	for room in ROOMS:
+		if owners[room] != "b":
+			assert new_owners[room] == owners[room]
+
+
+def test_adding_an_existing_worker_changes_nothing():
+	ring = HashRing(["a", "b"])
+	owners = get_owners(ring)
+	ring.add_worker("a")
+	assert ring.workers == ["a", "b"]
+	assert get_owners(ring) == owners
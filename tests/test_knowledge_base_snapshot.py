@@ -0,0 +1,140 @@
+import os
+
+import pytest
+
+import knowledge_base_snapshot
+from knowledge_base_snapshot import SnapshotError
+
+
+STATE_FILE = b"""name: ask_status
+subtask: introduction
+formulations:
+- What is the status of the robot?
+- How is the robot doing?
+transition_states:
+- inform_status
+- inform_end
+transition_probabilities:
+  inform_status: 0.75
+  inform_end: 0.25
+slots:
+- robot
+"""
+
+FIXED_STATES_FILE = b"""okay: "Okay"
+"yes": "Yes"
+"""
+
+
+@pytest.fixture
+def folder(tmp_path):
+	folder = tmp_path / "dialogue_states"
+	folder.mkdir()
+	(folder / "ask_status.yaml").write_bytes(STATE_FILE)
+	(folder / "fixed_states.yaml").write_bytes(FIXED_STATES_FILE)
+	return str(folder)
+
+
+def read_states(path: str) -> dict:
+	snapshot = knowledge_base_snapshot.read_snapshot(path)
+	try:
+		return {state['name']: (file_name, state) for file_name, state in snapshot.get_states()}
+	finally:
+		snapshot.close()
+
+
+def test_round_trip(folder):
+	path, states, _ = knowledge_base_snapshot.build_snapshot(folder, processes=1)
+	assert path == knowledge_base_snapshot.get_snapshot_path(folder)
+	assert states == 3
+
+	snapshot_states = read_states(path)
+	assert snapshot_states['ask_status'] == ("ask_status.yaml", {
+		'name': "ask_status",
+		'formulations': ["What is the status of the robot?", "How is the robot doing?"],
+		'transition_states': ["inform_status", "inform_end"],
+		'transition_probabilities': {'inform_status': 0.75, 'inform_end': 0.25},
+		'subtask': "introduction",
+		'slots': ["robot"],
+		'is_fixed': False
+	})
+	assert snapshot_states['okay'] == ("fixed_states.yaml", {
+		'name': "okay",
+		'formulations': ["Okay"],
+		'transition_states': [],
+		'transition_probabilities': {},
+		'subtask': None,
+		'slots': [],
+		'is_fixed': True
+	})
+	assert knowledge_base_snapshot.verify_snapshot(folder) == []
+
+
+def test_snapshot_is_stale_when_the_files_change(folder):
+	path, _, _ = knowledge_base_snapshot.build_snapshot(folder, processes=1)
+	snapshot = knowledge_base_snapshot.read_snapshot(path)
+	try:
+		assert snapshot.is_fresh(folder)
+
+		file_path = os.path.join(folder, "ask_status.yaml")
+		with open(file_path, 'ab') as f:
+			f.write(b"- inform_robot\n")
+		assert not snapshot.is_fresh(folder)
+
+		os.remove(file_path)
+		assert not snapshot.is_fresh(folder)
+	finally:
+		snapshot.close()
+	assert knowledge_base_snapshot.verify_snapshot(folder)
+
+
+def test_snapshot_is_stale_when_a_file_is_added(folder):
+	path, _, _ = knowledge_base_snapshot.build_snapshot(folder, processes=1)
+	with open(os.path.join(folder, "inform_end.yaml"), 'wb') as f:
+		f.write(b"name: inform_end\nformulations:\n- Bye\n")
+
+	snapshot = knowledge_base_snapshot.read_snapshot(path)
+	try:
+		assert not snapshot.is_fresh(folder)
+	finally:
+		snapshot.close()
+
+
+@pytest.mark.parametrize("corrupt", [
+	lambda data: data[:len(data) // 2],
+	lambda data: data[:-1] + bytes([data[-1] ^ 0xFF]),
+	lambda data: b"NOTASNAP" + data[8:],
+	lambda data: b"",
+], ids=["truncated", "flipped byte", "magic", "empty"])
+def test_corrupt_snapshot_raises_snapshot_error(folder, corrupt):
+	path, _, _ = knowledge_base_snapshot.build_snapshot(folder, processes=1)
+	with open(path, 'rb') as f:
+		data = f.read()
+	with open(path, 'wb') as f:
+		f.write(corrupt(data))
+
+	with pytest.raises(SnapshotError):
+		knowledge_base_snapshot.read_snapshot(path)
+	assert knowledge_base_snapshot.verify_snapshot(folder)
+
+
+def test_build_fails_on_invalid_file(folder):
+	with open(os.path.join(folder, "broken.yaml"), 'wb') as f:
+		f.write(b"name: [unclosed\n")
+
+	with pytest.raises(knowledge_base_snapshot.StateFileError):
+		knowledge_base_snapshot.build_snapshot(folder, processes=1)
+	assert not os.path.exists(knowledge_base_snapshot.get_snapshot_path(folder))
+
+
+def test_parse_state_files_in_processes():
+	files = [
+		(f"state_{index}.yaml", STATE_FILE.replace(b"ask_status", f"state_{index}".encode()))
+		for index in range(knowledge_base_snapshot.PARALLEL_MIN_FILES)]
+	files.append(("fixed_states.yaml", FIXED_STATES_FILE))
+	files.append(("broken.yaml", b"name: [unclosed\n"))
+
+	results = knowledge_base_snapshot.parse_state_files(files, processes=2)
+	assert results[:-1] == knowledge_base_snapshot.parse_state_files(files[:-1], processes=1)
+	assert [states[0]['name'] for states in results[:3]] == ["state_0", "state_1", "state_2"]
+	assert isinstance(results[-1], knowledge_base_snapshot.StateFileError)
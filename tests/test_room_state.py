@@ -0,0 +1,164 @@
+import fnmatch
+import threading
+import time
+
+import pytest
+
+import room_state
+from room_state import (
+	RoomStateBackend, MemoryRoomStateBackend, SQLiteRoomStateBackend,
+	RedisRoomStateBackend, create_room_state_backend)
+
+
+class FakeRedis:
+	"""
+	Local stand-in for redis.Redis with the calls used by the backend.
+	"""
+
+	def __init__(self):
+		self._values = {}
+		self._expires = {}
+
+	def _expire(self, key):
+		if key in self._expires and self._expires[key] <= time.monotonic():
+			del self._values[key]
+			del self._expires[key]
+
+	def get(self, key):
+		self._expire(key)
+		value = self._values.get(key)
+		return value.encode("utf-8") if value is not None else None
+
+	def set(self, key, value, nx=False, px=None):
+		self._expire(key)
+		if nx and key in self._values:
+			return None
+		self._values[key] = value
+		self._expires.pop(key, None)
+		if px is not None:
+			self._expires[key] = time.monotonic() + px / 1000
+		return True
+
+	def delete(self, key):
+		self._values.pop(key, None)
+		self._expires.pop(key, None)
+
+	def scan_iter(self, match="*"):
+		for key in list(self._values):
+			self._expire(key)
+			if key in self._values and fnmatch.fnmatch(key, match):
+				yield key.encode("utf-8")
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def backend(request, tmp_path) -> RoomStateBackend:
+	if request.param == "memory":
+		return MemoryRoomStateBackend()
+	elif request.param == "sqlite":
+		return SQLiteRoomStateBackend(str(tmp_path / "room_state.db"))
+	return RedisRoomStateBackend(FakeRedis())
+
+
+def test_base_class_is_abstract():
+	with pytest.raises(TypeError):
+		RoomStateBackend()
+
+
+def test_save_load_and_delete(backend):
+	assert backend.load("wizard_task-1") is None
+	assert backend.room_names() == []
+
+	state = {'name': "wizard_task-1", 'users': {"3": {'utterances': 2}}, 'progress': 0.5}
+	backend.save("wizard_task-1", state)
+	backend.save("wizard_task-2", {'name': "wizard_task-2"})
+	assert backend.load("wizard_task-1") == state
+	assert sorted(backend.room_names()) == ["wizard_task-1", "wizard_task-2"]
+
+	# saving again replaces the state
+	backend.save("wizard_task-1", {'name': "wizard_task-1", 'progress': 1})
+	assert backend.load("wizard_task-1") == {'name': "wizard_task-1", 'progress': 1}
+
+	backend.delete("wizard_task-1")
+	backend.delete("wizard_task-3")
+	assert backend.load("wizard_task-1") is None
+	assert backend.room_names() == ["wizard_task-2"]
+
+
+def test_locks_are_not_listed_as_rooms(backend):
+	with backend.lock("wizard_task-1"):
+		assert backend.room_names() == []
+
+
+def test_lock_is_reentrant(backend):
+	with backend.lock("wizard_task-1"):
+		with backend.lock("wizard_task-1"):
+			pass
+		# still held by the outer context
+		assert not backend._acquire("wizard_task-1", "other")
+	assert backend._acquire("wizard_task-1", "other")
+
+
+def test_lock_excludes_other_threads(backend, monkeypatch):
+	monkeypatch.setattr(room_state, "LOCK_RETRY_SECONDS", 0.001)
+	errors = []
+
+	def lock_from_thread():
+		try:
+			with backend.lock("wizard_task-1", timeout=0.05):
+				pass
+		except TimeoutError as ex:
+			errors.append(ex)
+
+	with backend.lock("wizard_task-1"):
+		thread = threading.Thread(target=lock_from_thread)
+		thread.start()
+		thread.join()
+	assert len(errors) == 1
+
+	# other rooms are not locked
+	with backend.lock("wizard_task-2", timeout=0.05):
+		pass
+
+
+def test_release_ignores_other_tokens(backend):
+	assert backend._acquire("wizard_task-1", "token")
+	backend._release("wizard_task-1", "other")
+	assert not backend._acquire("wizard_task-1", "other")
+	backend._release("wizard_task-1", "token")
+	assert backend._acquire("wizard_task-1", "other")
+
+
+@pytest.mark.parametrize("name", ["sqlite", "redis"])
+def test_shared_locks_expire(name, tmp_path, monkeypatch):
+	# a worker that dies while holding a lock does not block the room forever
+	monkeypatch.setattr(room_state, "LOCK_SECONDS", 0.05)
+	backend = SQLiteRoomStateBackend(str(tmp_path / "room_state.db")) \
+		if name == "sqlite" else RedisRoomStateBackend(FakeRedis())
+	assert backend.shared
+
+	assert backend._acquire("wizard_task-1", "token")
+	assert not backend._acquire("wizard_task-1", "other")
+	time.sleep(0.1)
+	assert backend._acquire("wizard_task-1", "other")
+
+
+def test_sqlite_is_shared_between_connections(tmp_path):
+	path = str(tmp_path / "room_state.db")
+	first = SQLiteRoomStateBackend(path)
+	second = SQLiteRoomStateBackend(path)
+
+	first.save("wizard_task-1", {'progress': 0.5})
+	assert second.load("wizard_task-1") == {'progress': 0.5}
+	assert first._acquire("wizard_task-1", "token")
+	assert not second._acquire("wizard_task-1", "other")
+
+
+def test_create_room_state_backend(tmp_path):
+	assert isinstance(create_room_state_backend(None), MemoryRoomStateBackend)
+	assert isinstance(create_room_state_backend("memory://"), MemoryRoomStateBackend)
+	assert not create_room_state_backend("memory://").shared
+	assert isinstance(
+		create_room_state_backend(f"sqlite:///{tmp_path}/room_state.db"),
+		SQLiteRoomStateBackend)
+	with pytest.raises(ValueError):
+		create_room_state_backend("mysql://localhost/crwiz")
@@ -0,0 +1,129 @@
+import json
+
+import pytest
+
+from room_timers import RoomTimers
+from scheduler import Scheduler
+
+
+ROOM = "wizard_task-1"
+ROOM_KEY = ('room_timeout', ROOM)
+TOKEN_KEY = ('token_timeout', ROOM)
+
+
+def on_timeout(_room_name):
+	pass
+
+
+@pytest.fixture
+def schedulers():
+	# one scheduler per worker, the timers are long so they never run here
+	schedulers = {worker: Scheduler(worker) for worker in ["a", "b"]}
+	yield schedulers
+	for scheduler in schedulers.values():
+		scheduler.stop()
+
+
+def new_timers(worker: str, schedulers: dict) -> RoomTimers:
+	return RoomTimers(ROOM, worker, schedulers[worker], on_timeout)
+
+
+def round_trip(timers: RoomTimers) -> dict:
+	# the state goes through JSON in the shared backends
+	return json.loads(json.dumps(timers.to_dict()))
+
+
+def test_timers_only_run_in_their_worker(schedulers):
+	timers_a = new_timers("a", schedulers)
+	timers_a.set_end_time(300)
+	assert timers_a.timer_worker == "a"
+	assert ROOM_KEY in schedulers["a"]
+
+	timers_b = new_timers("b", schedulers)
+	timers_b.restore(round_trip(timers_a), task_finished=False)
+	assert timers_b.timer_worker == "a"
+	assert timers_b.end_time == timers_a.end_time
+	# the key is kept so the room knows it has a timeout, but it is not scheduled
+	assert timers_b.room_timer == ROOM_KEY
+	assert ROOM_KEY not in schedulers["b"]
+	assert timers_b.to_dict() == timers_a.to_dict()
+
+
+def test_restore_rearms_the_timers_of_this_worker(schedulers):
+	timers = new_timers("a", schedulers)
+	timers.set_end_time(300)
+	timers.start_token_timer(on_timeout, 600)
+	state = round_trip(timers)
+
+	# e.g. the room was loaded again in the same worker
+	schedulers["a"].stop()
+	restored = new_timers("a", schedulers)
+	restored.restore(state, task_finished=False, token_timeout_callback=on_timeout)
+
+	assert restored.to_dict() == state
+	assert 290 < schedulers["a"].get_remaining(ROOM_KEY) <= 301
+	assert 590 < schedulers["a"].get_remaining(TOKEN_KEY) <= 600
+
+
+def test_restore_follows_a_new_end_time(schedulers):
+	timers_a = new_timers("a", schedulers)
+	timers_a.set_end_time(300)
+	timers_b = new_timers("b", schedulers)
+	timers_b.restore(round_trip(timers_a), task_finished=False)
+
+	# worker b shortens the task, so it runs the timeout now
+	timers_b.set_end_time(30)
+	timers_a.restore(round_trip(timers_b), task_finished=False)
+	assert timers_a.timer_worker == "b"
+	assert timers_a.end_time == timers_b.end_time
+	assert ROOM_KEY not in schedulers["a"]
+	assert schedulers["b"].get_remaining(ROOM_KEY) <= 31
+
+	# and moving it back to worker a schedules it there again
+	timers_a.set_end_time(60)
+	timers_b.restore(round_trip(timers_a), task_finished=False)
+	assert ROOM_KEY not in schedulers["b"]
+	assert 50 < schedulers["a"].get_remaining(ROOM_KEY) <= 61
+
+
+def test_restore_cancels_the_timeout_of_finished_tasks(schedulers):
+	timers_a = new_timers("a", schedulers)
+	timers_a.set_end_time(300)
+	state = round_trip(timers_a)
+
+	timers_a.restore(state, task_finished=True)
+	assert timers_a.room_timer is None
+	assert ROOM_KEY not in schedulers["a"]
+
+
+def test_token_timer_needs_its_callback(schedulers):
+	timers_a = new_timers("a", schedulers)
+	timers_a.start_token_timer(on_timeout, 600)
+	state = round_trip(timers_a)
+
+	restored = new_timers("a", schedulers)
+	schedulers["a"].stop()
+	restored.restore(state, task_finished=True)
+	assert restored.token_end_time == timers_a.token_end_time
+	assert TOKEN_KEY not in schedulers["a"]
+
+
+def test_cancel(schedulers):
+	timers = new_timers("a", schedulers)
+	timers.set_end_time(300)
+	timers.start_token_timer(on_timeout, 600)
+	timers.cancel()
+	assert timers.room_timer is None and timers.token_timer is None
+	assert len(schedulers["a"]) == 0
+	assert not timers.to_dict()['room_timer']
+
+
+def test_timers_of_stopped_workers_are_taken_over(schedulers):
+	timers_a = new_timers("a", schedulers)
+	timers_a.set_end_time(300)
+	state = round_trip(timers_a)
+
+	timers_b = RoomTimers(ROOM, "b", schedulers["b"], on_timeout, lambda worker: worker == "a")
+	timers_b.restore(state, task_finished=False)
+	assert timers_b.timer_worker == "b"
+	assert 290 < schedulers["b"].get_remaining(ROOM_KEY) <= 301
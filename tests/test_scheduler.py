@@ -0,0 +1,97 @@
+import threading
+import time
+
+from scheduler import Scheduler
+
+
+def run_inline(function, *args):
+	function(*args)
+
+
+def wait_for(condition, timeout: float = 2):
+	deadline = time.monotonic() + timeout
+	while not condition() and time.monotonic() < deadline:
+		time.sleep(0.01)
+	return condition()
+
+
+def test_callbacks_run_in_deadline_order():
+	scheduler = Scheduler("test", run_inline)
+	calls = []
+	scheduler.schedule("c", 0.15, calls.append, ["c"])
+	scheduler.schedule("a", 0.05, calls.append, ["a"])
+	scheduler.schedule("b", 0.1, calls.append, ["b"])
+	# same deadline as "a", runs after it
+	scheduler.schedule(None, 0.05, calls.append, ["a2"])
+
+	assert wait_for(lambda: len(calls) == 4)
+	assert calls == ["a", "a2", "b", "c"]
+	assert len(scheduler) == 0
+	scheduler.stop()
+
+
+def test_cancel():
+	scheduler = Scheduler("test", run_inline)
+	calls = []
+	scheduler.schedule("a", 0.05, calls.append, ["a"])
+	scheduler.schedule("b", 0.1, calls.append, ["b"])
+
+	assert "a" in scheduler
+	assert scheduler.cancel("a")
+	assert not scheduler.cancel("a")
+	assert "a" not in scheduler
+
+	assert wait_for(lambda: calls == ["b"])
+	time.sleep(0.1)
+	assert calls == ["b"]
+	scheduler.stop()
+
+
+def test_reschedule():
+	scheduler = Scheduler("test", run_inline)
+	calls = []
+	scheduler.schedule("a", 0.05, calls.append, ["a"])
+	scheduler.schedule("b", 0.1, calls.append, ["b"])
+
+	assert scheduler.reschedule("a", 0.2)
+	assert not scheduler.reschedule("missing", 0.1)
+	assert scheduler.get_remaining("a") > 0.1
+	assert [key for key, _ in scheduler.pending()] == ["b", "a"]
+
+	assert wait_for(lambda: len(calls) == 2)
+	assert calls == ["b", "a"]
+	scheduler.stop()
+
+
+def test_schedule_same_key_replaces_timer():
+	scheduler = Scheduler("test", run_inline)
+	calls = []
+	scheduler.schedule("a", 0.05, calls.append, [1])
+	scheduler.schedule("a", 0.05, calls.append, [2])
+
+	assert len(scheduler) == 1
+	assert wait_for(lambda: calls == [2])
+	scheduler.stop()
+
+
+def test_slow_callback_does_not_delay_others():
+	scheduler = Scheduler("test")
+	release = threading.Event()
+	calls = []
+	scheduler.schedule("slow", 0.01, release.wait, [2])
+	scheduler.schedule("fast", 0.05, calls.append, ["fast"])
+
+	assert wait_for(lambda: calls == ["fast"], timeout=1)
+	release.set()
+	scheduler.stop()
+
+
+def test_stop_cancels_timers():
+	scheduler = Scheduler("test", run_inline)
+	calls = []
+	scheduler.schedule("a", 0.05, calls.append, ["a"])
+	scheduler.stop()
+
+	time.sleep(0.1)
+	assert calls == []
+	assert len(scheduler) == 0
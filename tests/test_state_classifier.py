@@ -0,0 +1,77 @@
+import pytest
+
+from state_classifier import StateClassifier, get_terms
+
+
+FORMULATIONS = [
+	("intro_hello", "Hello, I am {robot.name}, how can I help you?"),
+	("intro_hello", "Hi there!"),
+	("inspect_fire", "Send {robot.name} to inspect the fire in the {area}"),
+	("inspect_fire", "Inspect the [east] tower"),
+	("extinguish_fire", "Extinguish the fire with {robot.name}"),
+	("emergency_services", "Should I call the emergency services?"),
+	("no_words", "{robot.name} <pause>"),
+]
+
+
+@pytest.fixture(scope="module")
+def classifier() -> StateClassifier:
+	return StateClassifier(FORMULATIONS)
+
+
+def test_get_terms():
+	assert get_terms("Send {robot.name} to the [east] tower!") == [
+		"send", "to", "the", "tower", "send to", "to the", "the tower"]
+	assert get_terms("Don't", (1, 1)) == ["don't"]
+
+
+def test_formulations_without_terms_are_not_indexed(classifier):
+	assert len(classifier) == len(FORMULATIONS) - 1
+	assert "no_words" not in classifier.state_names
+
+
+def test_top_k_ranking(classifier):
+	predictions = classifier.classify("inspect the fire in the tower", k=3)
+	# emergency_services only shares "the" with the text
+	assert [state for state, _ in predictions] == [
+		"inspect_fire", "extinguish_fire", "emergency_services"]
+	scores = [score for _, score in predictions]
+	assert scores == sorted(scores, reverse=True)
+	assert all(0 < score <= 1 for score in scores)
+
+	assert classifier.classify("inspect the fire in the tower", k=1) == predictions[:1]
+	assert classifier.classify("put out the fire with the robot")[0][0] == "extinguish_fire"
+
+
+def test_exact_formulation_scores_one(classifier):
+	state, score = classifier.classify("Should I call the emergency services?")[0]
+	assert state == "emergency_services"
+	assert score == pytest.approx(1)
+
+
+def test_state_score_is_its_closest_formulation(classifier):
+	# "hi there" only matches the second formulation of intro_hello
+	assert classifier.classify("hi there")[0] == ("intro_hello", pytest.approx(1))
+
+
+@pytest.mark.parametrize("text", ["", "   ", "?!", "zebra quantum"])
+def test_empty_or_unknown_text(classifier, text):
+	assert classifier.classify(text) == []
+
+
+def test_unknown_words_lower_the_score(classifier):
+	_, score = classifier.classify("hi there")[0]
+	_, lower_score = classifier.classify("hi there zebra")[0]
+	assert 0 < lower_score < score
+
+
+def test_k_is_capped(classifier):
+	assert classifier.classify("the fire", k=0) == []
+	predictions = classifier.classify("the fire", k=100)
+	assert len(predictions) <= len(classifier.state_names)
+
+
+def test_empty_classifier():
+	classifier = StateClassifier([])
+	assert len(classifier) == 0
+	assert classifier.classify("hello") == []